@@ -1,8 +1,14 @@
 # Import required libraries
-from utils.model import *
-from flask import Flask, render_template, request, jsonify
-import pandas as pd
-import numpy as np
+import os
+import csv
+import queue
+import threading
+import time
+from concurrent.futures import TimeoutError
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context, g
+from utils.locations import INACTIVE_LOCATIONS, manifest_path, load_active_locations
+from utils.workers import InferencePool, Overloaded
+from utils import metrics
 
 # Data location
 DATA_PATH = "../data/"
@@ -10,84 +16,253 @@ DATA_PATH = "../data/"
 ENCODERS_PATH = "encoders/"
 # Model location
 MODEL_PATH = "models/"
+# Feature store location
+FEATURE_STORE_PATH = DATA_PATH + "feature_store/"
+# Shared on-disk tier of the response cache for several worker processes (disabled when unset)
+CACHE_PATH = os.environ.get('PRICING_CACHE_PATH')
+# background: load the models in a thread while the app already serves pages (see /api/v1/ready)
+# lazy: load them on the first prediction, eager: load them before serving
+STARTUP = os.environ.get('PRICING_STARTUP', 'background')
 
+# Pricing functions and the response cache, filled in by initialise
+services = dict()
+ready = threading.Event()
+startup_error = None
+_initialise_lock = threading.Lock()
+# Pricing computations run in a bounded pool, concurrent requests for the same location and hour share one
+pool = InferencePool()
+# Pool, cache and surface statistics that only go up, exported as Prometheus counters
+COUNTERS = ['pricing_pool_submitted', 'pricing_pool_coalesced', 'pricing_pool_rejected', 'pricing_cache_hits',
+            'pricing_cache_disk_hits', 'pricing_cache_misses', 'pricing_surface_hits', 'pricing_surface_misses']
+
+
+class PricingUnavailable(Exception):
+    pass
+
+
+class UnknownLocation(Exception):
+    pass
+
+
+def initialise():
+    '''Import the pricing stack (pandas, TensorFlow, XGBoost), load and warm up every model'''
+    global startup_error
+    with _initialise_lock:
+        if ready.is_set():
+            return
+        try:
+            # Heavy imports are deferred so the app starts serving pages straight away
+            from utils.registry import get_registry
+            from utils.pricing import price_location, price_batch
+            from utils.cache import ResponseCache
+            from utils.surface import SurfaceReader
+
+            # Load all models, scalers and encoders once and hot-reload them when models/ changes
+            registry = get_registry().load()
+            registry.start_watcher()
+
+            # Pricing results only change with the feature store or the models
+            # Precomputed prices of every location and hour (python -m utils.surface) are used while they are current
+            services.update(price_location=price_location, price_batch=price_batch,
+                            cache=ResponseCache(disk_path=CACHE_PATH), surface=SurfaceReader())
+            startup_error = None
+            ready.set()
+        except Exception as e:
+            startup_error = f'{type(e).__name__}: {e}'
+            print(f"Error initialising pricing: {startup_error}")
+
+
+def get_services():
+    '''pricing services, waiting for the background initialisation or running it'''
+    if not ready.is_set():
+        initialise()
+    if not ready.is_set():
+        raise PricingUnavailable(startup_error)
+    return services
+
+
+if STARTUP == 'eager':
+    initialise()
+elif STARTUP == 'background':
+    threading.Thread(target=initialise, name='pricing-initialiser', daemon=True).start()
+
+
+def load_locations():
+    '''(location, display_name) of the active locations from the manifest of the feature store (python -m utils.locations)'''
+    if os.path.exists(manifest_path(FEATURE_STORE_PATH)):
+        return load_active_locations(FEATURE_STORE_PATH)
+    # Stores built before the manifest: every location of the transformed dataset but the inactive ones
+    with open(DATA_PATH + 'transformed_dataset.csv', newline='') as file:
+        locations = sorted({row['location'] for row in csv.DictReader(file)} - set(INACTIVE_LOCATIONS))
+    return [(location, location) for location in locations]
+
+
+def check_location(location):
+    '''raise UnknownLocation for a location that is not active in the manifest, any location passes without one'''
+    global _known_locations
+    if not os.path.exists(manifest_path(FEATURE_STORE_PATH)):
+        return
+    locations = load_active_locations(FEATURE_STORE_PATH)
+    if _known_locations[0] is not locations:
+        _known_locations = (locations, {name for name, display_name in locations})
+    if location not in _known_locations[1]:
+        raise UnknownLocation(location)
+
+
+# GET / page of the last location list
+_index_page = (None, None)
+# Names of the active locations of the last location list
+_known_locations = (None, set())
 
 
 app = Flask(__name__)
 
+@app.errorhandler(PricingUnavailable)
+def pricing_unavailable(e):
+    return jsonify(error=f'Pricing is not available: {e}'), 503
+
+@app.errorhandler(UnknownLocation)
+def unknown_location(e):
+    return jsonify(error=f'Unknown location {e}'), 404
+
+@app.errorhandler(Overloaded)
+def overloaded(e):
+    return jsonify(error=f'Too many pricing requests: {e}'), 503, {'Retry-After': '1'}
+
+@app.errorhandler(TimeoutError)
+def timed_out(e):
+    return jsonify(error=f'Pricing took longer than {pool.timeout}s'), 504
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.observe('pricing_request_seconds', time.perf_counter() - g.start, endpoint=endpoint, method=request.method,
+                    status=response.status_code)
+    return response
+
+def compute_and_cache(pricing, location, hour_of_the_day):
+    '''price one location and hour in a pool worker and cache the response, with the milliseconds of every stage'''
+    response, stages = metrics.profiled(pricing['price_location'], location, hour_of_the_day)
+    pricing['cache'].set(location, hour_of_the_day, response)
+    return response, stages
+
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
-    # Get locations from the csv file
-    df = pd.read_csv(DATA_PATH + 'transformed_dataset.csv')
-    locations = np.sort(df['location'].unique()).tolist()
-    remove_locations = ['Banbury', 'Billingshurst', 'Coatbridge', 'Dalkeith', 'Dunbar', 'Exeter', \
-                        'Haddington', 'Huntly', 'Leamington-Spa', 'Nantwich', 'Newbury', 'North Berwick', 'North Shields',\
-                            'On-fleet Bay', 'Poole', 'Putney', 'South Shields', 'Sunderland', 'Upper Tooting', 'Wandsworth', \
-                                'Warwick', 'Wokingham', 'Worthing']
-    for location in remove_locations:
-        locations.remove(location)
-
+    global _index_page
     if request.method == 'POST':
-        location = request.form['location']
-        hour_of_the_day = float(request.form['hour_of_the_day'])
-
-        # Load historical data
-        scaled_df, df = load_preprocessed_data()
-        predictions_df = predict_rates(scaled_df, location)
-        demand_factor_value, peak_hours = demand_factor(df, location, hour_of_the_day)
-
-        predictions_df = apply_dynamic_pricing_strategy(predictions_df, demand_factor_value)
-
-        # adjust final prices
-        grouped_averages = get_average_rates(df, location)
-        predictions_df = predictions_df.apply(lambda row: adjust_prices(row, grouped_averages), axis=1)
-        predictions_df.rename(columns={'hourly_rate': 'current_hourly_rate', 
-                                       'daily_rate': 'current_daily_rate', 'final_hourly_rate': 'adjusted_hourly_rate',
-                                       'final_daily_rate': 'adjusted_daily_rate'}, inplace=True)
-        predictions = dict()
-
-        # store all values of predictions_df in predictions dict
-        for index, row in predictions_df.iterrows():
-            predictions[row['vehicle_type']] = {
-                'current_hourly_rate': row['current_hourly_rate'],
-                'current_daily_rate': row['current_daily_rate'],
-                'adjusted_hourly_rate': row['adjusted_hourly_rate'],
-                'adjusted_daily_rate': row['adjusted_daily_rate']
-            }
-
-        # Predict demand_factor for Profitability Calculation
-        df_merged_revenue = calculate_profitability(df, location, predictions_df)
-
-        profitability = dict()
-
-        # store all values of predictions_df in predictions dict
-        for index, row in df_merged_revenue.iterrows():
-            profitability[row['vehicle_type']] = {
-                'adjusted_revenue': row['adjusted_revenue'],
-                'actual_revenue': row['actual_revenue'],
-                'profitability': row['profitability']
-            }
-
-        # Initialize sums
-        total_adjusted_revenue = 0
-        total_actual_revenue = 0
-        total_profitability = 0
-
-        # Iterate through the dictionary and sum up the values
-        for key, value in profitability.items():
-            total_adjusted_revenue += value['adjusted_revenue']
-            total_actual_revenue += value['actual_revenue']
-            total_profitability += value['profitability']
-
-        # Add the new key with summed values
-        profitability['Z'] = {
-            'adjusted_revenue': total_adjusted_revenue,
-            'actual_revenue': total_actual_revenue,
-            'profitability': total_profitability
-        }
-
-        return jsonify(peakHours=peak_hours, predictions=predictions, profitability=profitability)
-    return render_template('index.html', locations=locations)
+        location = request.form.get('location', '')
+        try:
+            hour_of_the_day = float(request.form['hour_of_the_day'])
+        except (KeyError, ValueError):
+            return jsonify(error='Expected a location and a numeric hour_of_the_day'), 400
+        check_location(location)
+
+        # Historical data of the location comes from the feature store (python -m utils.feature_store)
+        pricing = get_services()
+        stages = dict()
+        source = 'surface'
+        response = pricing['surface'].lookup(location, hour_of_the_day, pricing['cache'].versions())
+        if response is None:
+            source = 'cache'
+            response = pricing['cache'].get(location, hour_of_the_day)
+        if response is None:
+            source = 'computed'
+            response, stages = pool.run((location, hour_of_the_day), compute_and_cache, pricing, location, hour_of_the_day)
+
+        # Stage breakdown of the computation (shared by coalesced requests) with the X-Pricing-Profile header
+        if request.headers.get('X-Pricing-Profile'):
+            total = (time.perf_counter() - g.start) * 1000
+            profile = {'source': source, 'total_ms': total, 'stages_ms': stages}
+            server_timing = ', '.join(f'{stage.replace(" ", "_")};dur={ms:.2f}' for stage, ms in stages.items())
+            return jsonify(**response, profile=profile), {'Server-Timing': server_timing or f'{source};dur={total:.2f}'}
+        return jsonify(**response)
+
+    # The page only changes with the locations manifest
+    locations = load_locations()
+    if _index_page[0] is not locations:
+        _index_page = (locations, render_template('index.html', locations=locations))
+    return _index_page[1]
+
+@app.route('/api/v1/prices/batch', methods=['POST'])
+def prices_batch():
+    '''Price many (location, hour_of_the_day) pairs, streamed back as one JSON line per pair'''
+    body = request.get_json(silent=True) or {}
+    pairs = body.get('pairs')
+    if not isinstance(pairs, list) or not pairs:
+        return jsonify(error="Expected a JSON body {'pairs': [{'location': ..., 'hour_of_the_day': ...}, ...]}"), 400
+    try:
+        pairs = [(str(pair['location']), float(pair['hour_of_the_day'])) for pair in pairs]
+    except (KeyError, TypeError, ValueError):
+        return jsonify(error='Every pair needs a location and a numeric hour_of_the_day'), 400
+
+    pricing = get_services()
+    results = queue.Queue()
+
+    def produce():
+        # runs in a pool worker, the response streams the results as they are put
+        try:
+            for result in pricing['price_batch'](pairs, cache=pricing['cache']):
+                results.put(result)
+        except Exception as e:
+            # the status line is already sent, the error ends the stream as its last line
+            print(f"Error pricing a batch of {len(pairs)} pairs: {e!r}")
+            results.put({'error': f'Pricing failed: {e}'})
+        finally:
+            results.put(None)
+
+    pool.submit(None, produce)
+
+    def generate():
+        while True:
+            try:
+                # a worker that stops putting results ends the stream instead of holding the request
+                result = results.get(timeout=pool.timeout)
+            except queue.Empty:
+                print(f"Error pricing a batch of {len(pairs)} pairs: no result for {pool.timeout}s")
+                yield app.json.dumps({'error': f'Pricing took longer than {pool.timeout}s'}) + '\n'
+                return
+            if result is None:
+                return
+            if isinstance(result, dict):
+                yield app.json.dumps(result) + '\n'
+                continue
+            location, hour_of_the_day, response = result
+            yield app.json.dumps(dict(location=location, hour_of_the_day=hour_of_the_day, **response)) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/api/v1/cache/stats')
+def cache_stats():
+    '''hit and miss counters of the response cache'''
+    return jsonify(**get_services()['cache'].stats())
+
+@app.route('/metrics')
+def prometheus_metrics():
+    '''stage, model and request latency histograms with the pool and cache counters in the Prometheus text format'''
+    gauges = {f'pricing_pool_{name}': value for name, value in pool.stats().items()}
+    if ready.is_set():
+        gauges.update({f'pricing_cache_{name}': value for name, value in services['cache'].stats().items()})
+        gauges.update({f'pricing_surface_{name}': value for name, value in services['surface'].stats().items()})
+    counters = {name: gauges.pop(name) for name in COUNTERS if name in gauges}
+    gauges['pricing_ready'] = int(ready.is_set())
+    return Response(metrics.render(gauges, counters), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/v1/pool/stats')
+def pool_stats():
+    '''size and counters of the pricing worker pool'''
+    return jsonify(**pool.stats())
+
+@app.route('/api/v1/ready')
+def readiness():
+    '''200 once the models are loaded and warmed up, 503 before (or when loading failed)'''
+    if ready.is_set():
+        return jsonify(ready=True)
+    return jsonify(ready=False, startup=STARTUP, error=startup_error), 503
 
 if __name__ == '__main__':
     app.run()
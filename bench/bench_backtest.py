@@ -0,0 +1,81 @@
+'''Benchmark a five year, all locations backtest against replaying calculate_profitability per location and day
+
+python -m bench.bench_backtest [history rows] [days replayed per location]
+'''
+import sys
+import time
+import numpy as np
+import pandas as pd
+from utils.model import CATEGORIES, apply_schema
+from utils.backtest import backtest, booking_revenue, select_window
+
+
+def make_history(rows, seed=0):
+    '''random stored history (log transformed costs) of every location over five years'''
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp('2020-01-01')
+    seconds = rng.integers(0, int((pd.Timestamp('2025-01-01') - start).total_seconds()), rows)
+    hours = rng.integers(0, 24, rows)
+    return apply_schema(pd.DataFrame({
+        'location': rng.choice(np.array(CATEGORIES['location'], dtype=object), rows),
+        'Vehicle Type': rng.choice(np.array(CATEGORIES['Vehicle Type'], dtype=object), rows),
+        'booking_billed_start': start + pd.to_timedelta(seconds, unit='s'),
+        'booking_created_at_hour': hours,
+        'booking_rates_hours': rng.integers(0, 12, rows).astype(float),
+        'booking_rates_24hours': rng.integers(0, 3, rows).astype(float),
+        'booking_actual_cost_distance': np.log1p(rng.uniform(0, 40, rows)),
+        'booking_actual_cost_total': np.log1p(rng.uniform(5, 200, rows)),
+    }))
+
+
+def make_rates(seed=0):
+    '''adjusted rates of every location, vehicle type and hour'''
+    rng = np.random.default_rng(seed)
+    index = pd.MultiIndex.from_product([CATEGORIES['location'], CATEGORIES['Vehicle Type'], range(24)],
+                                       names=['location', 'vehicle_type', 'hour'])
+    return pd.DataFrame({'adjusted_hourly_rate': np.round(rng.uniform(5, 12, len(index)), 2),
+                         'adjusted_daily_rate': np.round(rng.uniform(40, 80, len(index)), 2)}, index=index).reset_index()
+
+
+def replay_day(df, rates, location, day):
+    '''the per location and day path: filter, merge the rates and sum, as calculate_profitability did'''
+    day_df = df[(df['location'] == location) & (df['booking_billed_start'] >= day) &
+                (df['booking_billed_start'] < day + pd.Timedelta(days=1))].copy()
+    day_df['actual_revenue'] = np.expm1(day_df['booking_actual_cost_total'])
+    merged = pd.merge(day_df.astype({'location': object, 'Vehicle Type': object}), rates,
+                      left_on=['location', 'Vehicle Type', 'booking_created_at_hour'],
+                      right_on=['location', 'vehicle_type', 'hour'], how='inner')
+    merged['adjusted_revenue'] = np.round(np.round(merged['booking_rates_hours'] * merged['adjusted_hourly_rate'] +
+                                                   merged['booking_rates_24hours'] * merged['adjusted_daily_rate'], 2) +
+                                          np.expm1(merged['booking_actual_cost_distance']), 2)
+    return merged.groupby('vehicle_type')[['actual_revenue', 'adjusted_revenue']].sum()
+
+
+def main(rows=3000000, days=20):
+    df = make_history(rows)
+    rates = make_rates()
+
+    start = time.perf_counter()
+    daily = backtest(df, rates)
+    vectorised = time.perf_counter() - start
+
+    # Per location and day replay on a sample of days, extrapolated to the whole window
+    sample_days = pd.date_range('2020-01-01', '2024-12-31', freq='D')[::(1827 // days)][:days]
+    start = time.perf_counter()
+    for day in sample_days:
+        expected = replay_day(df, rates, 'Newcastle', day)
+        result = daily.xs(('Newcastle', day), level=['location', 'date'])[['actual_revenue', 'adjusted_revenue']]
+        pd.testing.assert_frame_equal(result.sort_index(), expected.sort_index(), check_names=False, check_index_type=False)
+    per_day = (time.perf_counter() - start) / days
+    replays = len(CATEGORIES['location']) * 1827
+
+    # every booking with rates is accounted for
+    np.testing.assert_allclose(daily['actual_revenue'].sum(), booking_revenue(select_window(df), rates)['actual_revenue'].sum())
+
+    print(f'history rows: {rows}, locations: {len(CATEGORIES["location"])}, days: 1827')
+    print(f'backtest: {vectorised:.2f}s for {len(daily)} location, vehicle type and day rows')
+    print(f'per location and day replay: {per_day * 1000:.1f}ms each, {per_day * replays / 3600:.1f}h for all {replays}')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
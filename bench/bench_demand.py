@@ -0,0 +1,55 @@
+'''Benchmark the per-row demand_factor of calculate_profitability against the DemandIndex lookup
+
+python -m bench.bench_demand [history rows] [last month rows]
+'''
+import sys
+import time
+import numpy as np
+import pandas as pd
+from utils.model import demand_factor
+from utils.demand import DemandIndex
+
+
+def make_history(rows, seed=0):
+    '''random bookings with a skewed location and created hour distribution'''
+    rng = np.random.default_rng(seed)
+    locations = np.array([f'Location {i:02d}' for i in range(60)] + ['Newcastle'], dtype=object)
+    location_weights = rng.pareto(1.5, len(locations)) + 0.1
+    hour_weights = np.exp(-0.5 * ((np.arange(24) - 17) / 4) ** 2) + 0.05
+    return pd.DataFrame({
+        'location': rng.choice(locations, rows, p=location_weights / location_weights.sum()),
+        'booking_created_at_hour': rng.choice(24, rows, p=hour_weights / hour_weights.sum()).astype(np.int32),
+    })
+
+
+def main(history_rows=200000, rows=1000):
+    df = make_history(history_rows)
+    filtered_df = df.sample(rows, random_state=0).reset_index(drop=True)
+
+    # Current path of calculate_profitability, one demand_factor call per row
+    start = time.perf_counter()
+    expected = filtered_df.apply(lambda row: demand_factor(df, 'Newcastle', row['booking_created_at_hour'])[0], axis=1)
+    per_row = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = DemandIndex.from_history(df)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = index.hour_factors('Newcastle', filtered_df['booking_created_at_hour'])
+    lookup = time.perf_counter() - start
+
+    np.testing.assert_array_equal(result, expected.to_numpy())
+    # every (location, hour) pair matches demand_factor
+    for location in df['location'].unique():
+        for hour in range(24):
+            assert index.lookup(location, hour) == demand_factor(df, location, hour), (location, hour)
+
+    print(f'history rows: {history_rows}, last month rows: {rows}')
+    print(f'demand_factor per row: {per_row:.3f}s')
+    print(f'DemandIndex build: {build:.3f}s, lookup: {lookup * 1000:.3f}ms')
+    print(f'speedup (build + lookup): {per_row / (build + lookup):.1f}x')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
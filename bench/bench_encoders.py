@@ -0,0 +1,79 @@
+'''Compare the compiled lookup encoders with the pickled category_encoders encoders, bit for bit and in speed
+
+python -m bench.bench_encoders [rows]   (synthetic bookings from bench/generate_data.py)
+Exits with status 1 when the encoded columns or the float32 feature matrix differ.
+'''
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import joblib
+import numpy as np
+import pandas as pd
+from bench.generate_data import generate
+from utils.encoders import PICKLES, compile_encoders, LookupEncoder, reference_transform, check_equivalence, coverage_frame
+from utils.model import ENCODERS_PATH, MODEL_FEATURES, preprocess_data, transform_data, structure_dataframe
+
+
+def best_time(function, *args, repeat=5):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def load_time(statement):
+    '''seconds to import and load the encoders in a new process'''
+    code = f'import time; start = time.perf_counter(); {statement}; print(time.perf_counter() - start)'
+    process = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    return float(process.stdout.strip().splitlines()[-1])
+
+
+def main(rows=200000):
+    binary_encoder, one_hot_encoder = [joblib.load(os.path.join(ENCODERS_PATH, name)) for name in PICKLES]
+    encoder = LookupEncoder(compile_encoders(binary_encoder, one_hot_encoder))
+
+    data_path = tempfile.mkdtemp(prefix='pricing_bench_')
+    try:
+        generate(rows, data_path)
+        df = transform_data(preprocess_data(pd.read_csv(os.path.join(data_path, '2024 Bookings.csv')),
+                                            pd.read_csv(os.path.join(data_path, 'Diff Tariffs.csv'))))
+    finally:
+        shutil.rmtree(data_path, ignore_errors=True)
+    # a few unknown and missing locations and seasons
+    df.loc[df.index[:3], 'location'] = np.nan
+    df['season'] = df['season'].astype(object)
+    df.loc[df.index[3:6], 'season'] = 'Monsoon'
+
+    differences = check_equivalence(encoder, binary_encoder, one_hot_encoder, df)
+    differences += check_equivalence(encoder, binary_encoder, one_hot_encoder, coverage_frame(encoder))
+    for difference in differences:
+        print(f'Error: {difference}')
+    if differences:
+        return 1
+
+    def pickled_matrix(df):
+        encoded = pd.concat([df, reference_transform(binary_encoder, one_hot_encoder, df)], axis=1)
+        return structure_dataframe(encoded)[MODEL_FEATURES].to_numpy(dtype=np.float32)
+
+    out = np.empty((len(df), len(MODEL_FEATURES)), dtype=np.float32)
+    pickled = best_time(reference_transform, binary_encoder, one_hot_encoder, df)
+    compiled = best_time(encoder.transform, df)
+    pickled_features = best_time(pickled_matrix, df)
+    compiled_features = best_time(encoder.feature_matrix, df, out)
+    print(f'{len(df)} rows, identical output')
+    print(f'encoded columns: pickled {pickled * 1000:.1f}ms | compiled {compiled * 1000:.1f}ms ({pickled / compiled:.0f}x)')
+    print(f'float32 feature matrix: pickled + structure_dataframe {pickled_features * 1000:.1f}ms | '
+          f'compiled into a preallocated matrix {compiled_features * 1000:.1f}ms ({pickled_features / compiled_features:.0f}x)')
+    pickled_load = load_time(f"import joblib; [joblib.load('{ENCODERS_PATH}' + name) for name in {PICKLES}]")
+    compiled_load = load_time('from utils.encoders import load_encoders; load_encoders()')
+    print(f'import and load: pickles {pickled_load * 1000:.0f}ms | compiled {compiled_load * 1000:.0f}ms')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000))
@@ -0,0 +1,112 @@
+'''Benchmark the vectorised feature kernel (utils/features.py) against the steps of preprocess_data it replaced
+
+python -m bench.bench_features [rows]   (default 1000000 synthetic bookings)
+Each step is checked to give the same values as the row-wise version before it is timed.
+'''
+import sys
+import time
+import numpy as np
+import pandas as pd
+from bench.generate_data import booking_chunk
+from utils.features import calendar_features, flag, resolve_office_codes, clip_columns, WEEKEND_DAYS
+from utils.model import OUTLIER_COLUMNS, get_outlier_bounds
+
+
+def reference_office_codes(dataframe):
+    '''Step 7 as eleven str.contains passes'''
+    dataframe['location_office_use'] = dataframe['location_office_use'].str[:3]
+    for code, pattern in [('BRI', 'Lower Maudlin|Bristol'), ('GLA', 'glasgow|Glsgow'), ('NCL', 'Nwcastle'), ('BIR', 'Birmingham'),
+                          ('TUN', 'Tunbridge Wells'), ('FRO', 'Frome'), ('EXE', 'Exeter'), ('DUR', 'Durham'),
+                          ('SAL', 'Salford|Slaford'), ('SWI', "S'land"), ('REA', 'Reading')]:
+        dataframe.loc[(dataframe['location_description'].str.contains(pattern, case=False, na=False)) & (dataframe['location_office_use'].isnull()), 'location_office_use'] = code
+    return dataframe['location_office_use']
+
+
+def reference_season(date):
+    month = date.month
+    day = date.day
+    if (month == 3 and day >= 1) or (month > 3 and month < 6) or (month == 6 and day <= 30):
+        return 'Spring'
+    elif (month == 6 and day >= 1) or (month > 6 and month < 9) or (month == 9 and day <= 30):
+        return 'Summer'
+    elif (month == 9 and day >= 1) or (month > 9 and month < 12) or (month == 12 and day <= 31):
+        return 'Autumn'
+    else:
+        return 'Winter'
+
+
+def reference_holiday(date):
+    if (date.month == 12 and date.day >= 24) or (date.month == 1 and date.day <= 1) or \
+    (date.month == 5 and date.day == 27) or (date.month == 3 and date.day == 29) or \
+    (date.month == 8 and date.day == 26) or (date.month == 4 and date.day == 1) or (date.month == 5 and date.day == 6):
+        return 1
+    return 0
+
+
+def reference_cap(dataframe, lower_bound, upper_bound):
+    '''Step 17 as twelve np.where calls'''
+    for column in OUTLIER_COLUMNS:
+        dataframe[column] = np.where(dataframe[column] > upper_bound[column], upper_bound[column], dataframe[column])
+        dataframe[column] = np.where(dataframe[column] < lower_bound[column], lower_bound[column], dataframe[column])
+    return dataframe
+
+
+def make_frame(rows, seed=0):
+    '''synthetic bookings with missing dates, missing descriptions and descriptions matching several codes'''
+    rng = np.random.default_rng(seed)
+    dataframe = booking_chunk(rng, 0, rows)
+    missing = dataframe['location_office_use'].isna().to_numpy()
+    extra = np.flatnonzero(missing)[:6]
+    dataframe.loc[extra, 'location_description'] = ['Reading near Bristol', 'S\'LAND and Glasgow', 'Bay 12', np.nan,
+                                                    'durham\nexeter', 'Frome']
+    dataframe['booking_billed_start'] = pd.to_datetime(dataframe['booking_billed_start'])
+    dataframe.loc[rng.random(rows) < 0.01, 'booking_billed_start'] = pd.NaT
+    dataframe['booking_billed_start_dayofweek'] = dataframe['booking_billed_start'].dt.dayofweek
+    dataframe['booking_created_at_hour'] = pd.to_datetime(dataframe['booking_created_at']).dt.hour
+    dataframe['booking_mileage'] = dataframe['booking_mileage'].astype(float)
+    return dataframe
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main(rows=1000000):
+    dataframe = make_frame(rows)
+    peak_hours = [8, 9, 16, 17, 18]
+    lower_bound, upper_bound = get_outlier_bounds(dataframe[OUTLIER_COLUMNS].quantile(0.25), dataframe[OUTLIER_COLUMNS].quantile(0.75))
+    results = []
+
+    expected, before = timed(reference_office_codes, dataframe[['location_office_use', 'location_description']].copy())
+    actual, after = timed(resolve_office_codes, dataframe['location_office_use'], dataframe['location_description'])
+    pd.testing.assert_series_equal(actual, expected, check_names=False)
+    results.append(('Step 7 location codes', before, after))
+
+    dates = dataframe['booking_billed_start']
+    (expected_season, expected_holiday), before = timed(lambda: (dates.apply(reference_season), dates.apply(reference_holiday)))
+    (season, is_holiday), after = timed(calendar_features, dates)
+    assert np.array_equal(season, expected_season.to_numpy()) and np.array_equal(is_holiday, expected_holiday.to_numpy())
+    results.append(('Steps 15-16 season, holiday', before, after))
+
+    dayofweek, hour = dataframe['booking_billed_start_dayofweek'], dataframe['booking_created_at_hour']
+    expected, before = timed(lambda: (dayofweek.apply(lambda x: 1 if x in [5, 6] else 0), hour.apply(lambda x: 1 if x in peak_hours else 0)))
+    actual, after = timed(lambda: (flag(dayofweek, WEEKEND_DAYS), flag(hour, peak_hours)))
+    assert all(np.array_equal(a, e.to_numpy()) for a, e in zip(actual, expected))
+    results.append(('Step 12 weekend, peak hour', before, after))
+
+    expected, before = timed(reference_cap, dataframe[OUTLIER_COLUMNS].copy(), lower_bound, upper_bound)
+    actual, after = timed(clip_columns, dataframe[OUTLIER_COLUMNS].copy(), OUTLIER_COLUMNS, lower_bound, upper_bound)
+    pd.testing.assert_frame_equal(actual, expected, check_exact=True)
+    results.append(('Step 17 outlier capping', before, after))
+
+    print(f'{rows} rows, same values as the row-wise steps')
+    for step, before, after in results:
+        print(f'{step:30s} {before * 1000:9.1f}ms -> {after * 1000:7.1f}ms ({before / after:.0f}x)')
+    total_before, total_after = sum(result[1] for result in results), sum(result[2] for result in results)
+    print(f"{'total':30s} {total_before * 1000:9.1f}ms -> {total_after * 1000:7.1f}ms ({total_before / total_after:.0f}x)")
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,75 @@
+'''Benchmark the cold start of the Flask app: import time, first page and time until the models are ready
+
+python -m bench.bench_import [--output startup.json]
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Run in a fresh interpreter for every startup mode
+STARTUP_SCRIPT = '''
+import time, json
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+client = app.app.test_client()
+client.get('/')
+first_page = time.perf_counter()
+while client.get('/api/v1/ready').status_code != 200:
+    if app.startup_error:
+        break
+    if app.STARTUP == 'lazy':
+        app.get_services()
+    time.sleep(0.01)
+ready = time.perf_counter()
+print(json.dumps({'import': imported - start, 'first_page': first_page - start, 'ready': ready - start}))
+'''
+
+
+def import_times():
+    '''seconds of cumulative import time of app and self import time of every module from python -X importtime'''
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                            capture_output=True, text=True).stderr
+    total = 0
+    modules = dict()
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = int(self_time) / 1e6
+        if name.strip() == 'app':
+            total = int(cumulative) / 1e6
+    return total, modules
+
+
+def startup(mode):
+    '''seconds to import app, serve the first page and become ready in a startup mode'''
+    output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], capture_output=True, text=True,
+                            env={**os.environ, 'PRICING_STARTUP': mode}).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(output=None):
+    total, modules = import_times()
+    slowest = dict(sorted(modules.items(), key=lambda item: -item[1])[:10])
+    print(f'import app: {total:.3f}s, slowest modules:')
+    for name, seconds in slowest.items():
+        print(f'  {name:30s} {seconds:.3f}s')
+
+    results = {'import_time': total, 'slowest_modules': slowest}
+    for mode in ['eager', 'background', 'lazy']:
+        results[mode] = startup(mode)
+        print(f"{mode:10s} import {results[mode]['import']:.3f}s | first page {results[mode]['first_page']:.3f}s"
+              f" | ready {results[mode]['ready']:.3f}s")
+
+    if output:
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cold start of the Flask app')
+    parser.add_argument('--output', default=None, help='JSON file of the results')
+    main(parser.parse_args().output)
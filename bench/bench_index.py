@@ -0,0 +1,79 @@
+'''Load test of the GET / page: the manifest rendered from memory against reading transformed_dataset.csv per request
+
+python -m bench.bench_index [requests] [threads]
+'''
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from threading import Thread
+import numpy as np
+import pandas as pd
+from werkzeug.serving import make_server, WSGIRequestHandler
+import app
+
+
+class QuietHandler(WSGIRequestHandler):
+    # keep-alive connections, no access log
+    protocol_version = 'HTTP/1.1'
+
+    def log_request(self, *args):
+        pass
+
+
+def previous_locations():
+    '''locations as GET / computed them before the manifest'''
+    df = pd.read_csv(app.DATA_PATH + 'transformed_dataset.csv')
+    locations = np.sort(df['location'].unique()).tolist()
+    return [location for location in locations if location not in app.INACTIVE_LOCATIONS]
+
+
+def load_test(port, requests, threads):
+    '''requests/s and p99 latency of GET / over HTTP, one keep-alive connection per thread'''
+    def worker(count):
+        connection = HTTPConnection('127.0.0.1', port)
+        latencies = []
+        for i in range(count):
+            start = time.perf_counter()
+            connection.request('GET', '/')
+            response = connection.getresponse()
+            response.read()
+            assert response.status == 200
+            latencies.append(time.perf_counter() - start)
+        connection.close()
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        latencies = np.concatenate(list(executor.map(worker, [requests // threads] * threads)))
+    return len(latencies) / (time.perf_counter() - start), np.percentile(latencies, 99)
+
+
+def main(requests=5000, threads=4):
+    client = app.app.test_client()
+    assert [location for location, display_name in app.load_locations()] == previous_locations()
+
+    # Rendering in process, without the HTTP server
+    start = time.perf_counter()
+    for i in range(requests):
+        client.get('/')
+    print(f'manifest, in process: {requests / (time.perf_counter() - start):.0f} requests/s')
+
+    count = max(1, requests // 100)
+    start = time.perf_counter()
+    for i in range(count):
+        # same request handling plus the CSV scan it replaced
+        previous_locations()
+        client.get('/')
+    print(f'csv scan, in process: {count / (time.perf_counter() - start):.1f} requests/s')
+
+    # Threaded HTTP server as app.run(threaded=True)
+    server = make_server('127.0.0.1', 0, app.app, threaded=True, request_handler=QuietHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    rate, p99 = load_test(server.server_port, requests, threads)
+    print(f'manifest, HTTP, {threads} connections: {rate:.0f} requests/s, p99 {p99 * 1000:.2f}ms')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,90 @@
+'''Benchmark the live demand counters of utils/live_demand.py: event ingestion, index rebuild and lookup
+
+python -m bench.bench_live_demand [events]   (default 1000000 synthetic booking created events)
+Counters that never decay are first checked to give the DemandIndex of the same bookings counted in history.
+'''
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from bench.bench_demand import make_history
+from utils.demand import DemandIndex
+from utils.live_demand import TIME_ZONE, LiveDemand, parse_event
+
+START = 1717200000
+
+
+def make_events(rows, seed=0):
+    '''JSON lines of the bookings of make_history created in their UK hour, half of them with ISO dates'''
+    df = make_history(rows, seed)
+    rng = np.random.default_rng(seed)
+    days = np.cumsum(rng.integers(0, 2, rows)) // 1000
+    seconds = days * 86400 + df['booking_created_at_hour'].to_numpy() * 3600 + rng.integers(0, 3600, rows)
+    created = pd.to_datetime(START, unit='s') + pd.to_timedelta(seconds, unit='s')
+    # the hour skipped by the clocks going forward is counted in the next one
+    timestamps = created.tz_localize(TIME_ZONE, ambiguous=False, nonexistent='shift_forward').asi8 // 10 ** 9
+    lines = []
+    for i, (location, created_at, timestamp) in enumerate(zip(df['location'].tolist(), created.strftime('%Y-%m-%dT%H:%M:%S'),
+                                                              timestamps.tolist())):
+        if i % 2:
+            lines.append(json.dumps({'location': location, 'timestamp': timestamp}).encode() + b'\n')
+        else:
+            lines.append(json.dumps({'location': location, 'created_at': created_at}).encode() + b'\n')
+    return df, lines
+
+
+def main(rows=1000000):
+    df, lines = make_events(rows)
+
+    live = LiveDemand(half_life=math.inf)
+    for line in lines[:100000]:
+        assert live.add_event(line)
+    expected = DemandIndex.from_history(df[:100000])
+    actual = live.index()
+    for name in ['locations', 'peak', 'factor', 'off_peak_factor']:
+        assert np.array_equal(getattr(actual, name), getattr(expected, name)), name
+
+    live = LiveDemand()
+    start = time.perf_counter()
+    for line in lines:
+        live.add_event(line)
+    ingest = time.perf_counter() - start
+
+    events = [parse_event(line) for line in lines]
+    live = LiveDemand()
+    add = live.add
+    start = time.perf_counter()
+    for location, timestamp, hour in events:
+        add(location, timestamp, hour)
+    count = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = live.index()
+    build = time.perf_counter() - start
+
+    path = os.path.join(tempfile.mkdtemp(prefix='pricing_bench_'), 'live_demand_index.npz')
+    start = time.perf_counter()
+    index.save(path)
+    index = DemandIndex.load(path)
+    publish = time.perf_counter() - start
+    os.remove(path)
+
+    hours = np.tile(np.arange(24), 1000)
+    locations = index.locations.tolist()
+    start = time.perf_counter()
+    for i, hour in enumerate(hours.tolist()):
+        index.lookup(locations[i % len(locations)], hour)
+    lookup = time.perf_counter() - start
+
+    print(f'{rows} events, counters without decay give the historical DemandIndex')
+    print(f'parse and count: {rows / ingest:,.0f} events/s | count only: {rows / count:,.0f} events/s')
+    print(f'index of {len(locations)} locations: build {build * 1000:.1f}ms | save and load {publish * 1000:.1f}ms')
+    print(f'lookup: {lookup / len(hours) * 1e6:.1f}us per (location, hour)')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,102 @@
+'''Load test of POST / against serve.py: throughput, p50/p99 latency and rejected requests per concurrency level
+
+python -m bench.bench_load [--processes N] [--requests 400] [--concurrency 1 4 16 64] [--duplicates 0.5]
+Every request prices a new (location, hour) so the response cache is bypassed, except the duplicates which ask for
+the hour of a request that is still running and are coalesced with it.
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from urllib.parse import urlencode
+import numpy as np
+
+LOCATIONS = ['Newcastle', 'Glasgow', 'Oxford', 'Bristol', 'Edinburgh', 'Reading']
+
+
+def request(port, method, path, body=None):
+    connection = HTTPConnection('127.0.0.1', port, timeout=120)
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'} if body else {}
+    connection.request(method, path, body=body, headers=headers)
+    response = connection.getresponse()
+    data = response.read()
+    connection.close()
+    return response.status, data
+
+
+def start_server(processes):
+    '''serve.py on a free port, returns the process and the port once the models are ready'''
+    server = subprocess.Popen([sys.executable, 'serve.py', '--port', '0', '--processes', str(processes)],
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    port = int(server.stdout.readline().split(':')[-1].split()[0])
+    while True:
+        try:
+            # every process has to be ready, each answers some of the probes
+            if all(request(port, 'GET', '/api/v1/ready')[0] == 200 for i in range(4 * processes)):
+                return server, port
+        except OSError:
+            pass
+        time.sleep(0.2)
+
+
+def load(port, requests, concurrency, duplicates, offset):
+    '''requests/s, p50 and p99 latency and statuses of requests POSTed by concurrency threads'''
+    rng = np.random.default_rng(offset)
+    hours = offset + np.arange(requests) / requests
+    # duplicates repeat the hour of the previous request, which is usually still being priced
+    repeat = rng.random(requests) < duplicates
+    hours[1:][repeat[1:]] = hours[:-1][repeat[1:]]
+    hours = np.maximum.accumulate(hours)
+    bodies = [urlencode({'location': LOCATIONS[int(hour * 7919) % len(LOCATIONS)], 'hour_of_the_day': f'{hour:.6f}'})
+              for hour in hours]
+
+    def post(body):
+        start = time.perf_counter()
+        status, data = request(port, 'POST', '/', body)
+        return status, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(post, bodies))
+    elapsed = time.perf_counter() - start
+    statuses = [status for status, latency in results]
+    latencies = [latency for status, latency in results if status == 200]
+    return {'concurrency': concurrency, 'requests_per_second': len(results) / elapsed,
+            'ok_per_second': statuses.count(200) / elapsed,
+            'p50_ms': float(np.percentile(latencies, 50) * 1000) if latencies else None,
+            'p99_ms': float(np.percentile(latencies, 99) * 1000) if latencies else None,
+            'ok': statuses.count(200), 'rejected': statuses.count(503), 'timed_out': statuses.count(504)}
+
+
+def main(processes, requests, concurrency_levels, duplicates, output=None):
+    server, port = start_server(processes)
+    try:
+        results = []
+        for i, concurrency in enumerate(concurrency_levels):
+            result = load(port, requests, concurrency, duplicates, offset=i % 24)
+            results.append(result)
+            print(f"{concurrency:4d} clients: {result['ok_per_second']:7.1f} priced/s | "
+                  f"p50 {result['p50_ms']:8.1f}ms | p99 {result['p99_ms']:8.1f}ms | "
+                  f"{result['rejected']} rejected, {result['timed_out']} timed out")
+        print('pool of one process:', json.loads(request(port, 'GET', '/api/v1/pool/stats')[1]))
+    finally:
+        server.terminate()
+        server.wait()
+    if output:
+        with open(output, 'w') as file:
+            json.dump({'processes': processes, 'results': results}, file, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test of POST / against serve.py')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--duplicates', type=float, default=0.5, help='share of requests repeating a running one')
+    parser.add_argument('--output', default=None, help='JSON file of the results')
+    args = parser.parse_args()
+    main(args.processes, args.requests, args.concurrency, args.duplicates, args.output)
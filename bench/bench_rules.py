@@ -0,0 +1,60 @@
+'''Benchmark the row-wise adjust_prices against the vectorised apply_rules
+
+python -m bench.bench_rules [rows] [row-wise sample rows]
+'''
+import sys
+import time
+import numpy as np
+import pandas as pd
+from utils.model import CATEGORIES, adjust_prices
+from utils.rules import apply_rules
+
+
+def make_predictions(rows, seed=0):
+    '''random adjusted rates and revenues of every location and vehicle type'''
+    rng = np.random.default_rng(seed)
+    hourly_rate = np.round(rng.uniform(5, 12, rows), 2)
+    daily_rate = np.round(rng.uniform(40, 80, rows), 2)
+    return pd.DataFrame({
+        'vehicle_type': rng.choice(np.array(CATEGORIES['Vehicle Type'], dtype=object), rows),
+        'location': rng.choice(np.array(CATEGORIES['location'], dtype=object), rows),
+        'hourly_rate': hourly_rate,
+        'daily_rate': daily_rate,
+        'adjusted_hourly': np.round(hourly_rate * rng.uniform(0.5, 2.5, rows), 2),
+        'adjusted_daily': np.round(daily_rate * rng.uniform(0.5, 2.5, rows), 2),
+        'adjusted_revenue': np.round(rng.uniform(0, 300, rows), 2),
+        'actual_revenue': np.where(rng.random(rows) < 0.01, np.nan, np.round(rng.uniform(0, 300, rows), 2)),
+    })
+
+
+def make_averages(seed=0):
+    rng = np.random.default_rng(seed)
+    index = pd.MultiIndex.from_product([CATEGORIES['location'], CATEGORIES['Vehicle Type']], names=['location', 'Vehicle Type'])
+    return pd.DataFrame({'hourly_rate': rng.uniform(5, 12, len(index)),
+                         'daily_rate': rng.uniform(40, 80, len(index))}, index=index).reset_index()
+
+
+def main(rows=1000000, sample=5000):
+    predictions_df = make_predictions(rows)
+    averages = make_averages()
+
+    start = time.perf_counter()
+    result = apply_rules(predictions_df.copy(), averages)
+    vectorised = time.perf_counter() - start
+
+    # Row-wise path on a sample, averages filtered by location as get_average_rates does
+    sample_df = predictions_df.iloc[:sample]
+    start = time.perf_counter()
+    expected = sample_df.apply(lambda row: adjust_prices(row, averages[averages['location'] == row['location']]), axis=1)
+    row_wise = (time.perf_counter() - start) / sample * rows
+
+    for column in ['final_hourly_rate', 'final_daily_rate']:
+        np.testing.assert_array_equal(result[column].to_numpy()[:sample], expected[column].to_numpy(dtype=float))
+
+    print(f'rows: {rows}')
+    print(f'adjust_prices row by row: {row_wise:.1f}s (extrapolated from {sample} rows)')
+    print(f'apply_rules: {vectorised:.3f}s ({row_wise / vectorised:.0f}x faster)')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,61 @@
+'''Benchmark memory and groupby time of the booking frame with and without apply_schema
+
+python -m bench.bench_schema [rows]
+'''
+import sys
+import time
+import numpy as np
+import pandas as pd
+from utils.model import CATEGORIES, SMALL_INTEGERS, FLAGS, apply_schema
+
+
+def make_bookings(rows, seed=0):
+    '''random bookings with the object and int64 columns preprocess_data used to return'''
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({column: rng.choice(np.array(categories, dtype=object), rows)
+                       for column, categories in CATEGORIES.items()})
+    for column, dtype in SMALL_INTEGERS.items():
+        high = 24 if column.endswith('hour') else 7 if column.endswith('dayofweek') else 13 if column.endswith('month') \
+            else 2025
+        low = 2019 if column.endswith('year') else 0
+        df[column] = rng.integers(low, high, rows).astype('int64')
+    for column in FLAGS:
+        df[column] = rng.integers(0, 2, rows).astype('int64')
+    df['hourly_rate'] = rng.uniform(5, 15, rows)
+    df['daily_rate'] = rng.uniform(40, 80, rows)
+    return df
+
+
+def time_groupbys(df, observed):
+    kwargs = {'observed': True} if observed else {}
+    start = time.perf_counter()
+    counts = df.groupby(['location', 'booking_created_at_hour'], **kwargs).size()
+    averages = df.groupby(['location', 'Vehicle Type'], **kwargs).agg(
+        average_hourly_rate=('hourly_rate', 'mean'), average_daily_rate=('daily_rate', 'mean'))
+    return time.perf_counter() - start, counts, averages
+
+
+def main(rows=1000000):
+    df = make_bookings(rows)
+    compact = apply_schema(df.copy())
+
+    before = df.memory_usage(deep=True).sum()
+    after = compact.memory_usage(deep=True).sum()
+    time_before, counts_before, averages_before = time_groupbys(df, observed=False)
+    time_after, counts_after, averages_after = time_groupbys(compact, observed=True)
+
+    # same groups and values, categoricals group in category order instead of sorted order
+    for before_result, after_result in [(counts_before, counts_after), (averages_before, averages_after)]:
+        after_result.index = pd.MultiIndex.from_arrays(
+            [level.astype(before_result.index.levels[i].dtype) for i, level in enumerate(
+                [after_result.index.get_level_values(i) for i in range(after_result.index.nlevels)])])
+        pd.testing.assert_frame_equal(pd.DataFrame(before_result), pd.DataFrame(after_result.sort_index()),
+                                      check_names=False)
+
+    print(f'rows: {rows}')
+    print(f'memory: {before / 2 ** 20:.1f}MB -> {after / 2 ** 20:.1f}MB ({before / after:.1f}x smaller)')
+    print(f'groupbys: {time_before:.3f}s -> {time_after:.3f}s ({time_before / time_after:.1f}x faster)')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,80 @@
+'''Benchmark single row latency of model.predict against the serving engine backends, and batching across threads
+
+python -m bench.bench_serving [rows] [threads]
+(the onnx backend needs python -m utils.serving first, onnx and treelite need their optional packages)
+'''
+import sys
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from utils.registry import get_registry, manifest_models, MODEL_PATH
+from utils.serving import ServingEngine, make_predictor, scale_features
+
+
+def make_rows(scaler, rows, seed=0):
+    '''random feature rows in the range the models were trained on'''
+    rng = np.random.default_rng(seed)
+    columns = [f'f{i}' for i in range(47)] if scaler is None else scaler.feature_names_in_
+    low, high = (0, 1) if scaler is None else (scaler.data_min_, scaler.data_max_)
+    return pd.DataFrame(rng.uniform(low, high, (rows, 47)), columns=columns)
+
+
+def latency(predict, X, repeat=50):
+    '''median seconds of one single row call'''
+    times = []
+    for i in range(repeat):
+        row = X[i % len(X):i % len(X) + 1]
+        start = time.perf_counter()
+        predict(row)
+        times.append(time.perf_counter() - start)
+    return np.median(times)
+
+
+def main(rows=200, threads=8):
+    # the reference predict calls get arrays without feature names
+    warnings.filterwarnings('ignore')
+    registry = get_registry().load(warm_up=False)
+    for vehicle, entry in manifest_models().items():
+        model_hourly, model_daily, scaler = registry.get_models(vehicle)
+        X = make_rows(scaler, rows)
+        X_scaled = scaler.transform(X) if scaler is not None else X.to_numpy()
+        np.testing.assert_array_equal(scale_features(scaler, X), X_scaled) if scaler is not None else None
+
+        for model, target in zip([model_hourly, model_daily], ['hourly', 'daily']):
+            family, path = entry[target]['family'], MODEL_PATH + entry[target]['file']
+            if family == 'nn':
+                def reference(X, model=model):
+                    return np.ravel(model.predict(X, verbose=0))
+            else:
+                reference = model.predict
+            expected = reference(X_scaled)
+            line = f'{vehicle:9s}{target:7s}{family:4s} predict {latency(reference, X_scaled) * 1000:7.3f}ms'
+            for backend in ['native', 'onnx', 'treelite']:
+                predictor = make_predictor(model, path, backend)
+                if backend != 'native' and type(predictor).__name__ in ['KerasPredictor', 'XGBPredictor', 'TreePredictor']:
+                    continue
+                result = predictor.predict(X_scaled)
+                predictor.predict(X_scaled[:1])
+                # rates are rounded to 2 decimals by predict_rates_batch
+                same = np.mean(np.round(result, 2) == np.round(expected, 2))
+                np.testing.assert_allclose(result, expected, rtol=1e-4, atol=1e-3)
+                line += f' | {backend} {latency(predictor.predict, X_scaled) * 1000:7.3f}ms ({same:.0%} equal)'
+            print(line)
+
+    # Single row requests of many threads, one model call each or merged by the batching predictor
+    X = make_rows(registry.get_models('City')[2], rows)
+    for batch_wait in [0, 2]:
+        engine = ServingEngine(get_registry().get_engine().predictors, batch_wait=batch_wait)
+        engine.predict('City', X[:1])
+        start = time.perf_counter()
+        with ThreadPoolExecutor(threads) as executor:
+            results = list(executor.map(lambda i: engine.predict('City', X[i:i + 1])[0][0], range(rows)))
+        elapsed = time.perf_counter() - start
+        np.testing.assert_allclose(results, engine.predict('City', X)[0], rtol=1e-6)
+        print(f'City, {threads} threads, batch wait {batch_wait}ms: {rows / elapsed:.0f} rows/s')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
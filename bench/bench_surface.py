@@ -0,0 +1,41 @@
+'''Benchmark a price surface lookup against computing the response with price_location
+
+python -m bench.bench_surface [location] [hour]   (build the surface first with python -m utils.surface)
+'''
+import json
+import sys
+import time
+from utils.cache import ResponseCache
+from utils.pricing import price_location
+from utils.registry import get_registry
+from utils.surface import SurfaceReader
+
+
+def main(location='Newcastle', hour_of_the_day=17):
+    get_registry().load()
+    reader = SurfaceReader()
+    versions = ResponseCache().versions()
+    response = reader.lookup(location, hour_of_the_day, versions)
+    if response is None:
+        print('Error: no current surface for this location and hour, run python -m utils.surface')
+        return
+    expected = price_location(location, hour_of_the_day)
+    assert json.dumps(response, sort_keys=True) == json.dumps(expected, sort_keys=True)
+
+    repeat = 20
+    start = time.perf_counter()
+    for i in range(repeat):
+        price_location(location, hour_of_the_day)
+    computed = (time.perf_counter() - start) / repeat
+
+    repeat = 100000
+    start = time.perf_counter()
+    for i in range(repeat):
+        reader.lookup(location, hour_of_the_day, versions)
+    looked_up = (time.perf_counter() - start) / repeat
+    print(f'price_location {computed * 1000:.2f}ms | surface lookup {looked_up * 1e6:.1f}us '
+          f'({computed / looked_up:.0f}x faster, same response)')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else 'Newcastle', float(sys.argv[2]) if len(sys.argv) > 2 else 17)
@@ -0,0 +1,28 @@
+'''Benchmark the policy sweep with one worker against a process pool, on the built feature store
+
+python -m utils.feature_store && python -m bench.bench_sweep [workers]
+'''
+import sys
+import time
+import pandas as pd
+from utils.sweep import sweep, policy_grid
+
+
+def main(workers=4):
+    policies = policy_grid([0, 0.5, 1], [30, 50], [5, 10])
+
+    start = time.perf_counter()
+    serial = sweep(policies, 17.0, max_workers=1)
+    serial_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    parallel = sweep(policies, 17.0, max_workers=workers)
+    parallel_time = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(serial, parallel)
+    print(f'locations x policies: {serial["location"].nunique()} x {len(policies)}')
+    print(f'1 worker: {serial_time:.2f}s, {workers} workers: {parallel_time:.2f}s ({serial_time / parallel_time:.1f}x)')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,49 @@
+'''Benchmark the row-wise apply_rates against the vectorised resolve_rates
+
+python -m bench.bench_tariffs [rows]   (tests/test_tariffs.py checks that both give the same rates)
+'''
+import sys
+import time
+import numpy as np
+import pandas as pd
+from utils.model import apply_rates
+from utils.tariffs import resolve_rates
+
+
+def make_bookings(rows, seed=0):
+    '''random bookings covering every tariff rule, including missing dates and sizes'''
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp('2019-01-01')
+    seconds = rng.integers(0, int((pd.Timestamp('2026-12-31') - start).total_seconds()), rows)
+    booking_billed_start = pd.Series(start + pd.to_timedelta(seconds, unit='s'))
+    booking_billed_start[rng.random(rows) < 0.01] = pd.NaT
+    locations = ['Glasgow', 'Tunbridge Wells', 'Saffron Waldron', 'Saffron Walden', 'Eastbourne', 'Salisbury', 'Shropshire',
+                 'Newcastle', 'Canterbury', 'Plymouth', 'Bristol', 'Oxford', None]
+    return pd.DataFrame({
+        'booking_billed_start': booking_billed_start,
+        'location': rng.choice(np.array(locations, dtype=object), rows),
+        'Vehicle Type': rng.choice(np.array(['City', 'Everyday', 'Family', 'Van', '7 Seater', 'Hydrogen', None], dtype=object), rows),
+        'Fuel Type': rng.choice(np.array(['Petrol', 'EV', 'Hydrogen'], dtype=object), rows),
+        'Size Category': rng.choice(np.array(['Small', 'Medium', 'Large', 'Family', 'Van', '7 Seater', None], dtype=object), rows),
+    })
+
+
+def main(rows=20000):
+    dataframe = make_bookings(rows)
+
+    start = time.perf_counter()
+    dataframe.apply(apply_rates, axis=1)
+    row_wise = time.perf_counter() - start
+
+    start = time.perf_counter()
+    resolve_rates(dataframe)
+    vectorised = time.perf_counter() - start
+
+    print(f'rows: {rows}')
+    print(f'apply_rates (row-wise): {row_wise:.3f}s')
+    print(f'resolve_rates (vectorised): {vectorised:.3f}s')
+    print(f'speedup: {row_wise / vectorised:.1f}x')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,138 @@
+'''Synthetic bookings and tariffs shaped like the private 2024 Bookings.csv and Diff Tariffs.csv
+
+python -m bench.generate_data --rows 1000000 [--output ../data/] [--seed 0]
+Bookings are written in chunks, so 50M rows only need the memory of one chunk.
+'''
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from utils.model import LOCATION_MAPPING
+from utils.tariffs import TARIFF_RATES
+
+# Tariffs of the PAYG fleet plus one contract tariff and one 'Various' tariff that preprocess_data drops
+TARIFFS = pd.DataFrame([
+    ('City Petrol', 'PAYG', 'Petrol', 'Small', 'City', 0.22),
+    ('City EV', 'PAYG', 'EV', 'Small', 'City', 0.10),
+    ('Everyday Petrol', 'PAYG', 'Petrol', 'Medium', 'Everyday', 0.20),
+    ('Everyday EV', 'PAYG', 'EV', 'Medium', 'Everyday', 0.12),
+    ('Everyday Hydrogen', 'PAYG', 'Hydrogen', 'Large', 'Everyday', 0.02),
+    ('Family Petrol', 'PAYG', 'Petrol', 'Family', 'Family', 0.10),
+    ('Van Petrol', 'PAYG', 'Petrol', 'Van', 'Van', 0.08),
+    ('7 Seater Petrol', 'PAYG', 'Petrol', '7 Seater', '7 Seater', 0.06),
+    ('Various', 'PAYG', 'Petrol', 'Various', 'City', 0.02),
+    ('McCarthy & Stone EV', 'Contract', 'EV', 'Small', 'City', 0.08),
+], columns=['Tariff', 'PAYG or Contract', 'Petrol Or EV', 'Size Category', 'Vehicle Type', 'share'])
+
+# Booking creations by hour of the day: quiet nights, morning and evening peaks
+HOURLY_PROFILE = np.array([1, 0.6, 0.4, 0.3, 0.3, 0.5, 1.5, 3.5, 5, 4.5, 4, 4, 4.2, 4, 4, 4.3, 5, 5.5, 5, 4, 3, 2.5, 2, 1.5])
+
+# location_description of bookings without location_office_use, resolved by Step 7 of preprocess_data
+DESCRIPTIONS = ['Lower Maudlin Street', 'Glsgow Central', 'Nwcastle Quayside', 'Birmingham New St', 'Tunbridge Wells',
+                'Frome', 'Durham', 'Slaford Quays', "S'land Road", 'Reading Station']
+
+FIRST_CREATED = pd.Timestamp('2019-01-01')
+LAST_CREATED = pd.Timestamp('2024-06-30')
+
+
+def location_weights(codes):
+    '''Zipf like share of the bookings of every location, the big cities first'''
+    big = ['NCL', 'GLA', 'EDI', 'BRI', 'OXF', 'REA', 'BIR', 'LON', 'SAL', 'DDE']
+    ranks = np.array([big.index(code) if code in big else len(big) + i for i, code in enumerate(codes)])
+    weights = 1 / (ranks + 2.0)
+    return weights / weights.sum()
+
+
+def tariff_table():
+    '''Diff Tariffs.csv'''
+    return TARIFFS.drop(columns='share').assign(Notes='')
+
+
+def booking_chunk(rng, first_id, rows):
+    '''rows synthetic bookings with ids from first_id'''
+    codes = np.array(sorted(LOCATION_MAPPING))
+    location_codes = rng.choice(codes, rows, p=location_weights(codes))
+    shares = TARIFFS['share'].to_numpy()
+    tariffs = rng.choice(len(TARIFFS), rows, p=shares / shares.sum())
+
+    # Creation time follows the hourly profile, bookings start a few hours to a few days later
+    days = rng.integers(0, (LAST_CREATED - FIRST_CREATED).days, rows)
+    hours = rng.choice(24, rows, p=HOURLY_PROFILE / HOURLY_PROFILE.sum())
+    created = FIRST_CREATED + pd.to_timedelta(days * 86400 + hours * 3600 + rng.integers(0, 3600, rows), unit='s')
+    start = created + pd.to_timedelta(np.round(rng.exponential(18, rows) * 4) * 900, unit='s')
+    # Mostly a few hours, some bookings over several days
+    duration = np.maximum(1, np.round(rng.lognormal(1.3, 0.9, rows))).astype(int)
+    end = start + pd.to_timedelta(duration, unit='h')
+
+    # Costs at the default rates of the vehicle type
+    rates = TARIFF_RATES[TARIFF_RATES['tariff'] == 'default'].set_index('key')
+    vehicle = TARIFFS['Vehicle Type'].to_numpy()[tariffs]
+    days_billed = duration // 24
+    hours_billed = (duration % 24).astype(float)
+    mileage = np.round(rng.gamma(2, 12, rows) * (1 + days_billed))
+    cost_time = hours_billed * rates.loc[vehicle, 'hourly_rate'].to_numpy() + days_billed * rates.loc[vehicle, 'daily_rate'].to_numpy()
+    cost_distance = mileage * rates.loc[vehicle, 'per_mile'].to_numpy()
+
+    office_use = pd.Series(np.char.add(location_codes.astype(str), '01'), dtype=object)
+    description = pd.Series(np.char.add('Bay ', location_codes.astype(str)), dtype=object)
+    missing = rng.random(rows) < 0.03
+    office_use[missing] = np.nan
+    description[missing] = rng.choice(DESCRIPTIONS, missing.sum())
+
+    booking_ids = np.arange(first_id, first_id + rows)
+    # 1% of the rows repeat an earlier booking of the chunk
+    duplicated = np.flatnonzero(rng.random(rows) < 0.01)
+    booking_ids[duplicated] = booking_ids[rng.integers(0, duplicated + 1)]
+
+    def dates(values):
+        return values.strftime('%Y-%m-%d %H:%M:%S')
+
+    return pd.DataFrame({
+        'account_id': rng.integers(1, 5000, rows),
+        'Contract': np.where(TARIFFS['PAYG or Contract'].to_numpy()[tariffs] == 'Contract', 'Contract', 'PAYG'),
+        'user_id': rng.integers(1, 20000, rows),
+        'booking_id': booking_ids,
+        'location_description': description,
+        'location_office_use': office_use,
+        'booking_tariff': TARIFFS['Tariff'].to_numpy()[tariffs],
+        'booking_start': dates(start),
+        'booking_end': dates(end),
+        'booking_actual_start': dates(start),
+        'booking_actual_end': dates(end),
+        'booking_billed_start': dates(start),
+        'booking_billed_end': dates(end),
+        'booking_created_at': dates(created),
+        'booking_cancelled_at': '',
+        'booking_duration': duration,
+        'booking_actual_duration': duration,
+        'booking_billed_duration': duration,
+        'booking_rates_24hours': days_billed,
+        'booking_rates_overnight': 0,
+        'booking_rates_hours': hours_billed,
+        'booking_mileage': mileage,
+        'booking_actual_cost_distance': np.round(cost_distance, 2),
+        'booking_actual_cost_time': np.round(cost_time, 2),
+        'booking_actual_cost_total': np.round(cost_time + cost_distance, 2),
+    })
+
+
+def generate(rows, output, bookings='2024 Bookings.csv', seed=0, chunksize=1000000):
+    '''write Diff Tariffs.csv and rows bookings to output'''
+    os.makedirs(output, exist_ok=True)
+    tariff_table().to_csv(os.path.join(output, 'Diff Tariffs.csv'), index=False)
+    rng = np.random.default_rng(seed)
+    path = os.path.join(output, bookings)
+    for first_id in range(0, rows, chunksize):
+        chunk = booking_chunk(rng, first_id, min(chunksize, rows - first_id))
+        chunk.to_csv(path, mode='w' if first_id == 0 else 'a', header=first_id == 0, index=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic bookings and tariffs CSV files')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--output', default='../data/')
+    parser.add_argument('--bookings', default='2024 Bookings.csv', help='file name of the bookings CSV')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunksize', type=int, default=1000000)
+    args = parser.parse_args()
+    generate(args.rows, args.output, args.bookings, args.seed, args.chunksize)
@@ -0,0 +1,198 @@
+'''Benchmark suite of the pricing pipeline on synthetic data: wall time and peak memory of every stage
+
+python -m bench.suite [--rows 100000] [--cases preprocess_data ...] [--output results.json]
+python -m bench.suite --baseline results.json [--threshold 1.25]   # exit status 1 on a slowdown, for CI
+Every case runs in its own process so its memory is not mixed with the others. The data is generated by
+bench/generate_data.py into a temporary directory unless --data points at existing CSV files.
+'''
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+CASES = ['preprocess_data', 'apply_rates', 'encode_features', 'predict_rates', 'demand_factor', 'calculate_profitability']
+
+
+def resident_memory():
+    '''bytes of resident memory of this process'''
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # peak instead of current outside Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PeakMemory:
+    '''highest resident memory above the memory at entry, sampled every few milliseconds'''
+
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.peak = 0
+
+    def __enter__(self):
+        self.start = resident_memory()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, resident_memory() - self.start)
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, resident_memory() - self.start)
+
+
+def setup(case, data_path):
+    '''(prepare, stage) of a case: prepare() returns the arguments of stage, only stage is timed'''
+    import pandas as pd
+    from utils import model
+    from utils.tariffs import resolve_rates
+    from utils.demand import DemandIndex
+    from utils.rules import apply_rules
+
+    bookings = pd.read_csv(os.path.join(data_path, '2024 Bookings.csv'))
+    tariff_df = pd.read_csv(os.path.join(data_path, 'Diff Tariffs.csv'))
+    if case == 'preprocess_data':
+        return lambda: (bookings.copy(), tariff_df.copy()), model.preprocess_data
+
+    df = model.preprocess_data(bookings, tariff_df)
+    del bookings
+    if case == 'apply_rates':
+        # Step 10 input, the vectorised resolve_rates replaced the row-wise apply_rates
+        sizes = tariff_df.set_index('Tariff')['Size Category']
+        frame = df.drop(columns=['hourly_rate', 'daily_rate', 'per_mile']).assign(
+            **{'Size Category': df['booking_tariff'].map(sizes)})
+        return lambda: (frame.copy(),), resolve_rates
+
+    df = model.transform_data(df)
+    if case == 'encode_features':
+        def encode(df):
+            scaled_df, df = model.encode_features(df)
+            return model.structure_dataframe(scaled_df), df
+        return lambda: (df.copy(),), encode
+
+    scaled_df, df = model.encode_features(df)
+    scaled_df = model.structure_dataframe(scaled_df)
+    locations = df['location'].astype(object).dropna().unique().tolist()
+    items = [(scaled_df[(df['location'] == location).to_numpy()], location) for location in locations]
+    if case == 'predict_rates':
+        model.get_registry().load()
+        return lambda: (items,), model.predict_rates_batch
+
+    if case == 'demand_factor':
+        index = DemandIndex.from_counts(model.booking_counts(df))
+
+        def demand_factors(df, index):
+            return [model.demand_factor(df, location, hour, index=index) for location in locations for hour in range(24)]
+        return lambda: (df, index), demand_factors
+
+    if case == 'calculate_profitability':
+        predictions = model.predict_rates_batch(items)
+        averages = df.groupby(['location', 'Vehicle Type'], observed=True)[['hourly_rate', 'daily_rate']].mean().reset_index()
+        adjusted = dict()
+        for location, predictions_df in predictions.items():
+            if not predictions_df.empty:
+                predictions_df = model.apply_dynamic_pricing_strategy(predictions_df, 1.1)
+                # the columns build_response hands to calculate_profitability
+                adjusted[location] = apply_rules(predictions_df, averages).rename(columns={
+                    'final_hourly_rate': 'adjusted_hourly_rate', 'final_daily_rate': 'adjusted_daily_rate'})
+
+        def profitability(df, adjusted):
+            return [model.calculate_profitability(df, location, predictions_df) for location, predictions_df in adjusted.items()]
+        return lambda: (df, adjusted), profitability
+
+    raise ValueError(f'Unknown benchmark case {case}')
+
+
+def run_case(case, data_path, repeat):
+    '''best wall time and highest memory increase of repeat runs of a case, in this process'''
+    prepare, stage = setup(case, data_path)
+    times = []
+    peak = 0
+    for i in range(repeat):
+        args = prepare()
+        with PeakMemory() as memory:
+            start = time.perf_counter()
+            stage(*args)
+            times.append(time.perf_counter() - start)
+        peak = max(peak, memory.peak)
+        del args
+    return {'case': case, 'seconds': min(times), 'peak_memory_mb': peak / 2 ** 20,
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def compare(results, baseline, threshold):
+    '''cases more than threshold times slower, or using more memory, than in the baseline'''
+    previous = {result['case']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get(result['case'])
+        if before is None:
+            continue
+        for metric in ['seconds', 'peak_memory_mb']:
+            # changes within a few milliseconds or megabytes are noise
+            if result[metric] > before[metric] * threshold and result[metric] - before[metric] > 0.005 + (metric != 'seconds'):
+                regressions.append(f"{result['case']} {metric}: {before[metric]:.3f} -> {result[metric]:.3f}")
+    return regressions
+
+
+def main(rows, cases, data_path=None, repeat=3, output=None, baseline=None, threshold=1.25):
+    generated = data_path is None
+    if generated:
+        from bench.generate_data import generate
+        data_path = tempfile.mkdtemp(prefix='pricing_bench_')
+        generate(rows, data_path)
+    try:
+        results = []
+        for case in cases:
+            process = subprocess.run([sys.executable, '-m', 'bench.suite', '--run-case', case, '--data', data_path,
+                                      '--repeat', str(repeat)], capture_output=True, text=True)
+            if process.returncode != 0:
+                print(f'Error running {case}: {process.stderr.strip().splitlines()[-1:]}')
+                continue
+            result = json.loads(process.stdout.strip().splitlines()[-1])
+            results.append(result)
+            print(f"{case:25s} {result['seconds'] * 1000:10.1f}ms {result['peak_memory_mb']:8.1f}MB peak "
+                  f"({result['max_rss_mb']:.0f}MB max RSS)")
+    finally:
+        if generated:
+            shutil.rmtree(data_path, ignore_errors=True)
+
+    if output:
+        with open(output, 'w') as file:
+            json.dump({'rows': rows, 'results': results}, file, indent=2)
+    if baseline:
+        with open(baseline) as file:
+            regressions = compare(results, json.load(file), threshold)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pricing pipeline on synthetic data')
+    parser.add_argument('--rows', type=int, default=100000, help='synthetic bookings, 10k to 50M')
+    parser.add_argument('--cases', nargs='+', default=CASES, choices=CASES)
+    parser.add_argument('--data', default=None, help='directory with 2024 Bookings.csv and Diff Tariffs.csv')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default=None, help='JSON file of the results')
+    parser.add_argument('--baseline', default=None, help='JSON results to compare with')
+    parser.add_argument('--threshold', type=float, default=1.25, help='slowdown ratio reported as a regression')
+    parser.add_argument('--run-case', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_case:
+        print(json.dumps(run_case(args.run_case, args.data, args.repeat)))
+    else:
+        sys.exit(main(args.rows, args.cases, args.data, args.repeat, args.output, args.baseline, args.threshold))
@@ -0,0 +1,87 @@
+'''Production server: several processes accepting on one socket, each a threaded WSGI server running app
+
+python serve.py --processes 4 --port 5000
+Pricing work of each process runs in its bounded worker pool (PRICING_WORKERS, PRICING_QUEUE_SIZE, see utils/workers.py),
+set PRICING_CACHE_PATH so the processes share cached responses.
+'''
+import argparse
+import os
+import signal
+import socket
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+
+class RequestHandler(WSGIRequestHandler):
+    # keep-alive connections
+    protocol_version = 'HTTP/1.1'
+
+
+class QuietRequestHandler(RequestHandler):
+    def log_request(self, *args):
+        pass
+
+
+def serve(sock, access_log=False):
+    '''serve app on the listening socket until the process is stopped'''
+    # app is imported in every process after the fork, TensorFlow must not be loaded before it
+    from app import app
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, app, threaded=True, fd=sock.fileno(),
+                         request_handler=RequestHandler if access_log else QuietRequestHandler)
+    server.serve_forever()
+
+
+def start_worker(sock, access_log):
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            serve(sock, access_log)
+        finally:
+            os._exit(1)
+    return pid
+
+
+def main(host='127.0.0.1', port=5000, processes=os.cpu_count() or 1, access_log=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+    print(f'Serving on http://{host}:{sock.getsockname()[1]} with {processes} processes', flush=True)
+    if processes == 1:
+        serve(sock, access_log)
+        return
+
+    workers = {start_worker(sock, access_log) for i in range(processes)}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        workers.discard(pid)
+        # processes that die are replaced
+        if not stopping:
+            print(f'Error: worker {pid} exited with status {status}, restarting', flush=True)
+            workers.add(start_worker(sock, access_log))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the pricing app with several processes')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--access-log', action='store_true')
+    args = parser.parse_args()
+    main(args.host, args.port, args.processes, args.access_log)
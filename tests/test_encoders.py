@@ -0,0 +1,71 @@
+'''LookupEncoder against the pickled category_encoders it is compiled from
+
+python -m pytest tests
+'''
+import json
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from utils.encoders import PICKLES, COMPILED_FILE, LookupEncoder, compile_encoders, check_equivalence, coverage_frame, \
+    reference_transform
+from utils.model import ENCODERS_PATH
+
+# unpickling imports category_encoders
+joblib = pytest.importorskip('joblib')
+pytest.importorskip('category_encoders')
+
+
+@pytest.fixture(scope='module')
+def pickled():
+    return [joblib.load(os.path.join(ENCODERS_PATH, name)) for name in PICKLES]
+
+
+@pytest.fixture(scope='module')
+def encoder(pickled):
+    return LookupEncoder(compile_encoders(*pickled))
+
+
+def rows_of(encoder, kind):
+    '''one row per known category, unknown value or missing value of every encoded column, the others at a known category'''
+    base = {column: categories[0] for column, numeric, categories, outputs, table in encoder.columns}
+    rows = []
+    for column, numeric, categories, outputs, table in encoder.columns:
+        if kind == 'known':
+            values = list(categories)
+        elif kind == 'unknown':
+            values = [-1.0] if numeric else ['Unknown']
+        else:
+            # the pickled encoders are given int64 flags, which cannot be missing
+            values = [] if numeric else [np.nan, None]
+        rows += [dict(base, **{column: value}) for value in values]
+    return pd.DataFrame(rows)
+
+
+@pytest.mark.parametrize('kind', ['known', 'unknown', 'missing'])
+def test_same_output_as_pickled_encoders(encoder, pickled, kind):
+    dataframe = rows_of(encoder, kind)
+    assert check_equivalence(encoder, *pickled, dataframe) == []
+
+
+@pytest.mark.parametrize('kind', ['known', 'unknown', 'missing'])
+def test_same_output_for_categorical_columns(encoder, pickled, kind):
+    # the feature store gives the text columns a categorical dtype
+    dataframe = rows_of(encoder, kind)
+    categorical = dataframe.copy()
+    for column, numeric, categories, outputs, table in encoder.columns:
+        if not numeric:
+            categorical[column] = categorical[column].astype('category')
+    pd.testing.assert_frame_equal(encoder.transform(categorical), reference_transform(*pickled, dataframe))
+
+
+def test_row(encoder, pickled):
+    column, numeric, categories, outputs, table = encoder.columns[0]
+    expected = reference_transform(*pickled, coverage_frame(encoder).iloc[:1])[outputs].to_numpy()[0]
+    assert np.array_equal(encoder.row(column, categories[0]), expected)
+    assert encoder.row(column, 'Unknown' if not numeric else -1.0) is None
+
+
+def test_compiled_file_is_up_to_date(encoder):
+    with open(os.path.join(ENCODERS_PATH, COMPILED_FILE)) as file:
+        assert json.load(file) == json.loads(json.dumps(encoder.spec))
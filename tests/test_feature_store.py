@@ -0,0 +1,82 @@
+'''Part files of the feature store partitions across chunked builds and incremental updates
+
+python -m pytest tests
+'''
+import os
+import pandas as pd
+import pytest
+from bench.generate_data import generate
+from utils import feature_store, ingest
+from utils.feature_store import MAX_PARTS, build_feature_store, update_feature_store, compact_parts, current_parts, \
+    load_location_data, partition_path
+
+ROWS = 20000
+UPDATES = 6
+
+
+@pytest.fixture
+def data_path(tmp_path, monkeypatch):
+    '''synthetic bookings, the first half of them created before the others, in DATA_PATH'''
+    path = str(tmp_path) + '/'
+    generate(ROWS, path, chunksize=ROWS)
+    bookings = pd.read_csv(path + '2024 Bookings.csv')
+    bookings = bookings.iloc[pd.to_datetime(bookings['booking_created_at'], errors='coerce').argsort(kind='stable')]
+    for update in range(UPDATES + 1):
+        rows = ROWS // 2 + update * ROWS // (2 * UPDATES)
+        bookings[:rows].to_csv(path + f'bookings_{update}.csv', index=False)
+    monkeypatch.setattr(feature_store, 'DATA_PATH', path)
+    monkeypatch.setattr(ingest, 'DATA_PATH', path)
+    return path
+
+
+def part_counts(store_path):
+    return {(name, kind): len(current_parts(os.path.join(store_path, name, kind)))
+            for name in os.listdir(store_path) if name.startswith('location=') for kind in ['history', 'scaled']}
+
+
+def test_updates_keep_parts_bounded(data_path):
+    store_path = data_path + 'feature_store/'
+    build_feature_store(['bookings_0.csv'], store_path)
+    for update in range(1, UPDATES + 1):
+        # small chunks add several parts to a location in every update
+        assert update_feature_store([f'bookings_{update}.csv'], store_path, chunksize=500) > 0
+        assert max(part_counts(store_path).values()) <= MAX_PARTS
+        for name in os.listdir(partition_path('Newcastle', store_path)):
+            assert len(os.listdir(os.path.join(partition_path('Newcastle', store_path), name))) <= MAX_PARTS
+
+    # the updated store holds the bookings of a build of all of them
+    full_path = data_path + 'full_store/'
+    build_feature_store([f'bookings_{UPDATES}.csv'], full_path)
+    for location in ['Newcastle', 'Glasgow']:
+        updated, full = load_location_data(location, store_path)[1], load_location_data(location, full_path)[1]
+        assert len(updated) == len(full)
+        assert updated['booking_billed_start'].sort_values().tolist() == full['booking_billed_start'].sort_values().tolist()
+
+
+def test_compaction_keeps_rows(data_path, monkeypatch):
+    store_path = data_path + 'feature_store/'
+    # the parts of every chunk, as a build before compaction left them
+    monkeypatch.setattr(feature_store, 'compact_parts', lambda *args, **kwargs: [])
+    build_feature_store([f'bookings_{UPDATES}.csv'], store_path, chunksize=1000)
+    assert max(part_counts(store_path).values()) > MAX_PARTS
+    before = {location: load_location_data(location, store_path) for location in ['Newcastle', 'Glasgow']}
+    assert compact_parts(store_path)
+    assert max(part_counts(store_path).values()) <= MAX_PARTS
+    assert part_counts(store_path)['location=Newcastle', 'history'] == 1
+    for location, (scaled_df, df) in before.items():
+        compacted_scaled_df, compacted_df = load_location_data(location, store_path)
+        pd.testing.assert_frame_equal(compacted_scaled_df, scaled_df)
+        pd.testing.assert_frame_equal(compacted_df, df)
+
+
+def test_interrupted_compaction(data_path):
+    store_path = data_path + 'feature_store/'
+    build_feature_store([f'bookings_{UPDATES}.csv'], store_path, chunksize=1000)
+    path = os.path.join(partition_path('Newcastle', store_path), 'history')
+    compact_parts(store_path, ['Newcastle'], max_parts=1)
+    df = load_location_data('Newcastle', store_path)[1]
+    # parts left next to the file that holds them, as by a compaction that stopped before removing them
+    (compacted,) = os.listdir(path)
+    first, last = feature_store.part_range(compacted)
+    pd.read_parquet(os.path.join(path, compacted))[:10].to_parquet(os.path.join(path, feature_store.part_filename(last)))
+    pd.testing.assert_frame_equal(load_location_data('Newcastle', store_path)[1], df)
@@ -0,0 +1,81 @@
+'''resolve_rates against the row-wise apply_rates it replaces
+
+python -m pytest tests
+'''
+import itertools
+import numpy as np
+import pandas as pd
+import pytest
+from utils.model import apply_rates
+from utils.tariffs import TARIFF_RULES, resolve_rates, resolve_tariffs
+from bench.bench_tariffs import make_bookings
+
+YEARS = range(2019, 2027)
+LOCATIONS = ['Glasgow', 'Tunbridge Wells', 'Saffron Waldron', 'Saffron Walden', 'Eastbourne', 'Salisbury', 'Shropshire',
+             'Newcastle', 'Canterbury', 'Plymouth', 'Bristol', None]
+VEHICLE_TYPES = ['City', 'Everyday', 'Family', 'Van', '7 Seater', 'Hydrogen', None]
+FUEL_TYPES = ['Petrol', 'EV', 'Hydrogen']
+SIZE_CATEGORIES = ['Small', 'Medium', 'Large', 'Family', 'Van', '7 Seater', None]
+RATE_COLUMNS = ['hourly_rate', 'daily_rate', 'per_mile']
+
+
+def bookings(rows):
+    '''bookings of (booking_billed_start, location, Vehicle Type, Fuel Type, Size Category) rows'''
+    dataframe = pd.DataFrame(rows, columns=['booking_billed_start', 'location', 'Vehicle Type', 'Fuel Type', 'Size Category'])
+    dataframe['booking_billed_start'] = pd.to_datetime(dataframe['booking_billed_start'])
+    return dataframe
+
+
+def assert_same_rates(dataframe):
+    result = resolve_rates(dataframe)
+    # apply_rates returns the dates as objects when they are all missing, only its rates are compared
+    expected = dataframe.apply(apply_rates, axis=1)[RATE_COLUMNS]
+    pd.testing.assert_frame_equal(result[RATE_COLUMNS], expected, check_exact=True)
+    pd.testing.assert_frame_equal(result.drop(columns=RATE_COLUMNS), dataframe)
+
+
+def month_grid():
+    '''every month of YEARS at every location, with a missing date per location'''
+    starts = [pd.Timestamp(year, month, 15, 10) for year in YEARS for month in range(1, 13)] + [pd.NaT]
+    return list(itertools.product(starts, LOCATIONS))
+
+
+def test_every_month_and_location():
+    rows = month_grid()
+    vehicles = list(itertools.product(VEHICLE_TYPES, FUEL_TYPES, SIZE_CATEGORIES))
+    # a different vehicle on every row, each of them many times over the grid
+    vehicles = [vehicles[i * 7 % len(vehicles)] for i in range(len(rows))]
+    assert_same_rates(bookings([(start, location, vehicle_type, fuel_type, size_category)
+                                for (start, location), (vehicle_type, fuel_type, size_category) in zip(rows, vehicles)]))
+
+
+def test_every_rule_is_covered():
+    starts, locations = zip(*month_grid())
+    starts = pd.to_datetime(pd.Series(starts))
+    tariffs = resolve_tariffs(starts.dt.year.to_numpy(dtype=float), starts.dt.month.to_numpy(dtype=float),
+                              pd.Series(locations))
+    assert set(tariffs) == set(TARIFF_RULES['tariff'])
+
+
+@pytest.mark.parametrize('start', [pd.Timestamp('2021-06-01'), pd.Timestamp('2022-01-31'), pd.Timestamp('2022-05-01'),
+                                   pd.Timestamp('2022-11-01'), pd.Timestamp('2023-08-31'), pd.Timestamp('2023-09-01'),
+                                   pd.Timestamp('2024-03-31'), pd.Timestamp('2024-04-01'), pd.Timestamp('2025-12-31'),
+                                   pd.NaT])
+def test_every_vehicle_at_tariff_boundaries(start):
+    assert_same_rates(bookings([(start, location, vehicle_type, fuel_type, size_category)
+                                for location in ['Glasgow', 'Tunbridge Wells', 'Saffron Waldron', 'Newcastle', None]
+                                for vehicle_type, fuel_type, size_category
+                                in itertools.product(VEHICLE_TYPES, FUEL_TYPES, SIZE_CATEGORIES)]))
+
+
+def test_saffron_waldron_spelling():
+    # apply_rates spells the location 'Saffron Waldron', the mapped 'Saffron Walden' gets the default rates
+    dataframe = bookings([('2024-05-01', 'Saffron Waldron', 'City', 'Petrol', 'Small'),
+                          ('2024-05-01', 'Saffron Walden', 'City', 'Petrol', 'Small')])
+    assert_same_rates(dataframe)
+    rates = resolve_rates(dataframe)[RATE_COLUMNS].to_numpy()
+    assert not np.array_equal(rates[0], rates[1])
+
+
+def test_random_bookings():
+    assert_same_rates(make_bookings(5000))
@@ -0,0 +1,106 @@
+import argparse
+import numpy as np
+import pandas as pd
+
+
+def rates_from_responses(results):
+    '''Adjusted rates table from (location, hour_of_the_day, response) of price_batch, errors are skipped'''
+    rows = []
+    for location, hour_of_the_day, response in results:
+        for vehicle_type, rates in response.get('predictions', {}).items():
+            rows.append({'location': location, 'hour': hour_of_the_day, 'vehicle_type': vehicle_type,
+                         'adjusted_hourly_rate': rates['adjusted_hourly_rate'],
+                         'adjusted_daily_rate': rates['adjusted_daily_rate']})
+    return pd.DataFrame(rows, columns=['location', 'hour', 'vehicle_type', 'adjusted_hourly_rate', 'adjusted_daily_rate'])
+
+
+def booking_revenue(df, rates):
+    '''Actual and adjusted revenue of every booking of df, the history is not modified
+
+    rates has location, vehicle_type, adjusted_hourly_rate and adjusted_daily_rate columns, and optionally an hour
+    column matched against booking_created_at_hour to replay hour dependent prices. Bookings without rates are dropped.
+    '''
+    keys = ['location', 'vehicle_type'] + (['hour'] if 'hour' in rates.columns else [])
+    booking_keys = [df['location'].astype(object), df['Vehicle Type'].astype(object)]
+    if 'hour' in rates.columns:
+        booking_keys.append(df['booking_created_at_hour'].astype(float))
+        rates = rates.assign(hour=rates['hour'].astype(float))
+    table = rates.drop_duplicates(keys).set_index(keys)
+
+    # Position of the rates of every booking, -1 without rates
+    positions = table.index.get_indexer(pd.MultiIndex.from_arrays(booking_keys))
+    has_rates = positions >= 0
+    positions = positions[has_rates]
+
+    def column(name):
+        return df[name].to_numpy()[has_rates]
+
+    # Inverse log transformation of the costs
+    actual_cost_distance = np.expm1(column('booking_actual_cost_distance'))
+    actual_revenue = np.expm1(column('booking_actual_cost_total'))
+
+    # Same rounding as apply_dynamic_pricing_strategy
+    adjusted_cost_time = np.round((column('booking_rates_hours') * table['adjusted_hourly_rate'].to_numpy()[positions]) +
+                                  (column('booking_rates_24hours') * table['adjusted_daily_rate'].to_numpy()[positions]), 2)
+    adjusted_revenue = np.round(adjusted_cost_time + actual_cost_distance, 2)
+
+    return pd.DataFrame({
+        'location': column('location'),
+        'vehicle_type': column('Vehicle Type'),
+        'booking_billed_start': column('booking_billed_start'),
+        'actual_revenue': actual_revenue,
+        'adjusted_revenue': adjusted_revenue,
+    }, index=df.index[has_rates])
+
+
+def select_window(df, start=None, end=None):
+    '''bookings with booking_billed_start in [start, end), None is unbounded'''
+    booking_billed_start = df['booking_billed_start']
+    mask = booking_billed_start.notna().to_numpy()
+    if start is not None:
+        mask &= (booking_billed_start >= pd.Timestamp(start)).to_numpy()
+    if end is not None:
+        mask &= (booking_billed_start < pd.Timestamp(end)).to_numpy()
+    return df[mask]
+
+
+def backtest(df, rates, start=None, end=None, freq='D'):
+    '''Replay adjusted versus actual revenue of every location and vehicle type over a date window
+
+    Returns actual_revenue, adjusted_revenue and profitability per location, vehicle_type and period of freq.
+    '''
+    revenue = booking_revenue(select_window(df, start, end), rates)
+    period = revenue['booking_billed_start'].dt.floor(freq).rename('date')
+    daily = revenue.groupby(['location', 'vehicle_type', period], observed=True)[['actual_revenue', 'adjusted_revenue']].sum()
+    daily['profitability'] = daily['adjusted_revenue'] - daily['actual_revenue']
+    return daily
+
+
+def last_month(df, location):
+    '''bookings of location in the month before its latest booking_billed_start'''
+    location_df = df[(df['location'] == location).to_numpy()]
+    latest_date = location_df['booking_billed_start'].max()
+    return select_window(location_df, start=latest_date - pd.DateOffset(months=1))
+
+
+def run_backtest(start=None, end=None, hours=range(24), freq='D'):
+    '''Price every stored location at every hour and replay the prices over the stored history'''
+    # imported here, utils.pricing depends on utils.model which uses this module
+    from utils.feature_store import load_history
+    from utils.pricing import price_batch
+
+    df = load_history()
+    locations = df['location'].astype(object).dropna().unique().tolist()
+    rates = rates_from_responses(price_batch([(location, hour) for location in locations for hour in hours]))
+    return backtest(df, rates, start=start, end=end, freq=freq)
+
+
+if __name__ == '__main__':
+    # python -m utils.backtest --start 2020-01-01 --end 2025-01-01 --output backtest.csv
+    parser = argparse.ArgumentParser(description='Replay adjusted versus actual revenue over the feature store history')
+    parser.add_argument('--start', default=None, help='first booking_billed_start date')
+    parser.add_argument('--end', default=None, help='booking_billed_start date to stop before')
+    parser.add_argument('--freq', default='D', help='period of the revenue series')
+    parser.add_argument('--output', default='backtest.csv')
+    args = parser.parse_args()
+    run_backtest(args.start, args.end, freq=args.freq).to_csv(args.output)
@@ -0,0 +1,209 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from utils.registry import MODEL_PATH, model_files
+from utils.feature_store import FEATURE_STORE_PATH, LIVE_DEMAND_PATH, STATE_FILE, live_demand_mtime
+
+
+def store_version(store_path):
+    '''version of the feature store, from its state file
+
+    Builds and updates write the state file last and always as a new file, so one stat tells a committed change
+    without walking the partitions.
+    '''
+    try:
+        stat = os.stat(os.path.join(store_path, STATE_FILE))
+    except OSError:
+        return ''
+    return f'{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}'
+
+
+def models_version(model_path):
+    '''version of the models the registry loads: the manifest, or the files of model_path without one'''
+    try:
+        files = model_files(model_path)
+    except OSError:
+        return ''
+    return hashlib.sha256(json.dumps(sorted(files.items())).encode()).hexdigest()[:16]
+
+
+def live_demand_version(live_path):
+    '''publish time of the live DemandIndex in use, empty while the historical one is served'''
+    mtime = live_demand_mtime(live_path)
+    return '' if mtime is None else f'{mtime:.0f}'
+
+
+def _remove(path):
+    '''remove a file another process may already have removed, 1 if this call did'''
+    try:
+        os.remove(path)
+        return 1
+    except OSError:
+        return 0
+
+
+class ResponseCache:
+    '''LRU and TTL cache of pricing responses keyed on location, hour and the data, model and live demand versions
+
+    With disk_path set, responses are also written there as JSON so several worker processes share them, in one
+    directory per version. At startup and then every prune_interval seconds of writes, the directories of other versions,
+    the files older than ttl and the oldest files beyond disk_maxsize are removed.
+    '''
+
+    def __init__(self, maxsize=1024, ttl=3600, disk_path=None, store_path=FEATURE_STORE_PATH, model_path=MODEL_PATH,
+                 live_path=LIVE_DEMAND_PATH, check_interval=1.0, disk_maxsize=65536, prune_interval=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self.disk_maxsize = disk_maxsize
+        self.prune_interval = prune_interval
+        self.store_path = store_path
+        self.model_path = model_path
+        self.live_path = live_path
+        self.check_interval = check_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._versions = None
+        self._checked = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._pruning = threading.Lock()
+        self._pruned = 0
+        if disk_path is not None:
+            os.makedirs(disk_path, exist_ok=True)
+            self.prune()
+
+    def versions(self):
+        '''data, model and live demand versions, rechecked at most every check_interval seconds'''
+        now = time.monotonic()
+        if self._versions is None or now - self._checked >= self.check_interval:
+            # the live DemandIndex is outside the data paths, its version is its publish time
+            versions = (store_version(self.store_path), models_version(self.model_path), live_demand_version(self.live_path))
+            with self._lock:
+                if versions != self._versions:
+                    # entries of older versions can never be hit again
+                    self._entries.clear()
+                self._versions = versions
+                self._checked = now
+        return self._versions
+
+    def key(self, location, hour_of_the_day):
+        data_version, model_version, demand_version = self.versions()
+        return f'{location}|{float(hour_of_the_day)}|{data_version}|{model_version}|{demand_version}'
+
+    def _disk_directory(self, versions):
+        '''directory of the disk entries of versions, the part of a key after location and hour'''
+        return os.path.join(self.disk_path, hashlib.sha256(versions.encode()).hexdigest()[:16])
+
+    def _disk_file(self, key):
+        return os.path.join(self._disk_directory(key.split('|', 2)[2]),
+                            hashlib.sha256(key.encode()).hexdigest() + '.json')
+
+    def prune(self):
+        '''remove the disk entries of other versions, older than ttl, and the oldest beyond disk_maxsize'''
+        if self.disk_path is None or not self._pruning.acquire(blocking=False):
+            return 0
+        try:
+            current = self._disk_directory('|'.join(self.versions()))
+            now = time.time()
+            removed = 0
+            entries = []
+            for filename in os.listdir(self.disk_path):
+                path = os.path.join(self.disk_path, filename)
+                if path == current:
+                    continue
+                # entries of older versions can never be hit again, nor can files of the flat layout
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    _remove(path)
+                removed += 1
+            if os.path.isdir(current):
+                for filename in os.listdir(current):
+                    path = os.path.join(current, filename)
+                    try:
+                        mtime = os.path.getmtime(path)
+                    except OSError:
+                        continue
+                    if now - mtime >= self.ttl:
+                        removed += _remove(path)
+                    elif not filename.endswith('.tmp'):
+                        entries.append((mtime, path))
+            entries.sort()
+            for mtime, path in entries[:max(len(entries) - self.disk_maxsize, 0)]:
+                removed += _remove(path)
+            self._pruned = time.monotonic()
+            return removed
+        finally:
+            self._pruning.release()
+
+    def get(self, location, hour_of_the_day):
+        '''cached response or None'''
+        key = self.key(location, hour_of_the_day)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+
+        if self.disk_path is not None:
+            path = self._disk_file(key)
+            try:
+                if time.time() - os.path.getmtime(path) < self.ttl:
+                    with open(path) as file:
+                        response = json.load(file)
+                    self._store(key, response)
+                    with self._lock:
+                        self.disk_hits += 1
+                    return response
+            except (OSError, ValueError):
+                pass
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _store(self, key, response):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def set(self, location, hour_of_the_day, response):
+        key = self.key(location, hour_of_the_day)
+        self._store(key, response)
+        if self.disk_path is not None:
+            path = self._disk_file(key)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(tmp_path, 'w') as file:
+                    json.dump(response, file)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                # another process pruned the directory of a version it no longer serves
+                print(f"Error writing cached response: {e}")
+            if time.monotonic() - self._pruned >= self.prune_interval:
+                self.prune()
+
+    def get_or_compute(self, location, hour_of_the_day, compute):
+        '''cached response, or compute(location, hour_of_the_day) and cache it'''
+        response = self.get(location, hour_of_the_day)
+        if response is None:
+            response = compute(location, hour_of_the_day)
+            self.set(location, hour_of_the_day, response)
+        return response
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'size': len(self._entries)}
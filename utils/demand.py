@@ -0,0 +1,82 @@
+import numpy as np
+
+HOURS = 24
+
+
+class DemandIndex:
+    '''Dense location x hour table of demand factors, built once per data refresh from booking_counts'''
+
+    def __init__(self, locations, bookings, peak, factor, off_peak_factor):
+        self.locations = np.asarray(locations)
+        self.bookings = bookings
+        self.peak = peak
+        self.factor = factor
+        self.off_peak_factor = off_peak_factor
+        self._positions = {location: i for i, location in enumerate(self.locations.tolist())}
+
+    @classmethod
+    def from_counts(cls, counts):
+        '''Same rules as peak_hour_demand_factor and popular_location_demand_factor, for every (location, hour) at once'''
+        table = counts.unstack('booking_created_at_hour', fill_value=0)
+        table = table.reindex(columns=range(HOURS), fill_value=0).sort_index()
+        locations = table.index.to_numpy()
+        # integer booking counts, or the decayed float counts of utils.live_demand
+        bookings = table.to_numpy(dtype=np.float64 if counts.dtype.kind == 'f' else np.int64)
+        # groupby only returns hours with bookings, so statistics are over those hours
+        present = bookings > 0
+
+        peak = np.zeros(bookings.shape, dtype=bool)
+        hour_factor = np.zeros(len(locations))
+        for i in range(len(locations)):
+            hourly_bookings = bookings[i][present[i]]
+            threshold = np.int32(np.round(np.percentile(hourly_bookings, 75)))
+            peak[i] = present[i] & (bookings[i] >= threshold)
+            hour_factor[i] = np.round((hourly_bookings / hourly_bookings.max()).mean(), 2)
+
+        demand_location = bookings.sum(axis=1)
+        threshold = np.int32(np.round(np.percentile(demand_location, 75)))
+        location_demand = np.round((demand_location / demand_location.max()).mean(), 2)
+        location_factor = np.where(demand_location >= threshold, location_demand, 0)
+
+        factor = np.round(np.mean([np.where(peak, hour_factor[:, None], 0),
+                                   np.broadcast_to(location_factor[:, None], peak.shape)], axis=0), 5)
+        off_peak_factor = np.round(np.mean([np.zeros(len(locations)), location_factor], axis=0), 5)
+        return cls(locations, bookings, peak, factor, off_peak_factor)
+
+    @classmethod
+    def from_history(cls, historical_data):
+        return cls.from_counts(historical_data.groupby(['location', 'booking_created_at_hour'], observed=True).size())
+
+    def save(self, path):
+        np.savez(path, locations=self.locations.astype(str), bookings=self.bookings, peak=self.peak,
+                 factor=self.factor, off_peak_factor=self.off_peak_factor)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['locations'], data['bookings'], data['peak'], data['factor'], data['off_peak_factor'])
+
+    def peak_hours(self, location):
+        '''peak hours of a location'''
+        i = self._positions.get(location)
+        if i is None:
+            return []
+        return np.flatnonzero(self.peak[i]).tolist()
+
+    def lookup(self, location, hour):
+        '''return demand factor and peak hours of a location, like demand_factor'''
+        i = self._positions.get(location)
+        if i is None:
+            return 0.0, []
+        return self.hour_factors(location, np.array([hour]))[0], self.peak_hours(location)
+
+    def hour_factors(self, location, hours):
+        '''demand factor of a location for an array of hours'''
+        hours = np.asarray(hours, dtype=float)
+        i = self._positions.get(location)
+        if i is None:
+            return np.zeros(len(hours))
+        # hours that are not whole numbers in 0-23 are never peak hours
+        valid = (hours >= 0) & (hours < HOURS) & (hours == np.floor(hours))
+        positions = np.where(valid, hours, 0).astype(np.int64)
+        return np.where(valid, self.factor[i, positions], self.off_peak_factor[i])
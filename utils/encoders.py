@@ -0,0 +1,172 @@
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+from utils.model import ENCODERS_PATH, ENCODER_DTYPES, MODEL_FEATURES
+
+# Pickled category_encoders encoders and the lookup tables compiled from them
+PICKLES = ['binary_encoder.pkl', 'one_hot_encoder.pkl']
+COMPILED_FILE = 'lookup_encoders.json'
+
+
+def compile_encoders(binary_encoder, one_hot_encoder):
+    '''Lookup tables of the fitted BinaryEncoder and OneHotEncoder
+
+    Each encoded column gets its categories and a table with one row of output values per category, then a row for
+    unknown values and a row for missing values, so encoding is an index into the table.
+    '''
+    columns = []
+    for encoder in [binary_encoder, one_hot_encoder]:
+        if encoder.handle_unknown != 'value' or encoder.handle_missing != 'value':
+            raise ValueError(f'{type(encoder).__name__} with handle_unknown={encoder.handle_unknown} and '
+                             f'handle_missing={encoder.handle_missing} cannot be compiled')
+        for ordinal, mapping in zip(encoder.ordinal_encoder.mapping, encoder.mapping):
+            assert ordinal['col'] == mapping['col']
+            values = ordinal['mapping']
+            categories = [value for value in values.index if not pd.isna(value)]
+            # category_encoders codes unknown values -1 and missing values -2
+            rows = [values[category] for category in categories] + [-1, -2]
+            table = mapping['mapping'].reindex(rows, fill_value=0)
+            columns.append({
+                'column': ordinal['col'],
+                'numeric': ENCODER_DTYPES[ordinal['col']] != object,
+                'categories': [category.item() if hasattr(category, 'item') else category for category in categories],
+                'outputs': table.columns.tolist(),
+                'table': table.to_numpy().tolist(),
+            })
+    return {'columns': columns}
+
+
+class LookupEncoder:
+    '''Compiled encoders: NumPy tables indexed by the category codes of every encoded column'''
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.columns = []
+        for entry in spec['columns']:
+            categories = pd.Index(entry['categories'], dtype=float if entry['numeric'] else object)
+            table = np.asarray(entry['table'], dtype=np.int64)
+            self.columns.append((entry['column'], entry['numeric'], categories, entry['outputs'], table))
+        self._tables = {column: (numeric, categories, table) for column, numeric, categories, outputs, table in self.columns}
+        self.input_columns = [column for column, *rest in self.columns]
+        self.outputs = [output for *rest, outputs, table in self.columns for output in outputs]
+        # float32 tables and their columns in the model feature matrix
+        self.feature_tables = [(column, table.astype(np.float32), [MODEL_FEATURES.index(output) for output in outputs])
+                               for column, numeric, categories, outputs, table in self.columns]
+        self.numeric_features = [(position, feature) for position, feature in enumerate(MODEL_FEATURES) if feature not in self.outputs]
+
+    def rows(self, column, values):
+        '''row of the table of column for every value'''
+        numeric, categories, table = self._tables[column]
+        unknown, missing = len(table) - 2, len(table) - 1
+        if isinstance(values.dtype, pd.CategoricalDtype) and not numeric:
+            # index the categories once, then map the codes of every value
+            lookup = categories.get_indexer(values.cat.categories.astype(object))
+            lookup = np.append(np.where(lookup < 0, unknown, lookup), missing)
+            return lookup[values.cat.codes.to_numpy()]
+        values = values.to_numpy(dtype=float) if numeric else values.to_numpy(dtype=object)
+        rows = categories.get_indexer(values)
+        rows[rows < 0] = unknown
+        rows[pd.isna(values)] = missing
+        return rows
+
+    def row(self, column, value):
+        '''encoded values of one value of column, None for an unknown value'''
+        rows = self.rows(column, pd.Series([value]))
+        table = self._tables[column][2]
+        if rows[0] >= len(table) - 2:
+            return None
+        return table[rows[0]]
+
+    def transform(self, dataframe):
+        '''frame of the encoded columns, as the pickled encoders return them'''
+        encoded = dict()
+        for column, numeric, categories, outputs, table in self.columns:
+            values = table[self.rows(column, dataframe[column])]
+            for i, output in enumerate(outputs):
+                encoded[output] = values[:, i]
+        return pd.DataFrame(encoded, index=dataframe.index)
+
+    def feature_matrix(self, dataframe, out=None):
+        '''float32 model inputs of the transformed frame, in the column order of MODEL_FEATURES
+
+        The categorical columns are encoded straight into out, a preallocated (rows, 47) float32 array, without the
+        intermediate encoded frame.
+        '''
+        if out is None:
+            out = np.empty((len(dataframe), len(MODEL_FEATURES)), dtype=np.float32)
+        for position, feature in self.numeric_features:
+            out[:, position] = dataframe[feature].to_numpy()
+        for column, table, positions in self.feature_tables:
+            out[:, positions] = table[self.rows(column, dataframe[column])]
+        return out
+
+
+def reference_transform(binary_encoder, one_hot_encoder, dataframe):
+    '''encoded columns of the pickled encoders, as encode_features computed them'''
+    encoder_input = dataframe[list(ENCODER_DTYPES)].astype(ENCODER_DTYPES)
+    return pd.concat([binary_encoder.transform(encoder_input['location']),
+                      one_hot_encoder.transform(encoder_input.drop(columns='location'))], axis=1)
+
+
+def check_equivalence(encoder, binary_encoder, one_hot_encoder, dataframe):
+    '''differences between the compiled and the pickled encoders on dataframe, empty when they agree bit for bit'''
+    expected = reference_transform(binary_encoder, one_hot_encoder, dataframe)
+    actual = encoder.transform(dataframe)
+    differences = []
+    if actual.columns.tolist() != expected.columns.tolist():
+        differences.append(f'columns {actual.columns.tolist()} instead of {expected.columns.tolist()}')
+    else:
+        for column in expected.columns:
+            if actual[column].dtype != expected[column].dtype or not np.array_equal(actual[column], expected[column]):
+                differences.append(f'{column}: {(actual[column].to_numpy() != expected[column].to_numpy()).sum()} rows differ')
+    numeric = [feature for feature in MODEL_FEATURES if feature not in encoder.outputs]
+    if set(numeric) <= set(dataframe.columns):
+        expected_matrix = pd.concat([dataframe[numeric], expected], axis=1)[MODEL_FEATURES].to_numpy(dtype=np.float32)
+        # compare the bits so NaN and -0.0 have to match too
+        if not np.array_equal(encoder.feature_matrix(dataframe).view(np.uint32), expected_matrix.view(np.uint32)):
+            differences.append('feature matrix differs')
+    return differences
+
+
+def coverage_frame(encoder):
+    '''one row per category, unknown value and missing value of every encoded column'''
+    base = {column: categories[0] for column, numeric, categories, outputs, table in encoder.columns}
+    rows = []
+    for column, numeric, categories, outputs, table in encoder.columns:
+        # the pickled encoders are given int64 flags, which cannot be missing
+        for value in list(categories) + ([-1.0] if numeric else ['Unknown', np.nan]):
+            rows.append(dict(base, **{column: value}))
+    return pd.DataFrame(rows)
+
+
+def load_encoders(encoders_path=ENCODERS_PATH):
+    '''LookupEncoder of encoders_path, compiled from the pickles when the compiled file is missing or older'''
+    path = os.path.join(encoders_path, COMPILED_FILE)
+    pickles = [os.path.join(encoders_path, name) for name in PICKLES]
+    if os.path.exists(path) and all(os.path.getmtime(path) >= os.path.getmtime(pickle) for pickle in pickles if os.path.exists(pickle)):
+        with open(path) as file:
+            return LookupEncoder(json.load(file))
+    # unpickling imports category_encoders
+    import joblib
+    return LookupEncoder(compile_encoders(*[joblib.load(pickle) for pickle in pickles]))
+
+
+if __name__ == '__main__':
+    # python -m utils.encoders, after the encoder pickles change
+    import joblib
+    parser = argparse.ArgumentParser(description='Compile the pickled encoders into lookup tables')
+    parser.add_argument('--encoders', default=ENCODERS_PATH)
+    args = parser.parse_args()
+    binary_encoder, one_hot_encoder = [joblib.load(os.path.join(args.encoders, name)) for name in PICKLES]
+    spec = compile_encoders(binary_encoder, one_hot_encoder)
+    encoder = LookupEncoder(spec)
+    differences = check_equivalence(encoder, binary_encoder, one_hot_encoder, coverage_frame(encoder))
+    if differences:
+        raise SystemExit(f"Error compiling the encoders: {'; '.join(differences)}")
+    path = os.path.join(args.encoders, COMPILED_FILE)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(spec, file)
+    os.replace(path + '.tmp', path)
+    print(f"Compiled {len(spec['columns'])} columns into {len(encoder.outputs)} outputs: {path}")
@@ -0,0 +1,434 @@
+import argparse
+import json
+import os
+import shutil
+import time
+import numpy as np
+import pandas as pd
+from utils.model import DATA_PATH, LOCATION_MAPPING, preprocess_data, transform_data, encode_features, structure_dataframe, \
+    booking_counts, apply_schema
+from utils.ingest import CHUNKSIZE, read_chunks, read_bookings, collect_statistics, preprocess_chunk, \
+    preprocess_data_stream, DuplicateFilter, max_timestamp
+from utils.demand import DemandIndex
+from utils.locations import save_manifest
+from utils.metrics import timed
+
+# Feature store location
+FEATURE_STORE_PATH = DATA_PATH + "feature_store/"
+# Statistics of the last full build and the watermark of incremental updates
+STATE_FILE = 'state.json'
+# Part files a location partition may have before they are compacted into one
+MAX_PARTS = 4
+# DemandIndex of the live booking counters published by utils/live_demand.py, served while it is fresh. It is kept
+# outside the feature store so publishing it does not change the store version.
+LIVE_DEMAND_PATH = DATA_PATH + "live_demand/"
+LIVE_DEMAND_FILE = 'live_demand_index.npz'
+LIVE_DEMAND_MAX_AGE = float(os.environ.get('LIVE_DEMAND_MAX_AGE', 2700))
+
+
+def partition_path(location, store_path=FEATURE_STORE_PATH):
+    '''directory of one location partition'''
+    return os.path.join(store_path, f'location={location}')
+
+
+def part_filename(part, last=None):
+    '''file name of one part, or of the parts part to last compacted into one file'''
+    if last is None:
+        return f'part-{part:05d}.parquet'
+    return f'part-{part:05d}-{last:05d}.parquet'
+
+
+def part_range(filename):
+    '''(first, last) part in a part file name'''
+    numbers = filename[len('part-'):-len('.parquet')].split('-')
+    return int(numbers[0]), int(numbers[-1])
+
+
+def current_parts(path):
+    '''part files of a partition directory in order, without the parts a compacted file already holds'''
+    filenames = [(part_range(filename), filename) for filename in os.listdir(path)
+                 if filename.startswith('part-') and filename.endswith('.parquet')]
+    parts = []
+    covered = -1
+    # a compacted file sorts before the parts it holds when the compaction stopped before removing them
+    for (first, last), filename in sorted(filenames, key=lambda item: (item[0][0], -item[0][1])):
+        if first > covered:
+            parts.append(filename)
+            covered = last
+    return parts
+
+
+def write_partitions(scaled_df, df, store_path, part=0):
+    '''append one part of scaled_df and df to every location partition'''
+    # encode_features keeps the index of df, so scaled_df rows can be selected with the same mask
+    for location, location_df in df.groupby('location', sort=True, observed=True):
+        path = partition_path(location, store_path)
+        for name, frame in [('history', location_df), ('scaled', scaled_df.loc[location_df.index])]:
+            os.makedirs(os.path.join(path, name), exist_ok=True)
+            # readers of a live store never see a half written part
+            tmp_path = os.path.join(path, name, f'.{part_filename(part)}.tmp')
+            frame.to_parquet(tmp_path)
+            os.replace(tmp_path, os.path.join(path, name, part_filename(part)))
+
+
+def encode_chunks(filenames, chunksize, statistics=None, raw_df=None):
+    '''yield (scaled_df, df) of the bookings, in one piece (raw_df when it was read already) or streamed in chunks'''
+    tariff_df = pd.read_csv(DATA_PATH + 'Diff Tariffs.csv')
+    if chunksize is None:
+        if raw_df is None:
+            raw_df = read_bookings(filenames)
+        yield encode_preprocessed(preprocess_data(raw_df, tariff_df))
+        return
+    for df in preprocess_data_stream(filenames, tariff_df, chunksize, statistics):
+        yield encode_preprocessed(df)
+
+
+def encode_preprocessed(df):
+    '''transform, encode and arrange preprocessed data as load_preprocessed_data does'''
+    df = transform_data(df)
+    scaled_df, df = encode_features(df)
+    scaled_df = structure_dataframe(scaled_df)
+    return scaled_df, df
+
+
+def rate_sums(df):
+    '''sums and counts of the rates for each location and vehicle type, the running form of get_average_rates'''
+    return df.groupby(['location', 'Vehicle Type'], observed=True).agg(
+        hourly_rate_sum=('hourly_rate', 'sum'), hourly_rate_count=('hourly_rate', 'count'),
+        daily_rate_sum=('daily_rate', 'sum'), daily_rate_count=('daily_rate', 'count'))
+
+
+def add_aggregates(total, part):
+    '''add the counts or rate sums of a new part to the running total'''
+    if total is None:
+        return part
+    # categories of the location level can differ between parts, align on plain values
+    names = total.index.names
+    total, part = [frame.set_axis(frame.index.to_flat_index(), axis=0) for frame in [total, part]]
+    total = total.add(part, fill_value=0)
+    total.index = pd.MultiIndex.from_tuples(total.index, names=names)
+    return total
+
+
+def schema_index(aggregate):
+    '''aggregate with the index dtypes of apply_schema, the chunked sums have object and float levels'''
+    return aggregate.set_axis(pd.MultiIndex.from_frame(apply_schema(aggregate.index.to_frame(index=False))), axis=0)
+
+
+def save_aggregates(store_path, counts, sums):
+    '''write the booking counts, rate sums and DemandIndex of the whole history
+
+    They are written with the same dtypes whether they were summed over chunks or counted in one piece.
+    '''
+    counts = schema_index(counts.astype('int64')).sort_index()
+    sums = schema_index(sums.astype({'hourly_rate_count': 'int64', 'daily_rate_count': 'int64'}))
+    replace_file(os.path.join(store_path, 'booking_counts.parquet'),
+                 lambda path: counts.rename('bookings').to_frame().to_parquet(path))
+    replace_file(os.path.join(store_path, 'rate_sums.parquet'), lambda path: sums.sort_index().to_parquet(path))
+    replace_file(os.path.join(store_path, 'demand_index.npz'),
+                 lambda path: DemandIndex.from_counts(counts).save(path), suffix='.npz')
+
+
+def stored_locations(counts):
+    '''locations with bookings in the booking counts'''
+    if counts is None:
+        return []
+    return counts.index.get_level_values('location').unique().astype(str).tolist()
+
+
+def replace_file(path, write, suffix=''):
+    '''write a file next to path and swap it in'''
+    tmp_path = f'{path}.tmp{suffix}'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def save_state(store_path, statistics, parts, next_index):
+    '''write the statistics of the last full build, the watermark and the booking id hashes'''
+    replace_file(os.path.join(store_path, 'booking_ids.npy'),
+                 lambda path: np.save(path, statistics['booking_ids']), suffix='.npy')
+    state = {
+        'watermark': None if pd.isna(statistics['watermark']) else statistics['watermark'].isoformat(),
+        'peak_hours': [int(hour) for hour in statistics['peak_hours']],
+        'lower_bound': statistics['lower_bound'].to_dict(),
+        'upper_bound': statistics['upper_bound'].to_dict(),
+        'parts': parts,
+        'next_index': next_index,
+    }
+
+    def write(path):
+        with open(path, 'w') as file:
+            json.dump(state, file, indent=2)
+
+    # the state is written last, it marks the parts and aggregates of an update as complete
+    replace_file(os.path.join(store_path, STATE_FILE), write)
+
+
+def load_state(store_path=FEATURE_STORE_PATH):
+    '''statistics, watermark and booking id hashes saved by save_state'''
+    with open(os.path.join(store_path, STATE_FILE)) as file:
+        state = json.load(file)
+    state['watermark'] = pd.NaT if state['watermark'] is None else pd.Timestamp(state['watermark'])
+    state['lower_bound'] = pd.Series(state['lower_bound'])
+    state['upper_bound'] = pd.Series(state['upper_bound'])
+    state['booking_ids'] = np.load(os.path.join(store_path, 'booking_ids.npy'))
+    return state
+
+
+def build_feature_store(filenames=('2024 Bookings.csv',), store_path=FEATURE_STORE_PATH, chunksize=None):
+    '''Run the full preprocessing pipeline once and persist it to Parquet partitioned by location
+
+    With a chunksize the bookings are streamed (see utils/ingest.py) and each chunk is appended as a new part.
+    '''
+    # Build next to the live store and swap it in so readers never see a half written store
+    tmp_path = store_path.rstrip('/') + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    # Peak hours, outlier bounds and the watermark are kept for incremental updates
+    tariff_df = pd.read_csv(DATA_PATH + 'Diff Tariffs.csv')
+    raw_df = None
+    if chunksize is None:
+        # the bookings are read once and the statistics come from the frame in memory
+        raw_df = read_bookings(list(filenames))
+        statistics = collect_statistics(list(filenames), tariff_df, chunks=[raw_df])
+    else:
+        statistics = collect_statistics(list(filenames), tariff_df, chunksize)
+
+    counts = None
+    sums = None
+    part = -1
+    next_index = 0
+    for part, (scaled_df, df) in enumerate(encode_chunks(list(filenames), chunksize, statistics, raw_df)):
+        write_partitions(scaled_df, df, tmp_path, part)
+        counts = add_aggregates(counts, booking_counts(df))
+        sums = add_aggregates(sums, rate_sums(df))
+        next_index = max(next_index, int(df.index.max()) + 1 if len(df) else 0)
+
+    # Demand factors need booking counts of every location, store them aggregated and as a DemandIndex
+    save_aggregates(tmp_path, counts, sums)
+    # Locations of the GET / page, with the active flags and display names edited in the live store
+    save_manifest(tmp_path, stored_locations(counts), LOCATION_MAPPING, previous_store_path=store_path)
+    save_state(tmp_path, statistics, part + 1, next_index)
+    # a chunked build leaves one part per chunk in every location
+    compact_parts(tmp_path)
+
+    old_path = store_path.rstrip('/') + '.old'
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(store_path):
+        os.rename(store_path, old_path)
+    os.rename(tmp_path, store_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def remove_uncommitted_parts(store_path, parts):
+    '''remove parts left behind by an update that did not finish'''
+    for location_path in os.listdir(store_path):
+        if not location_path.startswith('location='):
+            continue
+        for name in ['history', 'scaled']:
+            path = os.path.join(store_path, location_path, name)
+            # an update can stop before the directories of a new location are both made
+            if not os.path.isdir(path):
+                continue
+            for filename in os.listdir(path):
+                if not filename.startswith('part-') or part_range(filename)[1] >= parts:
+                    os.remove(os.path.join(path, filename))
+        # a location first seen by the unfinished update has no committed part left
+        if not any(os.listdir(os.path.join(store_path, location_path, name))
+                   for name in ['history', 'scaled'] if os.path.isdir(os.path.join(store_path, location_path, name))):
+            shutil.rmtree(os.path.join(store_path, location_path))
+
+
+def update_feature_store(filenames, store_path=FEATURE_STORE_PATH, chunksize=CHUNKSIZE):
+    '''Append the bookings created since the watermark to the feature store without rescanning the history
+
+    Peak hours and outlier bounds stay those of the last full build. Booking counts, rate sums and the DemandIndex
+    are updated from the new bookings only. Returns the number of appended bookings.
+    '''
+    state = load_state(store_path)
+    remove_uncommitted_parts(store_path, state['parts'])
+    tariff_df = pd.read_csv(DATA_PATH + 'Diff Tariffs.csv')
+    counts = load_booking_counts(store_path)
+    sums = load_rate_sums(store_path)
+
+    # booking ids already stored are dropped, so bookings created at the watermark can be read again safely
+    drop_duplicates = DuplicateFilter(state['booking_ids'])
+    watermark = state['watermark']
+    part = state['parts']
+    next_index = state['next_index']
+    appended = 0
+    locations = set()
+    for chunk in read_chunks(filenames, chunksize):
+        # Only parse the created date of bookings before the watermark
+        created = pd.to_datetime(chunk['booking_created_at'], errors='coerce')
+        if not pd.isna(watermark):
+            chunk = chunk[(created >= watermark) | created.isna()]
+        if chunk.empty:
+            continue
+        state['watermark'] = max_timestamp(state['watermark'], created[chunk.index].max())
+        df = preprocess_chunk(chunk, tariff_df, state, drop_duplicates)
+        if df.empty:
+            continue
+
+        df.index = pd.RangeIndex(next_index, next_index + len(df))
+        next_index += len(df)
+        scaled_df, df = encode_preprocessed(df)
+        write_partitions(scaled_df, df, store_path, part)
+        locations.update(df['location'].astype(str).unique())
+        part += 1
+        counts = add_aggregates(counts, booking_counts(df))
+        sums = add_aggregates(sums, rate_sums(df))
+        appended += len(df)
+
+    if appended:
+        save_aggregates(store_path, counts, sums)
+        save_manifest(store_path, stored_locations(counts), LOCATION_MAPPING)
+        state['booking_ids'] = drop_duplicates.seen
+        save_state(store_path, state, part, next_index)
+        # every update adds a part to the locations it touched, merging them keeps the files read per request bounded
+        compact_parts(store_path, sorted(locations))
+    return appended
+
+
+def read_parts(path):
+    '''concatenate the memory mapped part files of a partition'''
+    for attempt in range(2):
+        parts = current_parts(path)
+        try:
+            # parts with different categories are concatenated as object columns
+            return apply_schema(pd.concat([pd.read_parquet(os.path.join(path, part), memory_map=True) for part in parts]))
+        except FileNotFoundError:
+            # a compaction removed the parts after they were listed, the file it wrote holds them
+            if attempt:
+                raise
+
+
+def compact_partition(path, max_parts=MAX_PARTS):
+    '''merge the part files of a partition directory into one when there are more than max_parts
+
+    The merged file is named after the parts it holds and written before they are removed, so readers and
+    remove_uncommitted_parts see every row once at any time.
+    '''
+    parts = current_parts(path)
+    if len(parts) <= max_parts:
+        return False
+    first, last = part_range(parts[0])[0], part_range(parts[-1])[1]
+    merged = read_parts(path)
+    tmp_path = os.path.join(path, f'.{part_filename(first, last)}.tmp')
+    merged.to_parquet(tmp_path)
+    os.replace(tmp_path, os.path.join(path, part_filename(first, last)))
+    for part in parts:
+        if part != part_filename(first, last):
+            os.remove(os.path.join(path, part))
+    return True
+
+
+def compact_parts(store_path, locations=None, max_parts=MAX_PARTS):
+    '''compact the history and scaled parts of locations, every location by default, returns the compacted locations'''
+    if locations is None:
+        locations = sorted(name[len('location='):] for name in os.listdir(store_path) if name.startswith('location='))
+    compacted = []
+    for location in locations:
+        changed = [compact_partition(os.path.join(partition_path(location, store_path), name), max_parts)
+                   for name in ['history', 'scaled']]
+        if any(changed):
+            compacted.append(location)
+    return compacted
+
+
+@timed('load_location_data')
+def load_location_data(location, store_path=FEATURE_STORE_PATH):
+    '''return scaled_df, df of a single location, memory mapped from the feature store'''
+    path = partition_path(location, store_path)
+    if not os.path.isdir(path):
+        raise FileNotFoundError(f'No feature store partition for {location}')
+    scaled_df = read_parts(os.path.join(path, 'scaled'))
+    df = read_parts(os.path.join(path, 'history'))
+    return scaled_df, df
+
+
+def load_history(locations=None, store_path=FEATURE_STORE_PATH):
+    '''return the stored history of several locations, every location by default'''
+    if locations is None:
+        locations = sorted(name[len('location='):] for name in os.listdir(store_path) if name.startswith('location='))
+    frames = [read_parts(os.path.join(partition_path(location, store_path), 'history')) for location in locations]
+    return apply_schema(pd.concat(frames))
+
+
+def load_scaled(locations=None, store_path=FEATURE_STORE_PATH):
+    '''return the encoded features of several locations, every location by default'''
+    if locations is None:
+        locations = sorted(name[len('location='):] for name in os.listdir(store_path) if name.startswith('location='))
+    return pd.concat([read_parts(os.path.join(partition_path(location, store_path), 'scaled')) for location in locations])
+
+
+def load_booking_counts(store_path=FEATURE_STORE_PATH):
+    '''return bookings per location and booking_created_at_hour of the whole history'''
+    counts = pd.read_parquet(os.path.join(store_path, 'booking_counts.parquet'), memory_map=True)
+    return counts['bookings']
+
+
+def load_rate_sums(store_path=FEATURE_STORE_PATH):
+    '''return rate sums and counts per location and vehicle type of the whole history'''
+    return pd.read_parquet(os.path.join(store_path, 'rate_sums.parquet'))
+
+
+_rate_averages = (None, None)
+
+
+def load_rate_averages(store_path=FEATURE_STORE_PATH):
+    '''return average rates per location and vehicle type as get_average_rates, kept in memory until the store changes'''
+    global _rate_averages
+    path = os.path.join(store_path, 'rate_sums.parquet')
+    mtime = os.path.getmtime(path)
+    if _rate_averages[0] != mtime:
+        sums = load_rate_sums(store_path)
+        averages = pd.DataFrame({'hourly_rate': sums['hourly_rate_sum'] / sums['hourly_rate_count'],
+                                 'daily_rate': sums['daily_rate_sum'] / sums['daily_rate_count']}).reset_index()
+        _rate_averages = (mtime, averages)
+    return _rate_averages[1]
+
+
+_demand_index = (None, None)
+
+
+def live_demand_mtime(live_path=LIVE_DEMAND_PATH):
+    '''modification time of the live DemandIndex, None when it is missing or older than LIVE_DEMAND_MAX_AGE'''
+    try:
+        mtime = os.path.getmtime(os.path.join(live_path, LIVE_DEMAND_FILE))
+    except FileNotFoundError:
+        return None
+    return mtime if time.time() - mtime <= LIVE_DEMAND_MAX_AGE else None
+
+
+def load_demand_index(store_path=FEATURE_STORE_PATH, live_path=LIVE_DEMAND_PATH):
+    '''return the DemandIndex of the feature store, kept in memory until the store is rebuilt
+
+    The live DemandIndex is returned instead while it was published less than LIVE_DEMAND_MAX_AGE seconds ago.
+    '''
+    global _demand_index
+    mtime = live_demand_mtime(live_path)
+    path = os.path.join(live_path, LIVE_DEMAND_FILE)
+    if mtime is None:
+        path = os.path.join(store_path, 'demand_index.npz')
+        mtime = os.path.getmtime(path)
+    if _demand_index[0] != (path, mtime):
+        _demand_index = ((path, mtime), DemandIndex.load(path))
+    return _demand_index[1]
+
+
+if __name__ == '__main__':
+    # python -m utils.feature_store ["2019 Bookings.csv" ... "2024 Bookings.csv"] [--chunksize 200000]
+    # python -m utils.feature_store "2024 Bookings.csv" --incremental
+    parser = argparse.ArgumentParser(description='Build the feature store from bookings CSV files in DATA_PATH')
+    parser.add_argument('filenames', nargs='*', default=['2024 Bookings.csv'])
+    parser.add_argument('--chunksize', type=int, default=None, help='stream the CSV files in chunks of this many rows')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only append bookings created since the last build or update')
+    args = parser.parse_args()
+    if args.incremental:
+        appended = update_feature_store(args.filenames, chunksize=args.chunksize or CHUNKSIZE)
+        print(f'Appended {appended} bookings')
+    else:
+        build_feature_store(args.filenames, chunksize=args.chunksize)
@@ -0,0 +1,66 @@
+import re
+import numpy as np
+
+# Season of every month, index 0 is the season of missing dates
+# (the row-wise get_season mapped March to June to Spring, July to September to Summer, October to December to Autumn)
+SEASON_BY_MONTH = np.array(['Winter', 'Winter', 'Winter', 'Spring', 'Spring', 'Spring', 'Spring', 'Summer', 'Summer', 'Summer',
+                            'Autumn', 'Autumn', 'Autumn'], dtype=object)
+
+# Holidays of every year as (month, day)
+HOLIDAYS = [(12, day) for day in range(24, 32)] + [(1, 1), (5, 27), (3, 29), (8, 26), (4, 1), (5, 6)]
+HOLIDAY_KEYS = np.array([month * 100 + day for month, day in HOLIDAYS])
+
+# Short codes of location_description, the first matching pattern wins
+DESCRIPTION_CODES = [
+    ('BRI', 'Lower Maudlin|Bristol'), ('GLA', 'glasgow|Glsgow'), ('NCL', 'Nwcastle'), ('BIR', 'Birmingham'),
+    ('TUN', 'Tunbridge Wells'), ('FRO', 'Frome'), ('EXE', 'Exeter'), ('DUR', 'Durham'), ('SAL', 'Salford|Slaford'),
+    ('SWI', "S'land"), ('REA', 'Reading'),
+]
+# One lookahead per code tried in order at the start of the description, so one scan finds the first pattern that
+# occurs anywhere in it, as the separate str.contains passes did
+DESCRIPTION_PATTERN = re.compile('^(?:' + '|'.join(f'(?=.*?({pattern}))' for code, pattern in DESCRIPTION_CODES) + ')',
+                                 re.IGNORECASE | re.DOTALL)
+
+WEEKEND_DAYS = [5, 6]
+
+
+def calendar_features(dates):
+    '''season and is_holiday of a datetime Series, from one pass over its months and days'''
+    month = dates.dt.month.fillna(0).to_numpy(dtype=np.int64)
+    day = dates.dt.day.fillna(0).to_numpy(dtype=np.int64)
+    season = SEASON_BY_MONTH[month]
+    is_holiday = np.isin(month * 100 + day, HOLIDAY_KEYS).astype(np.int64)
+    return season, is_holiday
+
+
+def flag(values, members):
+    '''1 where values is one of members, else 0'''
+    return np.isin(values.to_numpy(), list(members)).astype(np.int64)
+
+
+def resolve_office_codes(office_use, description):
+    '''location_office_use short codes, resolved from location_description where they are missing'''
+    office_use = office_use.str[:3]
+    missing = office_use.isna().to_numpy()
+    if missing.any():
+        matches = description[missing].str.extract(DESCRIPTION_PATTERN).notna().to_numpy()
+        found = matches.any(axis=1)
+        codes = np.array([code for code, pattern in DESCRIPTION_CODES], dtype=object)[matches.argmax(axis=1)]
+        rows = np.flatnonzero(missing)[found]
+        office_use = office_use.copy()
+        office_use.iloc[rows] = codes[found]
+    return office_use
+
+
+def clip_columns(dataframe, columns, lower_bound, upper_bound):
+    '''cap and floor columns at their bounds vectors in one pass over the columns, missing values and bounds are kept'''
+    # one row per column so every column is contiguous
+    values = np.array([dataframe[column].to_numpy(dtype=float) for column in columns])
+    lower = lower_bound[columns].to_numpy(dtype=float)[:, np.newaxis]
+    upper = upper_bound[columns].to_numpy(dtype=float)[:, np.newaxis]
+    # comparisons with NaN are False, so unlike np.clip missing bounds leave the values as they are
+    values = np.where(values > upper, upper, values)
+    values = np.where(values < lower, lower, values)
+    for column, column_values in zip(columns, values):
+        dataframe[column] = column_values
+    return dataframe
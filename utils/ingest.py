@@ -0,0 +1,147 @@
+import numpy as np
+import pandas as pd
+from utils.model import DATA_PATH, OUTLIER_COLUMNS, clean_data, get_peak_hours, add_peak_hour, add_features, \
+    get_outlier_bounds, cap_outliers, apply_schema
+
+# Columns of the bookings CSV used by preprocess_data, everything else is never read
+BOOKING_DTYPES = {
+    'booking_id': str,
+    'Contract': str,
+    'booking_tariff': str,
+    'location_office_use': str,
+    'location_description': str,
+    'booking_billed_start': str,
+    'booking_billed_end': str,
+    'booking_created_at': str,
+    'booking_actual_duration': 'float64',
+    'booking_billed_duration': 'float64',
+    'booking_rates_24hours': 'float64',
+    'booking_rates_overnight': 'float64',
+    'booking_rates_hours': 'float64',
+    'booking_mileage': 'float64',
+    'booking_actual_cost_distance': 'float64',
+    'booking_actual_cost_time': 'float64',
+    'booking_actual_cost_total': 'float64',
+}
+
+# Rows per chunk
+CHUNKSIZE = 200000
+
+
+def read_chunks(filenames, chunksize=CHUNKSIZE):
+    '''read the bookings CSVs chunk by chunk with explicit dtypes'''
+    for filename in filenames:
+        for chunk in pd.read_csv(DATA_PATH + filename, usecols=list(BOOKING_DTYPES), dtype=BOOKING_DTYPES,
+                                 chunksize=chunksize):
+            yield chunk
+
+
+def read_bookings(filenames):
+    '''read the bookings CSVs in one piece with the dtypes of read_chunks'''
+    return pd.concat([pd.read_csv(DATA_PATH + filename, usecols=list(BOOKING_DTYPES), dtype=BOOKING_DTYPES)
+                      for filename in filenames], ignore_index=True)
+
+
+def quantile_from_counts(counts, q):
+    '''Linear interpolated quantile, as DataFrame.quantile, from the value counts of a column'''
+    counts = counts.sort_index()
+    values = counts.index.to_numpy(dtype=float)
+    ranks = np.cumsum(counts.to_numpy())
+    if len(values) == 0:
+        return np.nan
+    position = (ranks[-1] - 1) * q
+    lower = np.floor(position)
+    below = values[np.searchsorted(ranks, lower, side='right')]
+    above = values[np.searchsorted(ranks, min(lower + 1, ranks[-1] - 1), side='right')]
+    # interpolate exactly as numpy does between the two neighbouring values
+    return np.quantile([below, above], position - lower)
+
+
+class DuplicateFilter:
+    '''keep='first' drop_duplicates on booking_id across chunks
+
+    Only a sorted array of 8 byte hashes of the booking ids seen so far is kept, not the bookings themselves.
+    '''
+
+    def __init__(self, seen=None):
+        # seen: sorted hashes of booking ids stored earlier, see utils/feature_store.py
+        self.seen = np.array([], dtype=np.uint64) if seen is None else seen
+
+    def __call__(self, dataframe):
+        hashes = pd.util.hash_array(dataframe['booking_id'].to_numpy(dtype=object))
+        keep = ~pd.Series(hashes).duplicated(keep='first').to_numpy()
+
+        # drop ids already seen in earlier chunks
+        if len(self.seen):
+            positions = np.minimum(np.searchsorted(self.seen, hashes), len(self.seen) - 1)
+            keep &= self.seen[positions] != hashes
+
+        new = np.sort(hashes[keep])
+        self.seen = np.insert(self.seen, np.searchsorted(self.seen, new), new)
+        return dataframe[keep]
+
+
+def collect_statistics(filenames, tariff_df, chunksize=CHUNKSIZE, chunks=None):
+    '''First pass: peak hours (step 12) and IQR outlier bounds (step 17) of the whole history
+
+    Also returns the latest booking_created_at (the watermark of incremental updates) and the hashes of every booking id.
+    chunks, e.g. [bookings] already read by read_bookings, are used instead of reading the files again.
+    '''
+    hourly_bookings = pd.Series(dtype='int64')
+    value_counts = {col: pd.Series(dtype='int64') for col in OUTLIER_COLUMNS}
+    drop_duplicates = DuplicateFilter()
+    watermark = pd.NaT
+
+    for chunk in read_chunks(filenames, chunksize) if chunks is None else chunks:
+        dataframe = clean_data(chunk, tariff_df.copy())
+        # Peak hours are counted before duplicates are dropped, as in preprocess_data
+        hourly_bookings = hourly_bookings.add(dataframe.groupby('booking_created_at_hour').size(), fill_value=0)
+        dataframe = drop_duplicates(dataframe)
+        watermark = max_timestamp(watermark, dataframe['booking_created_at'].max())
+        for col in OUTLIER_COLUMNS:
+            value_counts[col] = value_counts[col].add(dataframe[col].value_counts(), fill_value=0)
+
+    peak_hours = get_peak_hours(hourly_bookings.astype('int64').sort_index())
+    Q1 = pd.Series({col: quantile_from_counts(value_counts[col], 0.25) for col in OUTLIER_COLUMNS})
+    Q3 = pd.Series({col: quantile_from_counts(value_counts[col], 0.75) for col in OUTLIER_COLUMNS})
+    lower_bound, upper_bound = get_outlier_bounds(Q1, Q3)
+    return {'peak_hours': peak_hours, 'lower_bound': lower_bound, 'upper_bound': upper_bound,
+            'watermark': watermark, 'booking_ids': drop_duplicates.seen}
+
+
+def max_timestamp(a, b):
+    '''latest of two timestamps, NaT if both are missing'''
+    if pd.isna(a):
+        return b
+    if pd.isna(b):
+        return a
+    return max(a, b)
+
+
+def preprocess_chunk(chunk, tariff_df, statistics, drop_duplicates):
+    '''preprocess_data of one chunk with the statistics of the whole history'''
+    dataframe = clean_data(chunk, tariff_df.copy())
+    dataframe = add_peak_hour(dataframe, statistics['peak_hours'])
+    dataframe = drop_duplicates(dataframe)
+    dataframe = add_features(dataframe)
+    dataframe = cap_outliers(dataframe, statistics['lower_bound'], statistics['upper_bound'])
+    return apply_schema(dataframe)
+
+
+def preprocess_data_stream(filenames, tariff_df, chunksize=CHUNKSIZE, statistics=None):
+    '''Yield preprocess_data output of several bookings CSVs chunk by chunk
+
+    Memory depends on the chunk size, only the booking id hashes and value counts grow with the history.
+    '''
+    if statistics is None:
+        statistics = collect_statistics(filenames, tariff_df, chunksize)
+
+    # Second pass: apply the per-row steps and the global statistics chunk by chunk
+    drop_duplicates = DuplicateFilter()
+    offset = 0
+    for chunk in read_chunks(filenames, chunksize):
+        dataframe = preprocess_chunk(chunk, tariff_df, statistics, drop_duplicates)
+        # Unique index across chunks
+        dataframe.index = pd.RangeIndex(offset, offset + len(dataframe))
+        offset += len(dataframe)
+        yield dataframe
@@ -0,0 +1,288 @@
+import argparse
+import json
+import math
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+import numpy as np
+import pandas as pd
+from utils.demand import DemandIndex, HOURS
+from utils.feature_store import FEATURE_STORE_PATH, LIVE_DEMAND_PATH, LIVE_DEMAND_FILE, load_booking_counts, replace_file
+
+# Bookings lose half their weight in the counters after this many seconds
+HALF_LIFE = 86400.0
+# Weights are rebased on the latest event before exp overflows
+REBASE_EXPONENT = 300.0
+# Weight of the historical booking counts the counters start from, as a number of events
+SEED_EVENTS = 1000
+# Every publish is a new data version for the response cache and the price surface, so it matches the surface rebuilds
+PUBLISH_INTERVAL = 900.0
+SNAPSHOT_INTERVAL = 300.0
+POLL_INTERVAL = 0.2
+# Counters and read position of the event file
+SNAPSHOT_PATH = LIVE_DEMAND_PATH + 'live_demand_snapshot.npz'
+# booking_created_at of the bookings CSV is the wall clock time of the UK, events are counted in the same hours
+TIME_ZONE = ZoneInfo('Europe/London')
+
+
+class LiveDemand:
+    '''Exponentially decayed booking counters per (location, hour)
+
+    Events are added with forward decay: an event at time t weighs exp(rate * (t - reference)), so adding one is a
+    single multiplication and addition whatever the order of the events, and all the counters decay together.
+    '''
+
+    def __init__(self, half_life=HALF_LIFE):
+        self.half_life = half_life
+        self.rate = math.log(2) / half_life
+        self.reference = None
+        self.latest = None
+        self.locations = []
+        self._positions = dict()
+        # flat lists, one row of HOURS counters per location, are faster to update one at a time than arrays
+        self.counters = []
+        self.events = 0
+        # total of the historical counts, the scale of the published counts
+        self.scale = None
+
+    def _add_location(self, location):
+        self._positions[location] = len(self.locations)
+        self.locations.append(location)
+        self.counters.extend([0.0] * HOURS)
+        return self._positions[location]
+
+    def add(self, location, timestamp, hour, weight=1.0):
+        '''count a booking created at timestamp (seconds) in hour of the day, in constant time'''
+        i = self._positions.get(location)
+        if i is None:
+            i = self._add_location(location)
+        if self.reference is None:
+            self.reference = self.latest = timestamp
+        exponent = self.rate * (timestamp - self.reference)
+        if exponent > REBASE_EXPONENT:
+            self.rebase(timestamp)
+            exponent = 0.0
+        weight *= math.exp(exponent)
+        self.counters[i * HOURS + hour] += weight
+        if timestamp > self.latest:
+            self.latest = timestamp
+        self.events += 1
+
+    def rebase(self, timestamp):
+        '''move the reference time of the weights to timestamp'''
+        scale = math.exp(-self.rate * (timestamp - self.reference))
+        self.counters = [counter * scale for counter in self.counters]
+        self.reference = timestamp
+
+    def seed(self, counts, events, timestamp):
+        '''start from the historical booking counts, weighing as many events at timestamp'''
+        total = counts.sum()
+        self.scale = float(total)
+        for (location, hour), bookings in counts.items():
+            if bookings > 0:
+                self.add(location, timestamp, int(hour), events * bookings / total)
+        self.events = 0
+
+    def add_event(self, line):
+        '''count one JSON event line, False when it cannot be parsed'''
+        event = parse_event(line)
+        if event is None:
+            return False
+        self.add(*event)
+        return True
+
+    def counts(self):
+        '''decayed bookings per location and booking_created_at_hour at the latest event, as booking_counts'''
+        if self.reference is None:
+            return pd.Series([], dtype=float, index=pd.MultiIndex.from_tuples([], names=['location', 'booking_created_at_hour']))
+        scale = math.exp(-self.rate * (self.latest - self.reference))
+        counters = np.array(self.counters).reshape(len(self.locations), HOURS) * scale
+        index = pd.MultiIndex.from_product([self.locations, range(HOURS)], names=['location', 'booking_created_at_hour'])
+        counts = pd.Series(counters.ravel(), index=index)
+        return counts[counts > 0]
+
+    def index(self):
+        '''DemandIndex of the decayed counts, on the scale of the historical counts
+
+        The rules of demand_factor round percentiles to whole bookings, so the counts are scaled to the total of the
+        historical counts they were written for. The location factor comes from the hours of a location added up.
+        '''
+        counts = self.counts()
+        if self.scale is not None and counts.sum() > 0:
+            counts = counts * (self.scale / counts.sum())
+        # rounding keeps the thresholds independent of the order the events were added in
+        return DemandIndex.from_counts(counts.round(6))
+
+    def save(self, path, position=None):
+        '''snapshot of the counters and of the read position of the event file'''
+        inode, offset = position or (-1, -1)
+        replace_file(path, lambda tmp_path: np.savez(
+            tmp_path, locations=np.array(self.locations, dtype=str), counters=np.array(self.counters),
+            half_life=self.half_life, reference=np.nan if self.reference is None else self.reference,
+            latest=np.nan if self.latest is None else self.latest, events=self.events,
+            scale=np.nan if self.scale is None else self.scale, position=np.array([inode, offset])), suffix='.npz')
+
+    @classmethod
+    def load(cls, path):
+        '''counters and read position saved by save'''
+        with np.load(path) as data:
+            live = cls(float(data['half_life']))
+            for location in data['locations'].tolist():
+                live._add_location(location)
+            live.counters = data['counters'].tolist()
+            live.reference, live.latest, live.scale = [None if np.isnan(data[name]) else float(data[name])
+                                                       for name in ['reference', 'latest', 'scale']]
+            live.events = int(data['events'])
+            inode, offset = data['position'].tolist()
+        return live, (None if offset < 0 else (inode, offset))
+
+
+def parse_event(line):
+    '''(location, timestamp, hour) of a booking created event
+
+    {"location": "Bristol", "created_at": "2024-06-01T17:45:00"} or {"location": "Bristol", "timestamp": 1717263900}.
+    The hour is the UK wall clock hour, as booking_created_at_hour of the historical bookings: timestamps and
+    created_at with an offset are converted to it, created_at without one is UK time like booking_created_at.
+    '''
+    try:
+        event = json.loads(line)
+        location = event['location']
+        created_at = event.get('created_at')
+        if created_at is not None:
+            created = datetime.fromisoformat(created_at)
+            if created.tzinfo is None:
+                created = created.replace(tzinfo=TIME_ZONE)
+            return location, created.timestamp(), created.astimezone(TIME_ZONE).hour
+        timestamp = float(event['timestamp'])
+        return location, timestamp, datetime.fromtimestamp(timestamp, timezone.utc).astimezone(TIME_ZONE).hour
+    except (ValueError, KeyError, TypeError, AttributeError, OverflowError, OSError):
+        return None
+
+
+def follow(path, position=None, poll_interval=POLL_INTERVAL):
+    '''yield (line, position) of every line appended to path, and (None, position) while there are none
+
+    position is the (inode, offset) after the line. Reading starts at position when it is still the same file, and
+    follows the file when it is truncated or rotated. With path '-' the lines of stdin are read until it closes.
+    '''
+    if path == '-':
+        for line in sys.stdin.buffer:
+            yield line, None
+        return
+    file = None
+    while True:
+        if file is None:
+            try:
+                file = open(path, 'rb')
+            except FileNotFoundError:
+                yield None, position
+                time.sleep(poll_interval)
+                continue
+            stat = os.fstat(file.fileno())
+            offset = 0
+            if position is not None and position[0] == stat.st_ino and position[1] <= stat.st_size:
+                offset = position[1]
+            file.seek(offset)
+            inode = stat.st_ino
+            pending = b''
+        for line in file:
+            if not line.endswith(b'\n'):
+                # the writer has not finished the line yet
+                pending += line
+                continue
+            line = pending + line
+            pending = b''
+            offset += len(line)
+            yield line, (inode, offset)
+        yield None, (inode, offset)
+        time.sleep(poll_interval)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        if stat.st_ino != inode:
+            # rotated, the rest of the old file was read above
+            file.close()
+            file = None
+            position = None
+        elif stat.st_size < offset + len(pending):
+            # truncated
+            file.seek(0)
+            offset = 0
+            pending = b''
+
+
+def run(source, store_path=FEATURE_STORE_PATH, live_path=LIVE_DEMAND_PATH, snapshot_path=SNAPSHOT_PATH, half_life=HALF_LIFE,
+        publish_interval=PUBLISH_INTERVAL, snapshot_interval=SNAPSHOT_INTERVAL, seed_events=SEED_EVENTS,
+        poll_interval=POLL_INTERVAL):
+    '''Count the booking events of source and publish the live DemandIndex into live_path
+
+    load_demand_index serves the published index instead of the historical one of store_path while it is fresh.
+    '''
+    position = None
+    if os.path.exists(snapshot_path):
+        live, position = LiveDemand.load(snapshot_path)
+        if live.half_life != half_life:
+            # counters decayed at one rate cannot be recovered at another
+            raise SystemExit(f'Error: {snapshot_path} was counted with a half life of {live.half_life:g}s, not '
+                             f'{half_life:g}s. Remove it to count from the historical bookings again.')
+        print(f'Restored {len(live.locations)} locations from {snapshot_path}')
+    else:
+        live = LiveDemand(half_life)
+    counts = load_booking_counts(store_path) if seed_events else None
+    published = snapshotted = time.monotonic()
+    skipped = 0
+    changed = False
+    os.makedirs(live_path, exist_ok=True)
+    os.makedirs(os.path.dirname(snapshot_path) or '.', exist_ok=True)
+
+    def publish():
+        replace_file(os.path.join(live_path, LIVE_DEMAND_FILE), live.index().save, suffix='.npz')
+
+    try:
+        for line, line_position in follow(source, position, poll_interval):
+            if line is not None:
+                event = parse_event(line)
+                if event is None:
+                    skipped += 1
+                    print(f"Error parsing event: {line[:200]!r}")
+                else:
+                    if live.reference is None and counts is not None:
+                        # the history weighs as much as seed_events bookings at the first event
+                        live.seed(counts, seed_events, event[1])
+                    live.add(*event)
+                    changed = True
+                position = line_position
+            now = time.monotonic()
+            if changed and now - published >= publish_interval:
+                publish()
+                published = now
+                changed = False
+            if now - snapshotted >= snapshot_interval:
+                live.save(snapshot_path, position)
+                snapshotted = now
+    except KeyboardInterrupt:
+        pass
+    if live.reference is not None:
+        publish()
+    live.save(snapshot_path, position)
+    print(f'Counted {live.events} events, skipped {skipped}')
+    return live
+
+
+if __name__ == '__main__':
+    # python -m utils.live_demand events.jsonl
+    # producer | python -m utils.live_demand -
+    parser = argparse.ArgumentParser(description='Count booking created events into live demand factors')
+    parser.add_argument('source', help="JSON lines file to follow, or - for stdin")
+    parser.add_argument('--half-life', type=float, default=HALF_LIFE, help='seconds for a booking to lose half its weight')
+    parser.add_argument('--publish-interval', type=float, default=PUBLISH_INTERVAL)
+    parser.add_argument('--snapshot-interval', type=float, default=SNAPSHOT_INTERVAL)
+    parser.add_argument('--seed-events', type=float, default=SEED_EVENTS,
+                        help='weight of the historical booking counts as a number of events, 0 to start empty')
+    parser.add_argument('--snapshot', default=SNAPSHOT_PATH)
+    args = parser.parse_args()
+    run(args.source, snapshot_path=args.snapshot, half_life=args.half_life, publish_interval=args.publish_interval,
+        snapshot_interval=args.snapshot_interval, seed_events=args.seed_events)
@@ -0,0 +1,71 @@
+import json
+import os
+
+# Locations kept out of the pricing tool, marked inactive in the manifest
+INACTIVE_LOCATIONS = ['Banbury', 'Billingshurst', 'Coatbridge', 'Dalkeith', 'Dunbar', 'Exeter', 'Haddington', 'Huntly',
+                      'Leamington-Spa', 'Nantwich', 'Newbury', 'North Berwick', 'North Shields', 'On-fleet Bay', 'Poole',
+                      'Putney', 'South Shields', 'Sunderland', 'Upper Tooting', 'Wandsworth', 'Warwick', 'Wokingham',
+                      'Worthing']
+# Manifest of the locations, written next to the feature store aggregates
+MANIFEST_FILE = 'locations.json'
+
+
+def build_manifest(locations, location_mapping, previous=None):
+    '''Manifest entries {location, display_name, code, active} of the locations with bookings
+
+    display_name and active of locations in a previous manifest are kept, so they can be edited by hand.
+    '''
+    codes = {name: code for code, name in sorted(location_mapping.items(), reverse=True)}
+    previous = {entry['location']: entry for entry in previous or []}
+    manifest = []
+    for location in sorted(locations):
+        entry = {'location': location, 'display_name': location, 'code': codes.get(location),
+                 'active': location not in INACTIVE_LOCATIONS}
+        if location in previous:
+            entry['display_name'] = previous[location].get('display_name', location)
+            entry['active'] = previous[location].get('active', entry['active'])
+        manifest.append(entry)
+    return manifest
+
+
+def manifest_path(store_path):
+    return os.path.join(store_path, MANIFEST_FILE)
+
+
+def read_manifest(store_path):
+    '''manifest entries saved in store_path, empty when there is none'''
+    if not os.path.exists(manifest_path(store_path)):
+        return []
+    with open(manifest_path(store_path)) as file:
+        return json.load(file)
+
+
+def save_manifest(store_path, locations, location_mapping, previous_store_path=None):
+    '''write the manifest of locations to store_path, keeping the edits of the manifest in previous_store_path'''
+    manifest = build_manifest(locations, location_mapping, read_manifest(previous_store_path or store_path))
+    tmp_path = manifest_path(store_path) + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(tmp_path, manifest_path(store_path))
+    return manifest
+
+
+_active_locations = (None, None)
+
+
+def load_active_locations(store_path):
+    '''(location, display_name) of the active locations, kept in memory until the manifest changes'''
+    global _active_locations
+    mtime = os.path.getmtime(manifest_path(store_path))
+    if _active_locations[0] != (store_path, mtime):
+        locations = [(entry['location'], entry['display_name']) for entry in read_manifest(store_path) if entry['active']]
+        _active_locations = ((store_path, mtime), locations)
+    return _active_locations[1]
+
+
+if __name__ == '__main__':
+    # python -m utils.locations: write the manifest of an existing feature store
+    from utils.model import LOCATION_MAPPING
+    from utils.feature_store import FEATURE_STORE_PATH, load_booking_counts, stored_locations
+    manifest = save_manifest(FEATURE_STORE_PATH, stored_locations(load_booking_counts()), LOCATION_MAPPING)
+    print(f"{sum(entry['active'] for entry in manifest)} active of {len(manifest)} locations")
@@ -0,0 +1,133 @@
+import bisect
+import functools
+import threading
+import time
+from contextvars import ContextVar
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    'pricing_stage_seconds': 'Time spent in each stage of the pricing pipeline, including the stages it calls',
+    'pricing_model_seconds': 'Time spent in the rate models of each vehicle type',
+    'pricing_request_seconds': 'Time to answer HTTP requests',
+    'pricing_pool_submitted': 'Computations submitted to the pricing pool',
+    'pricing_pool_coalesced': 'Requests that shared a computation already in flight',
+    'pricing_pool_rejected': 'Requests rejected because the pricing pool was full',
+    'pricing_cache_hits': 'Responses served from the in-memory cache',
+    'pricing_cache_disk_hits': 'Responses served from the on-disk cache',
+    'pricing_cache_misses': 'Responses not found in the cache',
+    'pricing_surface_hits': 'Responses served from the price surface',
+    'pricing_surface_misses': 'Responses not found in the price surface',
+}
+
+
+class Histogram:
+    '''Prometheus style histogram of observed durations'''
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+_histograms = dict()
+_lock = threading.Lock()
+# (stage, labels, seconds) of the computation being profiled by the current thread, see profiled
+_profile = ContextVar('pricing_profile', default=None)
+# seconds observed inside the timed stage the current thread is in, so the stage can tell its own time
+_nested = ContextVar('pricing_nested', default=None)
+
+
+def observe(name, seconds, exclusive=None, **labels):
+    '''record seconds in the histogram of name and labels, and exclusive seconds (the time not spent in nested
+    observations, all of it by default) in the profile of the current computation'''
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(seconds)
+    profile = _profile.get()
+    if profile is not None:
+        profile.append((key, seconds if exclusive is None else exclusive))
+    nested = _nested.get()
+    if nested is not None:
+        nested[0] += seconds
+
+
+def timed(stage, name='pricing_stage_seconds'):
+    '''decorator recording the duration of every call of a pipeline stage'''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            nested = [0.0]
+            token = _nested.set(nested)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                _nested.reset(token)
+                observe(name, seconds, exclusive=seconds - nested[0], stage=stage)
+        return wrapper
+    return decorator
+
+
+def profiled(function, *args):
+    '''(function(*args), stage breakdown) with the milliseconds of every timed stage it went through
+
+    Stages are counted without the stages they call, so the breakdown adds up to the time of function.
+    '''
+    profile = []
+    token = _profile.set(profile)
+    try:
+        result = function(*args)
+    finally:
+        _profile.reset(token)
+    breakdown = dict()
+    for (name, labels), seconds in profile:
+        # stages by name, other histograms as 'model City'
+        stage = ' '.join(str(value) for key, value in labels)
+        if name != 'pricing_stage_seconds':
+            stage = f"{name[len('pricing_'):-len('_seconds')]} {stage}"
+        breakdown[stage] = breakdown.get(stage, 0) + seconds * 1000
+    return result, breakdown
+
+
+def format_labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+def render(gauges=None, counters=None):
+    '''Prometheus text exposition of the histograms, plus gauges and counters {name: value}'''
+    with _lock:
+        histograms = sorted((key, list(histogram.counts), histogram.sum, histogram.count)
+                            for key, histogram in _histograms.items())
+    lines = []
+    previous = None
+    for (name, labels), counts, total, count in histograms:
+        if name != previous:
+            lines += [f'# HELP {name} {HELP.get(name, name)}', f'# TYPE {name} histogram']
+            previous = name
+        cumulative = 0
+        for bound, bucket_count in zip(list(BUCKETS) + ['+Inf'], counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{format_labels(labels, le=bound)} {cumulative}')
+        lines.append(f'{name}_sum{format_labels(labels)} {total}')
+        lines.append(f'{name}_count{format_labels(labels)} {count}')
+    for name, value in (gauges or {}).items():
+        lines += [f'# TYPE {name} gauge', f'{name} {value}']
+    # counters only go up, their samples get the _total suffix
+    for name, value in (counters or {}).items():
+        lines += [f'# HELP {name}_total {HELP.get(name, name)}', f'# TYPE {name}_total counter', f'{name}_total {value}']
+    return '\n'.join(lines) + '\n'
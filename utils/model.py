@@ -1,8 +1,13 @@
 import pandas as pd
 import numpy as np
+import time
 import warnings
-import keras
 import joblib
+from utils.registry import get_registry
+from utils.tariffs import resolve_rates
+from utils.features import calendar_features, flag, resolve_office_codes, clip_columns, WEEKEND_DAYS
+from utils.backtest import booking_revenue, last_month
+from utils.metrics import timed, observe
 
 # Ignore all warnings
 warnings.filterwarnings('ignore')
@@ -14,6 +19,55 @@ ENCODERS_PATH = "encoders/"
 # Model location
 MODEL_PATH = "models/"
 
+# Location short codes of location_office_use
+LOCATION_MAPPING = {
+    'ABI': 'Abingdon', 'ABN': 'Aberdeen', 'BIC': 'Bicester', 'BIL': 'Billingshurst', 'BIR': 'Birmingham', 'BNB': 'Banbury', 'BOU': 'Bournemouth',
+    'BRE': 'Brentwood', 'BRI': 'Bristol', 'CAN': 'Canterbury', 'CHI': 'Chichester', 'CHM': 'Chelmsford', 'CLY': 'Crawley', 'COA': 'Coatbridge',
+    'DAL': 'Dalkeith', 'DDE': 'Dundee', 'DER': 'Derby', 'DUN': 'Dunbar', 'DUR': 'Durham', 'EAS': 'Eastbourne', 'EDI': 'Edinburgh', 'ELI': 'Elgin',
+    'EST': 'Eastleigh', 'EXE': 'Exeter', 'EYN': 'Eynsham', 'FAL': 'Falkirk', 'FRO': 'Frome', 'GHD': 'Gateshead', 'GLA': 'Glasgow', 'HAD': 'Haddington',
+    'HAI': 'Hainault', 'HAR': 'Harrogate', 'HAS': 'Hastings', 'HOR': 'Horsham', 'HOT': 'Henley-on-Thames', 'HRE': 'Houghton-Regis', 'HUN': 'Huntly',
+    'HWY': 'High Wycombe', 'INR': 'Inverurie', 'IOW': 'Isle-of-Wight', 'IPS': 'Ipswich', 'KID': 'Kidlington', 'KNA': 'Knaresborough', 'KNT': 'Maidstone',
+    'LAN': 'Lancaster', 'LEM': 'Leamington-Spa', 'LEW': 'Lewes', 'LON': 'Harrow', 'MUS': 'Musselburgh', 'NAN': 'Nantwich', 'NBE': 'North Berwick',
+    'NCL': 'Newcastle', 'NEW': 'Newbury', 'NTH': 'North Shields', 'OHL': 'Oxenholme', 'ONF': 'On-fleet Bay', 'ORK': 'Orkney', 'OXF': 'Oxford',
+    'PEN': 'Penrith', 'PER': 'Perth', 'PLY': 'Plymouth', 'PUT': 'Putney', 'REA': 'Reading', 'RIP': 'Ripon', 'SAF': 'Saffron Walden', 'SAL': 'Salford',
+    'SBY': 'Salisbury', 'SHR': 'Shrewsbury', 'SOL': 'Solihull', 'SSH': 'South Shields', 'SUN': 'Sunderland', 'SWI': 'Swindon', 'TUN': 'Tunbridge Wells',
+    'UPP': 'Upper Tooting', 'WAL': 'Walton-on-Thames', 'WAN': 'Wandsworth', 'WAR': 'Warwick', 'WIN': 'Winchester', 'WLG': 'Wallingford', 'WND': 'Windermere',
+    'WNT': 'Wantage', 'WOK': 'Wokingham', 'WOR': 'Worthing', 'WRR': 'Warrington', 'WSM': 'Weston-super-Mare'
+}
+
+# Compact dtypes of the preprocessed booking frame, applied by apply_schema
+# Categories are declared so every chunk and partition shares them, unexpected values are appended
+CATEGORIES = {
+    'location': sorted(set(LOCATION_MAPPING.values())),
+    'Vehicle Type': ['City', 'Everyday', 'Family', 'Van', '7 Seater'],
+    'Fuel Type': ['Petrol', 'EV', 'Hydrogen'],
+    'season': ['Winter', 'Autumn', 'Summer', 'Spring'],
+}
+SMALL_INTEGERS = {f'{column}_{feature}': dtype
+                  for column in ['booking_billed_start', 'booking_billed_end', 'booking_created_at']
+                  for feature, dtype in [('hour', 'int8'), ('dayofweek', 'int8'), ('month', 'int8'), ('year', 'int16')]}
+FLAGS = ['is_weekend', 'is_holiday', 'is_peak_hour']
+# dtypes the pickled encoders were fitted on
+ENCODER_DTYPES = {'location': object, 'season': object, 'is_holiday': 'int64', 'is_peak_hour': 'int64', 'is_weekend': 'int64',
+                  'Vehicle Type': object, 'Fuel Type': object}
+
+# Columns of the encoded frame in the order of the rows given to the models at training time
+COLUMN_ORDER = ['location_0', 'location_1', 'location_2', 'location_3', 'location_4', 'location_5', 'location_6', 'booking_actual_duration',
+                'booking_billed_start', 'booking_billed_start_hour', 'booking_billed_start_dayofweek', 'booking_billed_start_month',
+                'booking_billed_start_year', 'booking_billed_end_hour', 'booking_billed_end_dayofweek', 'booking_billed_end_month',
+                'booking_billed_end_year', 'booking_billed_duration', 'booking_mileage', 'booking_rates_hours', 'booking_rates_24hours',
+                'booking_rates_overnight', 'booking_actual_cost_distance', 'booking_actual_cost_time', 'booking_actual_cost_total',
+                'booking_created_at_hour', 'booking_created_at_dayofweek', 'booking_created_at_month', 'booking_created_at_year',
+                'season_Winter', 'season_Autumn', 'season_Summer', 'season_Spring', 'is_holiday_1.0', 'is_holiday_0.0', 'Vehicle Type_City',
+                'Vehicle Type_Everyday', 'Vehicle Type_Family', 'Vehicle Type_Van', 'Vehicle Type_7 Seater', 'Fuel Type_Petrol', 'Fuel Type_EV',
+                'Fuel Type_Hydrogen', 'is_peak_hour_1.0', 'is_peak_hour_0.0', 'is_weekend_1.0', 'is_weekend_0.0', 'hourly_rate', 'daily_rate', 'per_mile']
+# Model inputs, prepare_features leaves out the billed start and the rates
+MODEL_FEATURES = [col for col in COLUMN_ORDER if col not in ['booking_billed_start', 'hourly_rate', 'daily_rate']]
+
+# Numerical columns capped and floored by the IQR rule
+OUTLIER_COLUMNS = ['booking_actual_duration', 'booking_billed_duration', 'booking_mileage', 'booking_actual_cost_distance',
+                   'booking_actual_cost_time', 'booking_actual_cost_total']
+
 
 def load_encoders():
     '''load the encoders'''
@@ -153,23 +207,11 @@ def apply_rates(row):
 
     return row
 
-def preprocess_data(dataframe, tariff_df, location_mapping=None):
-    '''preprocess data steps'''
-    location_mapping = {
-        'ABI': 'Abingdon', 'ABN': 'Aberdeen', 'BIC': 'Bicester', 'BIL': 'Billingshurst', 'BIR': 'Birmingham', 'BNB': 'Banbury', 'BOU': 'Bournemouth',
-        'BRE': 'Brentwood', 'BRI': 'Bristol', 'CAN': 'Canterbury', 'CHI': 'Chichester', 'CHM': 'Chelmsford', 'CLY': 'Crawley', 'COA': 'Coatbridge',
-        'DAL': 'Dalkeith', 'DDE': 'Dundee', 'DER': 'Derby', 'DUN': 'Dunbar', 'DUR': 'Durham', 'EAS': 'Eastbourne', 'EDI': 'Edinburgh', 'ELI': 'Elgin',
-        'EST': 'Eastleigh', 'EXE': 'Exeter', 'EYN': 'Eynsham', 'FAL': 'Falkirk', 'FRO': 'Frome', 'GHD': 'Gateshead', 'GLA': 'Glasgow', 'HAD': 'Haddington',
-        'HAI': 'Hainault', 'HAR': 'Harrogate', 'HAS': 'Hastings', 'HOR': 'Horsham', 'HOT': 'Henley-on-Thames', 'HRE': 'Houghton-Regis', 'HUN': 'Huntly',
-        'HWY': 'High Wycombe', 'INR': 'Inverurie', 'IOW': 'Isle-of-Wight', 'IPS': 'Ipswich', 'KID': 'Kidlington', 'KNA': 'Knaresborough', 'KNT': 'Maidstone',
-        'LAN': 'Lancaster', 'LEM': 'Leamington-Spa', 'LEW': 'Lewes', 'LON': 'Harrow', 'MUS': 'Musselburgh', 'NAN': 'Nantwich', 'NBE': 'North Berwick',
-        'NCL': 'Newcastle', 'NEW': 'Newbury', 'NTH': 'North Shields', 'OHL': 'Oxenholme', 'ONF': 'On-fleet Bay', 'ORK': 'Orkney', 'OXF': 'Oxford',
-        'PEN': 'Penrith', 'PER': 'Perth', 'PLY': 'Plymouth', 'PUT': 'Putney', 'REA': 'Reading', 'RIP': 'Ripon', 'SAF': 'Saffron Walden', 'SAL': 'Salford',
-        'SBY': 'Salisbury', 'SHR': 'Shrewsbury', 'SOL': 'Solihull', 'SSH': 'South Shields', 'SUN': 'Sunderland', 'SWI': 'Swindon', 'TUN': 'Tunbridge Wells',
-        'UPP': 'Upper Tooting', 'WAL': 'Walton-on-Thames', 'WAN': 'Wandsworth', 'WAR': 'Warwick', 'WIN': 'Winchester', 'WLG': 'Wallingford', 'WND': 'Windermere',
-        'WNT': 'Wantage', 'WOK': 'Wokingham', 'WOR': 'Worthing', 'WRR': 'Warrington', 'WSM': 'Weston-super-Mare'
-    }
-    
+def clean_data(dataframe, tariff_df, location_mapping=None):
+    '''preprocess steps 1 to 12 that only depend on the row itself'''
+    if location_mapping is None:
+        location_mapping = LOCATION_MAPPING
+
     # Function for data preprocessing
     # Step 1: Only select PAYG fleet data
     dataframe = dataframe[dataframe['Contract'] == 'PAYG']
@@ -182,13 +224,13 @@ def preprocess_data(dataframe, tariff_df, location_mapping=None):
     # Step 3: Convert datatypes to pandas datetime object
     date_columns = ['booking_start', 'booking_end', 'booking_actual_start', 'booking_actual_end',
                     'booking_billed_start', 'booking_billed_end', 'booking_created_at', 'booking_cancelled_at']
-    for col in date_columns:
+    for col in [col for col in date_columns if col in dataframe.columns]:
         dataframe[col] = pd.to_datetime(dataframe[col], errors='coerce')
 
     # Step 4: Convert to Integer type
     int_columns = ['booking_duration', 'booking_actual_duration', 'booking_billed_duration',
                    'booking_rates_24hours', 'booking_rates_overnight']
-    for col in int_columns:
+    for col in [col for col in int_columns if col in dataframe.columns]:
         # dataframe[col] = pd.to_numeric(dataframe[col], errors='coerce').fillna(0).astype(int)
         dataframe[col] = pd.to_numeric(dataframe[col], errors='coerce').astype(int)
 
@@ -203,19 +245,8 @@ def preprocess_data(dataframe, tariff_df, location_mapping=None):
     dataframe = dataframe.dropna(subset=['location_office_use', 'location_description'], how='all')
 
     # Step 7: Create Location column from location_office_use
-    dataframe['location_office_use'] = dataframe['location_office_use'].str[:3]
-    # Replace 'location_office_use' with short codes where 'location_description' contains longer text only if 'location_office_use' is null
-    dataframe.loc[(dataframe['location_description'].str.contains('Lower Maudlin|Bristol', case=False, na=False)) & (dataframe['location_office_use'].isnull()), 'location_office_use'] = 'BRI'
-    dataframe.loc[(dataframe['location_description'].str.contains('glasgow|Glsgow', case=False, na=False)) & (dataframe['location_office_use'].isnull()), 'location_office_use'] = 'GLA'
-    dataframe.loc[(dataframe['location_description'].str.contains('Nwcastle', case=False, na=False)) & (dataframe['location_office_use'].isnull()), 'location_office_use'] = 'NCL'
-    dataframe.loc[(dataframe['location_description'].str.contains('Birmingham', case=False, na=False)) & (dataframe['location_office_use'].isnull()), 'location_office_use'] = 'BIR'
-    dataframe.loc[(dataframe['location_description'].str.contains('Tunbridge Wells', case=False, na=False)) & (dataframe['location_office_use'].isnull()), 'location_office_use'] = 'TUN'
-    dataframe.loc[(dataframe['location_description'].str.contains('Frome', case=False, na=False)) & (dataframe['location_office_use'].isnull()), 'location_office_use'] = 'FRO'
-    dataframe.loc[(dataframe['location_description'].str.contains('Exeter', case=False, na=False)) & (dataframe['location_office_use'].isnull()), 'location_office_use'] = 'EXE'
-    dataframe.loc[(dataframe['location_description'].str.contains('Durham', case=False, na=False)) & (dataframe['location_office_use'].isnull()), 'location_office_use'] = 'DUR'
-    dataframe.loc[(dataframe['location_description'].str.contains('Salford|Slaford', case=False, na=False)) & (dataframe['location_office_use'].isnull()), 'location_office_use'] = 'SAL'
-    dataframe.loc[(dataframe['location_description'].str.contains("S'land", case=False, na=False)) & (dataframe['location_office_use'].isnull()), 'location_office_use'] = 'SWI'
-    dataframe.loc[(dataframe['location_description'].str.contains('Reading', case=False, na=False)) & (dataframe['location_office_use'].isnull()), 'location_office_use'] = 'REA'
+    # Short codes from location_description where location_office_use is null, one regex scan of those rows only
+    dataframe['location_office_use'] = resolve_office_codes(dataframe['location_office_use'], dataframe['location_description'])
 
     dataframe['location'] = dataframe['location_office_use'].map(location_mapping)
 
@@ -225,8 +256,8 @@ def preprocess_data(dataframe, tariff_df, location_mapping=None):
     # Step 9: Only Select Size Category other than Various
     dataframe = dataframe[dataframe['Size Category'] != 'Various']
 
-    # Step 10: Apply the rates function
-    dataframe = dataframe.apply(apply_rates, axis=1)
+    # Step 10: Apply the rates (vectorised apply_rates, see utils/tariffs.py)
+    dataframe = resolve_rates(dataframe)
 
     # Step 11: Extract features from dates
     date_features = ['hour', 'dayofweek', 'month', 'year']
@@ -237,23 +268,29 @@ def preprocess_data(dataframe, tariff_df, location_mapping=None):
 
     # Step 12: Weekend and peak hours
     ## Weekend
-    dataframe['is_weekend'] = dataframe['booking_billed_start_dayofweek'].apply(lambda x: 1 if x in [5, 6] else 0)
+    dataframe['is_weekend'] = flag(dataframe['booking_billed_start_dayofweek'], WEEKEND_DAYS)
 
-    ## peak hours
-    # Aggregate bookings by hour
-    hourly_bookings = dataframe.groupby('booking_created_at_hour').size()
+    return dataframe
+
+
+def get_peak_hours(hourly_bookings):
+    '''peak hours from the number of bookings per booking_created_at_hour'''
     hourly_bookings = pd.DataFrame(hourly_bookings, columns=['bookings'])
 
     # Identify peak hours
     threshold = np.int32(np.round(np.percentile(hourly_bookings['bookings'], 75)))
     peak_hours = hourly_bookings[hourly_bookings['bookings'] >= threshold].index.tolist()
+    return peak_hours
 
-    # add column for is_peak_hour
-    dataframe['is_peak_hour'] = dataframe['booking_created_at_hour'].apply(lambda x: 1 if x in peak_hours else 0)
 
-    # Step 13: Drop duplicates based on ‘booking_id’ keep=‘first’
-    dataframe.drop_duplicates(subset=['booking_id'], keep='first', inplace=True)
+def add_peak_hour(dataframe, peak_hours):
+    '''add column for is_peak_hour'''
+    dataframe['is_peak_hour'] = flag(dataframe['booking_created_at_hour'], peak_hours)
+    return dataframe
 
+
+def add_features(dataframe):
+    '''preprocess steps 14 to 16 that only depend on the row itself'''
     # Step 14: Remove columns
     columns_to_remove = ['account_id', 'Contract', 'user_id', 'booking_id', 'location_description', 'location_office_use', 'vehicle_description',
                          'vehicle_registration', 'vehicle_communication_id', 'vehicle_operator_name', 'vehicle_office_use', 'booking_actual_start',
@@ -261,59 +298,69 @@ def preprocess_data(dataframe, tariff_df, location_mapping=None):
                          'booking_start', 'booking_end', 'booking_credits_used', 'booking_transactions_value', 'booking_estimated_cost', 'booking_total_paid',
                          'booking_status', 'booking_ended_early', 'booking_cancelled_at', 'booking_cancellation_reason', 'PAYG or Contract', 'Notes',
                          'booking_duration', 'Tariff', 'Size Category']
-    dataframe.drop(columns=columns_to_remove, inplace=True)
+    dataframe.drop(columns=[col for col in columns_to_remove if col in dataframe.columns], inplace=True)
 
     # Step 15: Add Seasons features (apply it to booking_billed_start)
-    def get_season(date):
-        month = date.month
-        day = date.day
-        if (month == 3 and day >= 1) or (month > 3 and month < 6) or (month == 6 and day <= 30):
-            return 'Spring'
-        elif (month == 6 and day >= 1) or (month > 6 and month < 9) or (month == 9 and day <= 30):
-            return 'Summer'
-        elif (month == 9 and day >= 1) or (month > 9 and month < 12) or (month == 12 and day <= 31):
-            return 'Autumn'
-        else:
-            return 'Winter'
-
-    dataframe['season'] = dataframe['booking_billed_start'].apply(get_season)
-
     # Step 16: Add Holiday features
-    def is_holiday(date):
-        if (date.month == 12 and date.day >= 24) or (date.month == 1 and date.day <= 1) or \
-        (date.month == 5 and date.day == 27) or (date.month == 3 and date.day == 29) or \
-        (date.month == 8 and date.day == 26) or (date.month == 4 and date.day == 1) or (date.month == 5 and date.day == 6):
-            return 1
-        return 0
+    season, is_holiday = calendar_features(dataframe['booking_billed_start'])
+    dataframe['season'] = season
+    dataframe['is_holiday'] = is_holiday
 
-    dataframe['is_holiday'] = dataframe['booking_billed_start'].apply(is_holiday)
+    return dataframe
 
-    # Step 17: Outliers
-    # Check for outliers using IQR
-    Q1 = dataframe[['booking_actual_duration', 'booking_billed_duration', 'booking_mileage', 'booking_actual_cost_distance', 'booking_actual_cost_time', 'booking_actual_cost_total']].quantile(0.25)
-    Q3 = dataframe[['booking_actual_duration', 'booking_billed_duration', 'booking_mileage', 'booking_actual_cost_distance', 'booking_actual_cost_time', 'booking_actual_cost_total']].quantile(0.75)
+
+def get_outlier_bounds(Q1, Q3):
+    '''IQR lower and upper bounds of OUTLIER_COLUMNS from their quartiles'''
     IQR = Q3 - Q1
     lower_bound = Q1 - 1.5 * IQR
     upper_bound = Q3 + 1.5 * IQR
+    return lower_bound, upper_bound
+
+
+def cap_outliers(dataframe, lower_bound, upper_bound):
+    '''Handling outliers by capping and flooring'''
+    return clip_columns(dataframe, OUTLIER_COLUMNS, lower_bound, upper_bound)
+
+
+def apply_schema(dataframe):
+    '''Store categorical columns as categoricals, date features as int8/int16 and flags as bool'''
+    for column, categories in CATEGORIES.items():
+        if column in dataframe.columns:
+            extra = sorted(set(dataframe[column].dropna().unique()) - set(categories))
+            dataframe[column] = pd.Categorical(dataframe[column], categories=categories + extra)
+    for column, dtype in SMALL_INTEGERS.items():
+        # date features of missing dates stay float
+        if column in dataframe.columns and not dataframe[column].isna().any():
+            dataframe[column] = dataframe[column].astype(dtype)
+    for column in FLAGS:
+        if column in dataframe.columns:
+            dataframe[column] = dataframe[column].astype(bool)
+    return dataframe
 
-    # Handling outliers by capping and flooring
-    dataframe['booking_actual_duration'] = np.where(dataframe['booking_actual_duration'] > upper_bound['booking_actual_duration'], upper_bound['booking_actual_duration'], dataframe['booking_actual_duration'])
-    dataframe['booking_actual_duration'] = np.where(dataframe['booking_actual_duration'] < lower_bound['booking_actual_duration'], lower_bound['booking_actual_duration'], dataframe['booking_actual_duration'])
 
-    dataframe['booking_billed_duration'] = np.where(dataframe['booking_billed_duration'] > upper_bound['booking_billed_duration'], upper_bound['booking_billed_duration'], dataframe['booking_billed_duration'])
-    dataframe['booking_billed_duration'] = np.where(dataframe['booking_billed_duration'] < lower_bound['booking_billed_duration'], lower_bound['booking_billed_duration'], dataframe['booking_billed_duration'])
+def preprocess_data(dataframe, tariff_df, location_mapping=None):
+    '''preprocess data steps'''
+    # Steps 1 to 12: cleaning, tariffs, date features and weekend
+    dataframe = clean_data(dataframe, tariff_df, location_mapping)
 
-    dataframe['booking_mileage'] = np.where(dataframe['booking_mileage'] > upper_bound['booking_mileage'], upper_bound['booking_mileage'], dataframe['booking_mileage'])
-    dataframe['booking_mileage'] = np.where(dataframe['booking_mileage'] < lower_bound['booking_mileage'], lower_bound['booking_mileage'], dataframe['booking_mileage'])
+    ## peak hours
+    # Aggregate bookings by hour
+    peak_hours = get_peak_hours(dataframe.groupby('booking_created_at_hour').size())
+    dataframe = add_peak_hour(dataframe, peak_hours)
+
+    # Step 13: Drop duplicates based on ‘booking_id’ keep=‘first’
+    dataframe.drop_duplicates(subset=['booking_id'], keep='first', inplace=True)
 
-    dataframe['booking_actual_cost_distance'] = np.where(dataframe['booking_actual_cost_distance'] > upper_bound['booking_actual_cost_distance'], upper_bound['booking_actual_cost_distance'], dataframe['booking_actual_cost_distance'])
-    dataframe['booking_actual_cost_distance'] = np.where(dataframe['booking_actual_cost_distance'] < lower_bound['booking_actual_cost_distance'], lower_bound['booking_actual_cost_distance'], dataframe['booking_actual_cost_distance'])
+    # Steps 14 to 16: remove columns, seasons and holidays
+    dataframe = add_features(dataframe)
 
-    dataframe['booking_actual_cost_time'] = np.where(dataframe['booking_actual_cost_time'] > upper_bound['booking_actual_cost_time'], upper_bound['booking_actual_cost_time'], dataframe['booking_actual_cost_time'])
-    dataframe['booking_actual_cost_time'] = np.where(dataframe['booking_actual_cost_time'] < lower_bound['booking_actual_cost_time'], lower_bound['booking_actual_cost_time'], dataframe['booking_actual_cost_time'])
+    # Step 17: Outliers
+    # Check for outliers using IQR
+    lower_bound, upper_bound = get_outlier_bounds(dataframe[OUTLIER_COLUMNS].quantile(0.25), dataframe[OUTLIER_COLUMNS].quantile(0.75))
+    dataframe = cap_outliers(dataframe, lower_bound, upper_bound)
 
-    dataframe['booking_actual_cost_total'] = np.where(dataframe['booking_actual_cost_total'] > upper_bound['booking_actual_cost_total'], upper_bound['booking_actual_cost_total'], dataframe['booking_actual_cost_total'])
-    dataframe['booking_actual_cost_total'] = np.where(dataframe['booking_actual_cost_total'] < lower_bound['booking_actual_cost_total'], lower_bound['booking_actual_cost_total'], dataframe['booking_actual_cost_total'])
+    # Compact dtypes
+    dataframe = apply_schema(dataframe)
 
     return dataframe
 
@@ -341,182 +388,145 @@ def inverse_transform_data(dataframe):
 def encode_features(dataframe):
     '''Encode categorical features'''
     df = dataframe.copy()
-    binary_encoder, one_hot_encoder = load_encoders()
-    categorical_features = ['location', 'season', 'is_holiday', 'is_peak_hour', 'is_weekend', 'Vehicle Type', 'Fuel Type']
+    encoders = get_registry().get_encoders()
 
-    # Binary Encoding for 'location' due to high cardinality
-    locations = binary_encoder.transform(dataframe[categorical_features[0]])
+    # Binary Encoding for 'location' due to high cardinality, One-Hot Encoding for the other categorical features,
+    # through the lookup tables compiled from the pickled encoders
+    encoded = encoders.transform(dataframe)
 
-    # One-Hot Encoding for other categorical features
-    other_features = one_hot_encoder.transform(dataframe[categorical_features[1::]])
-
-    dataframe = pd.concat([dataframe, locations, other_features], axis=1)
-    dataframe.drop(categorical_features, axis=1, inplace=True)
+    dataframe = pd.concat([dataframe, encoded], axis=1)
+    dataframe.drop(encoders.input_columns, axis=1, inplace=True)
 
     return dataframe, df
 
 def structure_dataframe(dataframe):
     '''Arrange columns of the data'''
-    new_order = ['location_0', 'location_1', 'location_2', 'location_3', 'location_4', 'location_5', 'location_6', 'booking_actual_duration',
-                 'booking_billed_start', 'booking_billed_start_hour', 'booking_billed_start_dayofweek', 'booking_billed_start_month',
-                 'booking_billed_start_year', 'booking_billed_end_hour', 'booking_billed_end_dayofweek', 'booking_billed_end_month',
-                 'booking_billed_end_year', 'booking_billed_duration', 'booking_mileage', 'booking_rates_hours', 'booking_rates_24hours',
-                 'booking_rates_overnight', 'booking_actual_cost_distance', 'booking_actual_cost_time', 'booking_actual_cost_total',
-                 'booking_created_at_hour', 'booking_created_at_dayofweek', 'booking_created_at_month', 'booking_created_at_year',
-                 'season_Winter', 'season_Autumn', 'season_Summer', 'season_Spring', 'is_holiday_1.0', 'is_holiday_0.0', 'Vehicle Type_City',
-                 'Vehicle Type_Everyday', 'Vehicle Type_Family', 'Vehicle Type_Van', 'Vehicle Type_7 Seater', 'Fuel Type_Petrol', 'Fuel Type_EV',
-                 'Fuel Type_Hydrogen', 'is_peak_hour_1.0', 'is_peak_hour_0.0', 'is_weekend_1.0', 'is_weekend_0.0', 'hourly_rate', 'daily_rate', 'per_mile']
-    dataframe = dataframe[new_order]
+    dataframe = dataframe[COLUMN_ORDER]
 
     return dataframe
 
 
-def predict_rates(dataframe, location):
-    '''Predict hourly_rate and daily_rate for each vehicle types and for location'''
-    binary_encoder , one_hot_encoder = load_encoders()
-    df = dataframe.copy()
-    # BinaryEncoder inverse transform the location columns
-    df['location'] = binary_encoder.inverse_transform(df.filter(like='location_'))['location']
+def location_bits(encoders, location):
+    '''BinaryEncoder bit pattern of the location columns, None for an unknown location'''
+    return encoders.row('location', location)
 
-    # Filter data for the given location
-    location_data = df[df['location'] == location].copy()
 
-    # Encode location data again
-    location_encoded = binary_encoder.transform(location_data[['location']])
+@timed('prepare_features')
+def prepare_features(dataframe, location):
+    '''Features and current rates of the latest booking of each vehicle type for location'''
+    encoders = get_registry().get_encoders()
+    features = []
 
-    # Prepare features of location_data
-    location_data.update(location_encoded)
-    location_data.drop(['location'], axis=1, inplace=True)
+    # Match the encoded location columns against the bit pattern of the location instead of decoding every row
+    bits = location_bits(encoders, location)
+    if bits is None:
+        return features
+    location_columns = [f'location_{i}' for i in range(len(bits))]
+    location_mask = (dataframe[location_columns].to_numpy() == bits).all(axis=1)
 
-    predictions_df = pd.DataFrame()
+    booking_billed_start = dataframe['booking_billed_start'].to_numpy()
+    location_mask &= ~np.isnat(booking_billed_start)
 
-    vehicle_types = [col for col in location_data.columns if col.startswith('Vehicle Type_')]
+    # Same column order as the rows given to the models at training time
+    feature_columns = [col for col in dataframe.columns if col not in ['booking_billed_start', 'hourly_rate', 'daily_rate']]
 
-    model_hourly = None
-    model_daily = None
-    X = None
+    vehicle_types = [col for col in dataframe.columns if col.startswith('Vehicle Type_')]
 
     for vehicle_type in vehicle_types:
-        vehicle_data = location_data[location_data[vehicle_type] == 1].copy()
+        rows = np.flatnonzero(location_mask & (dataframe[vehicle_type].to_numpy() == 1))
 
-        if vehicle_data.empty:
+        if len(rows) == 0:
             print(f'No data for {vehicle_type.replace("Vehicle Type_", "")}')
             continue
 
-        # Sort the data based on billed start time
-        vehicle_data = vehicle_data.sort_values(by='booking_billed_start')
-
-        # Drop useless features for the current vehicle type
-        vehicle_data = vehicle_data.drop(columns=['booking_billed_start'])
-
-        # copy vehicle_data for booking_actual_cost_distance, booking_actual_cost_time, and booking_actual_cost_total
-        vehicle_data_copy = vehicle_data.copy()
-
-        # Inverse log transformation
-        vehicle_data_copy = inverse_transform_data(vehicle_data_copy)
+        # Latest booking based on billed start time, the last one if several start at the same time
+        latest = rows[len(rows) - 1 - np.argmax(booking_billed_start[rows][::-1])]
+
+        def value(column):
+            return dataframe[column].to_numpy()[latest]
+
+        features.append({
+            'vehicle_type': vehicle_type,
+            'X': dataframe.iloc[[latest]][feature_columns],
+            'row': {
+                'vehicle_type': vehicle_type.replace('Vehicle Type_', ''),
+                'location': location,
+                'hourly_rate': value('hourly_rate'),
+                'daily_rate': value('daily_rate'),
+                # Inverse log transformation of the costs
+                'actual_cost_distance': np.round(np.expm1(value('booking_actual_cost_distance')), 2),
+                'actual_cost_time': np.round(np.expm1(value('booking_actual_cost_time')), 2),
+                'actual_revenue': np.round(np.expm1(value('booking_actual_cost_total')), 2),
+                'booking_rates_hours': np.round(value('booking_rates_hours'), 2),
+                'booking_rates_24hours': np.round(value('booking_rates_24hours'), 2)
+            }
+        })
 
-        # drop target variables
-        vehicle_data = vehicle_data.drop(['hourly_rate', 'daily_rate'], axis=1)
+    return features
 
-        try:
-            # booking_actual_cost_distance
-            booking_actual_cost_distance = np.round(vehicle_data_copy['booking_actual_cost_distance'].values[-1], 2)
 
-            # booking_actual_cost_time
-            booking_actual_cost_time = np.round(vehicle_data_copy['booking_actual_cost_time'].values[-1], 2)
+@timed('predict_rates')
+def predict_rates_batch(items):
+    '''Predict hourly_rate and daily_rate for many (dataframe, location) items, with one predict call per vehicle type model'''
+    registry = get_registry()
 
-            # booking_actual_cost_total
-            booking_actual_cost_total = np.round(vehicle_data_copy['booking_actual_cost_total'].values[-1], 2)
+    # Collect the latest bookings of every location by vehicle type
+    features = {location: prepare_features(dataframe, location) for dataframe, location in items}
+    by_vehicle = dict()
+    for location_features in features.values():
+        for feature in location_features:
+            by_vehicle.setdefault(feature['vehicle_type'], []).append(feature)
 
-            # booking_rates_hours
-            booking_rates_hours = np.round(vehicle_data_copy['booking_rates_hours'].values[-1], 2)
+    engine = registry.get_engine()
+    for vehicle_type, vehicle_features in by_vehicle.items():
+        if vehicle_type not in engine:
+            print(f"Error loading model {vehicle_type.replace('Vehicle Type_', '')}: not in registry")
+            continue
 
-            # booking_rates_24hours
-            booking_rates_24hours = np.round(vehicle_data_copy['booking_rates_24hours'].values[-1], 2)
+        vehicle_data = pd.concat([feature['X'] for feature in vehicle_features], axis=0)
+        try:
+            # one call for every row of the vehicle type, see utils/serving.py
+            start = time.perf_counter()
+            pred_hourly, pred_daily = engine.predict(vehicle_type, vehicle_data)
+            observe('pricing_model_seconds', time.perf_counter() - start, vehicle_type=vehicle_type.replace('Vehicle Type_', ''))
+        except ValueError as e:
+            print(f"Error predicting rates for {vehicle_type.replace('Vehicle Type_', '')}: {e}")
+            continue
+        pred_hourly = pred_hourly.tolist()
+        pred_daily = pred_daily.tolist()
 
-            # hourly_rate
-            hourly_rate = vehicle_data_copy['hourly_rate'].values[-1]
+        for feature, hourly, daily in zip(vehicle_features, pred_hourly, pred_daily):
+            feature['row']['predicted_hourly'] = np.round(hourly, 2)
+            feature['row']['predicted_daily'] = np.round(daily, 2)
 
-            # daily_rate
-            daily_rate = vehicle_data_copy['daily_rate'].values[-1]
+    columns = ['vehicle_type', 'location', 'hourly_rate', 'daily_rate', 'predicted_hourly', 'predicted_daily',
+               'actual_cost_distance', 'actual_cost_time', 'actual_revenue', 'booking_rates_hours', 'booking_rates_24hours']
+    predictions = dict()
+    for location, location_features in features.items():
+        rows = [feature['row'] for feature in location_features if 'predicted_hourly' in feature['row']]
+        predictions_df = pd.DataFrame(rows, columns=columns) if rows else pd.DataFrame()
+        predictions[location] = predictions_df
 
-        except IndexError as e:
-            print(f"Error processing vehicle type {vehicle_type}: {e}")
-            continue
+    return predictions
 
-        if 'City' in vehicle_type or '7 Seater' in vehicle_type:
-            try:
-                scaler = joblib.load(ENCODERS_PATH + f'scaler_{vehicle_type}.pkl')
-                model_hourly = keras.models.load_model(MODEL_PATH + f'{vehicle_type.replace("Vehicle Type_", "")}_nn_hourly_rate_model.keras')
-                model_daily = keras.models.load_model(MODEL_PATH + f'{vehicle_type.replace("Vehicle Type_", "")}_nn_daily_rate_model.keras')
-
-                try:
-                    X = scaler.transform(vehicle_data)
-                except ValueError as e:
-                    print(f"Error scaling for {vehicle_type.replace('Vehicle Type_', '')}: {e}")
-                    continue
-            except ValueError as e:
-                print(f"Error loading model {vehicle_type.replace('Vehicle Type_', '')}: {e}")
-                continue
-        elif 'Everyday' in vehicle_type or 'Van' in vehicle_type:
-            try:
-                model_hourly = joblib.load(MODEL_PATH + f'{vehicle_type.replace("Vehicle Type_", "")}_xgb_hourly_rate_model.pkl')
-                model_daily = joblib.load(MODEL_PATH + f'{vehicle_type.replace("Vehicle Type_", "")}_xgb_daily_rate_model.pkl')
-
-                X = vehicle_data.values
-            except ValueError as e:
-                print(f"Error loading model {vehicle_type.replace('Vehicle Type_', '')}: {e}")
-                continue
-        elif 'Family' in vehicle_type:
-            try:
-                model_hourly = joblib.load(MODEL_PATH + f'{vehicle_type.replace("Vehicle Type_", "")}_xgb_hourly_rate_model.pkl')
-                model_daily = joblib.load(MODEL_PATH + f'{vehicle_type.replace("Vehicle Type_", "")}_dt_daily_rate_model.pkl')
-
-                X = vehicle_data.values
-            except ValueError as e:
-                print(f"Error loading model {vehicle_type.replace('Vehicle Type_', '')}: {e}")
-                continue
-
-        # check if model_hourly and model_daily not None and X is not empty list
-        if model_hourly is None or model_daily is None or X is None:
-            continue
 
-        X = X[-1].reshape(1, 47)
-
-        # predictions
-        pred_hourly = model_hourly.predict(X).tolist()[0]
-        pred_daily = model_daily.predict(X).tolist()[0]
-
-        while type(pred_hourly) != float:
-            pred_hourly = pred_hourly[0]
-
-        while type(pred_daily) != float:
-            pred_daily = pred_daily[0]
-
-        # Add predictions to the dataframe
-        temp_df = pd.DataFrame({
-            'vehicle_type': [vehicle_type.replace('Vehicle Type_', '')],
-            'location': [location],
-            'hourly_rate': [hourly_rate],
-            'daily_rate': [daily_rate],
-            'predicted_hourly': [np.round(pred_hourly, 2)],
-            'predicted_daily': [np.round(pred_daily, 2)],
-            'actual_cost_distance': [booking_actual_cost_distance],
-            'actual_cost_time': [booking_actual_cost_time],
-            'actual_revenue': [booking_actual_cost_total],
-            'booking_rates_hours': [booking_rates_hours],
-            'booking_rates_24hours': [booking_rates_24hours]
-        })
+def predict_rates(dataframe, location):
+    '''Predict hourly_rate and daily_rate for each vehicle types and for location'''
+    return predict_rates_batch([(dataframe, location)])[location]
 
-        predictions_df = pd.concat([predictions_df, temp_df], axis=0, ignore_index=True)
 
-    return predictions_df
+def booking_counts(historical_data):
+    '''Number of bookings for each location and booking_created_at_hour'''
+    return historical_data.groupby(['location', 'booking_created_at_hour'], observed=True).size()
 
 
-def popular_location_demand_factor(historical_data, location):
+def popular_location_demand_factor(historical_data, location, counts=None):
     '''Function for popular location based demand factor'''
     # Calculate the number of bookings for each location
-    demand_location = historical_data.groupby('location').size()
+    if counts is None:
+        demand_location = historical_data.groupby('location', observed=True).size()
+    else:
+        demand_location = counts.groupby(level='location', observed=True).sum()
     demand_location = pd.DataFrame(demand_location, columns=['bookings'])
 
     if location not in demand_location.index:
@@ -535,17 +545,23 @@ def popular_location_demand_factor(historical_data, location):
         return 0
 
 
-def peak_hour_demand_factor(historical_data, location, hour):
+def peak_hour_demand_factor(historical_data, location, hour, counts=None):
     '''function for peak hour demand factor'''
-    # select subset of data based on location
-    location_data = historical_data[historical_data['location'] == location]
-
-    if location_data.empty:
-        return 0
-
     # seperate hourly bookings with location
     # Aggregate bookings by hour
-    hourly_bookings = location_data.groupby('booking_created_at_hour').size()
+    if counts is None:
+        # select subset of data based on location
+        location_data = historical_data[historical_data['location'] == location]
+
+        if location_data.empty:
+            return 0
+
+        hourly_bookings = location_data.groupby('booking_created_at_hour').size()
+    else:
+        if location not in counts.index.get_level_values('location'):
+            return 0
+
+        hourly_bookings = counts.xs(location, level='location')
     hourly_bookings = pd.DataFrame(hourly_bookings, columns=['bookings'])
 
     # Identify peak hours
@@ -561,22 +577,28 @@ def peak_hour_demand_factor(historical_data, location, hour):
         return 0, peak_hours
 
 
-def demand_factor(historical_data, location, hour):
-    '''function for demand factor'''
-    hour_demand_factor, peak_hours = peak_hour_demand_factor(historical_data, location, hour)
-    location_demand_factor = popular_location_demand_factor(historical_data, location)
+@timed('demand_factor')
+def demand_factor(historical_data, location, hour, counts=None, index=None):
+    '''function for demand factor, counts are precomputed booking_counts and index a DemandIndex of the full history'''
+    if index is not None:
+        return index.lookup(location, hour)
+    hour_demand_factor, peak_hours = peak_hour_demand_factor(historical_data, location, hour, counts=counts)
+    location_demand_factor = popular_location_demand_factor(historical_data, location, counts=counts)
     final_demand_factor = np.round(np.mean([hour_demand_factor, location_demand_factor]), 5)
     return final_demand_factor, peak_hours
 
-def get_average_rates(df, location):
-    '''A function to get average rates for location and vehicle type'''
-    grouped_averages = df.groupby(['location', 'Vehicle Type']).agg({'hourly_rate': 'mean', 'daily_rate': 'mean'})
+@timed('get_average_rates')
+def get_average_rates(df, location, averages=None):
+    '''A function to get average rates for location and vehicle type, averages are precomputed for the whole history'''
+    if averages is not None:
+        return averages[averages['location'] == location]
+    grouped_averages = df.groupby(['location', 'Vehicle Type'], observed=True).agg({'hourly_rate': 'mean', 'daily_rate': 'mean'})
     grouped_averages.reset_index(inplace=True)
     grouped_averages = grouped_averages[grouped_averages['location'] == location]
     return grouped_averages
 
-def adjust_prices(row, grouped_averages):
-    '''A function to adjust prices'''
+def adjust_prices(row, grouped_averages, cap_threshold=50, cap_increase=10):
+    '''A function to adjust prices, rates above the average plus cap_threshold% are capped at the average plus cap_increase%'''
     if row['adjusted_revenue'] < row['actual_revenue']:
         row['final_hourly_rate'] = row['hourly_rate']
         row['final_daily_rate'] = row['daily_rate']
@@ -584,10 +606,10 @@ def adjust_prices(row, grouped_averages):
         grouped_vehicle = grouped_averages[grouped_averages['Vehicle Type'] == row['vehicle_type']]
         hourly_rate = grouped_vehicle['hourly_rate'].values[0]
         daily_rate = grouped_vehicle['daily_rate'].values[0]
-        hourly_rate_50 = hourly_rate + (hourly_rate * 50 / 100)
-        daily_rate_50 = daily_rate + (daily_rate * 50 / 100)
-        hourly_rate_10 = hourly_rate + (hourly_rate * 10 / 100)
-        daily_rate_10 = daily_rate + (daily_rate * 10 / 100)
+        hourly_rate_50 = hourly_rate + (hourly_rate * cap_threshold / 100)
+        daily_rate_50 = daily_rate + (daily_rate * cap_threshold / 100)
+        hourly_rate_10 = hourly_rate + (hourly_rate * cap_increase / 100)
+        daily_rate_10 = daily_rate + (daily_rate * cap_increase / 100)
         if row['adjusted_hourly'] > hourly_rate_50:
             row['final_hourly_rate'] = hourly_rate_10
         else:
@@ -599,15 +621,14 @@ def adjust_prices(row, grouped_averages):
             row['final_daily_rate'] = row['adjusted_daily']
     return row
 
-def apply_dynamic_pricing_strategy(predictions_df, demand_factor_value=None):
+@timed('apply_dynamic_pricing_strategy')
+def apply_dynamic_pricing_strategy(predictions_df, demand_factor_value=None, demand_weight=1):
+    '''Adjusted rates and revenue from the predicted rates, demand_weight scales the demand factor'''
     if demand_factor_value == None:
-        # Use dynamic pricing formula for hourly_rate and daily_rate
-        predictions_df['adjusted_hourly'] = np.round(predictions_df['predicted_hourly'] + (predictions_df['demand_factor_value'] * predictions_df['predicted_hourly']), 2)
-        predictions_df['adjusted_daily'] = np.round(predictions_df['predicted_daily'] + (predictions_df['demand_factor_value'] * predictions_df['predicted_daily']), 2)
-    else:
-        # Use dynamic pricing formula for hourly_rate and daily_rate
-        predictions_df['adjusted_hourly'] = np.round(predictions_df['predicted_hourly'] + (demand_factor_value * predictions_df['predicted_hourly']), 2)
-        predictions_df['adjusted_daily'] = np.round(predictions_df['predicted_daily'] + (demand_factor_value * predictions_df['predicted_daily']), 2)
+        demand_factor_value = predictions_df['demand_factor_value']
+    # Use dynamic pricing formula for hourly_rate and daily_rate
+    predictions_df['adjusted_hourly'] = np.round(predictions_df['predicted_hourly'] + (demand_weight * demand_factor_value * predictions_df['predicted_hourly']), 2)
+    predictions_df['adjusted_daily'] = np.round(predictions_df['predicted_daily'] + (demand_weight * demand_factor_value * predictions_df['predicted_daily']), 2)
 
     # Calculate booking adjusted cost time
     predictions_df['adjusted_cost_time'] = np.round((predictions_df['booking_rates_hours'] * predictions_df['adjusted_hourly']) + (predictions_df['booking_rates_24hours'] * predictions_df['adjusted_daily']), 2)
@@ -631,47 +652,14 @@ def load_preprocessed_data(filename='2024 Bookings.csv'):
     return scaled_df, df
 
 
+@timed('calculate_profitability')
 def calculate_profitability(df, location, predictions_df):
-    # Inverse log transform
-    df = inverse_transform_data(df)
+    '''Actual and adjusted revenue of the last month of bookings of location for each vehicle type, df is not modified'''
+    # subset with location in the last month, sorted by booking_billed_start
+    filtered_df = last_month(df, location).sort_values(by='booking_billed_start', kind='stable')
 
-    # sort values and reset index
-    df = df.sort_values(by='booking_billed_start')
-    df.reset_index(drop=True, inplace=True)
-    
-    # subset with location
-    filtered_df = df[df['location'] == location]
-
-    # Find the latest date in the booking_billed_start column
-    latest_date = filtered_df['booking_billed_start'].max()
-
-    # Calculate the date one month before the latest date
-    one_month_ago = latest_date - pd.DateOffset(months=1)
-
-    # Filter the dataframe to include only rows from the last one month
-    filtered_df = filtered_df[filtered_df['booking_billed_start'] >= one_month_ago]
-    filtered_df.reset_index(drop=True, inplace=True)
-    filtered_df['demand_factor_value'] = filtered_df.apply(lambda row: demand_factor(df, 'Newcastle', row['booking_created_at_hour']), axis=1)
-    # Extracting the demand_factor_value
-    filtered_df['demand_factor_value'] = filtered_df.apply(lambda row: row['demand_factor_value'][0] if isinstance(row['demand_factor_value'], tuple) else row['demand_factor_value'], axis=1)
-
-    # aggregate vital columns
-    predictions_df_group = predictions_df.groupby('vehicle_type').agg({
-        'current_hourly_rate': 'first',
-        'current_daily_rate': 'first',
-        'adjusted_hourly_rate': 'first',
-        'adjusted_daily_rate': 'first'
-    }).reset_index()
-
-    df_merged = pd.merge(filtered_df, predictions_df_group, left_on='Vehicle Type', right_on='vehicle_type', how='left')
-
-    df_merged.rename(columns={'booking_actual_cost_distance': 'actual_cost_distance'}, inplace=True)
-    # Calculate revenue for the actual values
-    df_merged['actual_revenue'] = df_merged['booking_actual_cost_total']
-
-    # Calculate booking adjusted cost time
-    df_merged['adjusted_cost_time'] = np.round((df_merged['booking_rates_hours'] * df_merged['adjusted_hourly_rate']) + (df_merged['booking_rates_24hours'] * df_merged['adjusted_daily_rate']), 2)
-    df_merged['adjusted_revenue'] = np.round(df_merged['adjusted_cost_time'] + df_merged['actual_cost_distance'], 2)
+    # Revenue of every booking with the adjusted rates of its vehicle type (see utils/backtest.py)
+    df_merged = booking_revenue(filtered_df, predictions_df.assign(location=location))
 
     df_merged_revenue = df_merged.groupby('vehicle_type').agg({
         'actual_revenue' : 'sum',
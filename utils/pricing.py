@@ -0,0 +1,137 @@
+from utils.model import demand_factor, apply_dynamic_pricing_strategy, get_average_rates, calculate_profitability, \
+    predict_rates_batch
+from utils.feature_store import load_location_data, load_demand_index, load_rate_averages
+from utils.rules import apply_rules
+from utils.metrics import timed
+
+# Pricing policy of the API: full demand factor and the cap of the location rules (see utils/rules.py)
+DEFAULT_POLICY = {'demand_weight': 1, 'cap_threshold': None, 'cap_increase': None}
+# Locations predicted together by price_batch, one predict call per vehicle type model for all of them
+BATCH_LOCATIONS = 4
+
+
+@timed('build_response')
+def build_response(location, hour_of_the_day, predictions_df, df, demand_index, rate_averages=None, policy=None):
+    '''Adjusted rates and revenue comparison of a location at an hour from its rate predictions'''
+    policy = {**DEFAULT_POLICY, **(policy or {})}
+    # apply_dynamic_pricing_strategy modifies its input
+    predictions_df = predictions_df.copy()
+
+    demand_factor_value, peak_hours = demand_factor(df, location, hour_of_the_day, index=demand_index)
+
+    predictions_df = apply_dynamic_pricing_strategy(predictions_df, demand_factor_value, demand_weight=policy['demand_weight'])
+
+    # adjust final prices
+    grouped_averages = get_average_rates(df, location, averages=rate_averages)
+    predictions_df = apply_rules(predictions_df, grouped_averages, policy)
+    predictions_df.rename(columns={'hourly_rate': 'current_hourly_rate',
+                                   'daily_rate': 'current_daily_rate', 'final_hourly_rate': 'adjusted_hourly_rate',
+                                   'final_daily_rate': 'adjusted_daily_rate'}, inplace=True)
+    predictions = dict()
+
+    # store all values of predictions_df in predictions dict
+    for index, row in predictions_df.iterrows():
+        predictions[row['vehicle_type']] = {
+            'current_hourly_rate': row['current_hourly_rate'],
+            'current_daily_rate': row['current_daily_rate'],
+            'adjusted_hourly_rate': row['adjusted_hourly_rate'],
+            'adjusted_daily_rate': row['adjusted_daily_rate']
+        }
+
+    # Predict demand_factor for Profitability Calculation
+    df_merged_revenue = calculate_profitability(df, location, predictions_df)
+
+    profitability = dict()
+
+    # store all values of predictions_df in predictions dict
+    for index, row in df_merged_revenue.iterrows():
+        profitability[row['vehicle_type']] = {
+            'adjusted_revenue': row['adjusted_revenue'],
+            'actual_revenue': row['actual_revenue'],
+            'profitability': row['profitability']
+        }
+
+    # Initialize sums
+    total_adjusted_revenue = 0
+    total_actual_revenue = 0
+    total_profitability = 0
+
+    # Iterate through the dictionary and sum up the values
+    for key, value in profitability.items():
+        total_adjusted_revenue += value['adjusted_revenue']
+        total_actual_revenue += value['actual_revenue']
+        total_profitability += value['profitability']
+
+    # Add the new key with summed values
+    profitability['Z'] = {
+        'adjusted_revenue': total_adjusted_revenue,
+        'actual_revenue': total_actual_revenue,
+        'profitability': total_profitability
+    }
+
+    return {'peakHours': peak_hours, 'predictions': predictions, 'profitability': profitability}
+
+
+@timed('price_location')
+def price_location(location, hour_of_the_day):
+    '''Adjusted rates and revenue comparison of one location at one hour'''
+    scaled_df, df = load_location_data(location)
+    predictions_df = predict_rates_batch([(scaled_df, location)])[location]
+    return build_response(location, hour_of_the_day, predictions_df, df, load_demand_index(), load_rate_averages())
+
+
+def price_batch(pairs, cache=None):
+    '''Yield (location, hour_of_the_day, response or error) for many pairs, grouped by location
+
+    Locations are loaded and predicted BATCH_LOCATIONS at a time, so the first rows are yielded before the other
+    locations are read.
+    '''
+    if cache is not None:
+        # cached pairs are returned straight away, the rest is priced together
+        missing = []
+        for location, hour_of_the_day in pairs:
+            response = cache.get(location, hour_of_the_day)
+            if response is None:
+                missing.append((location, hour_of_the_day))
+            else:
+                yield location, hour_of_the_day, response
+        for location, hour_of_the_day, response in price_batch(missing):
+            if 'error' not in response:
+                cache.set(location, hour_of_the_day, response)
+            yield location, hour_of_the_day, response
+        return
+
+    if not pairs:
+        return
+    demand_index = load_demand_index()
+    rate_averages = load_rate_averages()
+
+    # hours of every location, in the order the locations first appear
+    hours = dict()
+    for location, hour_of_the_day in pairs:
+        hours.setdefault(location, []).append(hour_of_the_day)
+    locations = list(hours)
+
+    for start in range(0, len(locations), BATCH_LOCATIONS):
+        data = dict()
+        errors = dict()
+        for location in locations[start:start + BATCH_LOCATIONS]:
+            try:
+                data[location] = load_location_data(location)
+            except FileNotFoundError:
+                errors[location] = f'Unknown location {location}'
+
+        predictions = predict_rates_batch([(scaled_df, location) for location, (scaled_df, df) in data.items()])
+
+        for location in locations[start:start + BATCH_LOCATIONS]:
+            for hour_of_the_day in hours[location]:
+                if location in errors:
+                    yield location, hour_of_the_day, {'error': errors[location]}
+                    continue
+                try:
+                    response = build_response(location, hour_of_the_day, predictions[location], data[location][1],
+                                              demand_index, rate_averages)
+                except Exception as e:
+                    # a streamed response has already started, report the failure on its own line
+                    response = {'error': f'Error pricing {location}: {e}'}
+                yield location, hour_of_the_day, response
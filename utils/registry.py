@@ -0,0 +1,231 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+import joblib
+from utils.serving import ServingEngine, make_predictor
+from utils.metrics import timed
+
+# Encoders location
+ENCODERS_PATH = "encoders/"
+# Model location
+MODEL_PATH = "models/"
+
+# Model family used for the hourly and daily rate model of each vehicle type
+VEHICLE_MODELS = {
+    'City': ('nn', 'nn'),
+    '7 Seater': ('nn', 'nn'),
+    'Everyday': ('xgb', 'xgb'),
+    'Van': ('xgb', 'xgb'),
+    'Family': ('xgb', 'dt'),
+}
+
+
+# Families, files and validation errors of models written by python -m utils.train
+MANIFEST_FILE = 'manifest.json'
+
+
+def model_filename(vehicle, family, target, release=None):
+    '''file name of a rate model inside MODEL_PATH, models published by python -m utils.train carry their release'''
+    extension = 'keras' if family == 'nn' else 'pkl'
+    suffix = f'.{release}' if release else ''
+    return f'{vehicle}_{family}_{target}_rate_model{suffix}.{extension}'
+
+
+def scaler_filename(vehicle, release=None):
+    '''file name of the scaler of a vehicle type inside ENCODERS_PATH'''
+    suffix = f'.{release}' if release else ''
+    return f'scaler_Vehicle Type_{vehicle}{suffix}.pkl'
+
+
+def read_manifest(model_path=MODEL_PATH):
+    '''training manifest of model_path, None when the models were placed by hand'''
+    path = os.path.join(model_path, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        return json.load(file)
+
+
+def manifest_models(model_path=MODEL_PATH):
+    '''manifest entry (scaler, hourly and daily family and file) of every vehicle type, VEHICLE_MODELS without a manifest'''
+    manifest = read_manifest(model_path)
+    if manifest is None:
+        return {vehicle: {'scaler': scaler_filename(vehicle) if hourly_family == 'nn' else None,
+                          'hourly': {'family': hourly_family, 'file': model_filename(vehicle, hourly_family, 'hourly')},
+                          'daily': {'family': daily_family, 'file': model_filename(vehicle, daily_family, 'daily')}}
+                for vehicle, (hourly_family, daily_family) in VEHICLE_MODELS.items()}
+    return manifest['models']
+
+
+def vehicle_models(model_path=MODEL_PATH):
+    '''(hourly family, daily family, scaler file or None) of every vehicle type, from the manifest when there is one'''
+    return {vehicle: (entry['hourly']['family'], entry['daily']['family'], entry.get('scaler'))
+            for vehicle, entry in manifest_models(model_path).items()}
+
+
+def model_files(model_path=MODEL_PATH):
+    '''mtime of the manifest, or of every file in model_path for models placed by hand
+
+    python -m utils.train writes the manifest after every file of a release, so its models are only loaded whole.
+    '''
+    manifest = os.path.join(model_path, MANIFEST_FILE)
+    if os.path.exists(manifest):
+        return {MANIFEST_FILE: os.path.getmtime(manifest)}
+    mtimes = {}
+    for filename in os.listdir(model_path):
+        path = os.path.join(model_path, filename)
+        if os.path.isfile(path):
+            mtimes[filename] = os.path.getmtime(path)
+    return mtimes
+
+
+def load_model(path):
+    '''load a keras or pickled rate model'''
+    if path.endswith('.keras'):
+        # TensorFlow is only imported when a Keras model is loaded
+        import keras
+        # Keras unpacks the weights next to the file it loads, a private copy keeps concurrent loads apart
+        tmp_path = tempfile.mkdtemp(prefix='pricing_model_')
+        try:
+            shutil.copyfile(path, os.path.join(tmp_path, os.path.basename(path)))
+            return keras.models.load_model(os.path.join(tmp_path, os.path.basename(path)))
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+    return joblib.load(path)
+
+
+class ModelRegistry:
+    '''Process-wide store of rate models, scalers and encoders, loaded once and shared across threads'''
+
+    def __init__(self, model_path=MODEL_PATH, encoders_path=ENCODERS_PATH):
+        self.model_path = model_path
+        self.encoders_path = encoders_path
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._mtimes = {}
+        self._watcher = None
+        self._stop = threading.Event()
+
+    def _model_files(self):
+        return model_files(self.model_path)
+
+    @timed('load_models')
+    def _build(self):
+        '''read every model, scaler and encoder from disk into a new snapshot'''
+        # imported here, utils.encoders imports utils.model
+        from utils.encoders import load_encoders
+        encoders = load_encoders(self.encoders_path)
+
+        models = dict()
+        predictors = dict()
+        # one read of the manifest, so the files of every vehicle type come from the same release
+        for vehicle, entry in manifest_models(self.model_path).items():
+            scaler = None
+            if entry.get('scaler') is not None:
+                scaler = joblib.load(self.encoders_path + entry['scaler'])
+            path_hourly = self.model_path + entry['hourly']['file']
+            path_daily = self.model_path + entry['daily']['file']
+            try:
+                model_hourly = load_model(path_hourly)
+                model_daily = load_model(path_daily)
+            except (OSError, ValueError) as e:
+                print(f"Error loading model {vehicle}: {e}")
+                continue
+            models[vehicle] = (model_hourly, model_daily, scaler)
+            predictors[vehicle] = (make_predictor(model_hourly, path_hourly), make_predictor(model_daily, path_daily), scaler)
+
+        return {'encoders': encoders, 'models': models, 'engine': ServingEngine(predictors)}
+
+    def _warm_up(self, snapshot):
+        '''run one dummy prediction through every model so the first request does not pay for graph building'''
+        for vehicle, (model_hourly, model_daily, scaler) in snapshot['models'].items():
+            if scaler is not None:
+                X = pd.DataFrame(np.zeros((1, scaler.n_features_in_)), columns=scaler.feature_names_in_)
+            else:
+                X = np.zeros((1, model_hourly.n_features_in_))
+            snapshot['engine'].predict(vehicle, X)
+
+    def load(self, warm_up=True):
+        '''load (or reload) everything and atomically swap it in'''
+        mtimes = self._model_files()
+        snapshot = self._build()
+        if warm_up:
+            self._warm_up(snapshot)
+        with self._lock:
+            self._snapshot = snapshot
+            self._mtimes = mtimes
+        return self
+
+    def _current(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    mtimes = self._model_files()
+                    snapshot = self._build()
+                    self._warm_up(snapshot)
+                    self._snapshot = snapshot
+                    self._mtimes = mtimes
+                snapshot = self._snapshot
+        return snapshot
+
+    def get_encoders(self):
+        '''return the LookupEncoder compiled from the binary and one hot encoders'''
+        return self._current()['encoders']
+
+    def get_models(self, vehicle):
+        '''return model_hourly, model_daily, scaler of a vehicle type, or None if not loaded'''
+        return self._current()['models'].get(vehicle.replace('Vehicle Type_', ''))
+
+    def get_engine(self):
+        '''return the ServingEngine of the loaded models'''
+        return self._current()['engine']
+
+    def reload_if_changed(self):
+        '''reload when the manifest, or without one a file in MODEL_PATH, was added, removed or modified'''
+        if self._model_files() != self._mtimes:
+            self.load()
+            return True
+        return False
+
+    def start_watcher(self, interval=5.0):
+        '''poll MODEL_PATH in a daemon thread and hot-reload on changes'''
+        if self._watcher is not None:
+            return self._watcher
+
+        def watch():
+            while not self._stop.wait(interval):
+                try:
+                    self.reload_if_changed()
+                except Exception as e:
+                    # keep serving the previous snapshot if the new files are incomplete
+                    print(f"Error reloading models: {e}")
+
+        self._watcher = threading.Thread(target=watch, name='model-registry-watcher', daemon=True)
+        self._watcher.start()
+        return self._watcher
+
+    def stop_watcher(self):
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join()
+        self._watcher = None
+        self._stop.clear()
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    '''return the process-wide model registry'''
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ModelRegistry()
+    return _registry
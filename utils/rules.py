@@ -0,0 +1,122 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from utils.metrics import timed
+
+# JSON file of per location rules {"Glasgow": [{"type": "cap_above_average", ...}, ...]} (DEFAULT_RULES when unset)
+RULES_PATH = os.environ.get('PRICING_RULES_PATH')
+
+# Guardrails applied in order to the adjusted rates, the same as adjust_prices
+DEFAULT_RULES = [
+    # rates more than threshold% above the location average of the vehicle type are capped at the average + increase%
+    {'type': 'cap_above_average', 'threshold': 50, 'increase': 10},
+    # keep the current rates when the adjusted rates would earn less than the actual revenue
+    {'type': 'keep_current_if_revenue_drops'},
+]
+
+RATES = ['hourly', 'daily']
+
+
+def cap_above_average(frame, final, mask, rule):
+    '''cap rates above the average plus threshold% at the average plus increase%'''
+    for rate in RATES:
+        average = frame[f'average_{rate}_rate']
+        cap = average + (average * rule['threshold'] / 100)
+        capped = average + (average * rule['increase'] / 100)
+        over = mask & (final[rate] > cap)
+        final[rate] = np.where(over, capped, final[rate])
+
+
+def keep_current_if_revenue_drops(frame, final, mask, rule):
+    '''keep the current rates of rows whose adjusted revenue is below the actual revenue'''
+    drops = mask & (frame['adjusted_revenue'] < frame['actual_revenue'])
+    for rate in RATES:
+        final[rate] = np.where(drops, frame[f'{rate}_rate'], final[rate])
+
+
+def limit_change(frame, final, mask, rule):
+    '''keep the rates within down% below and up% above the current rates'''
+    for rate in RATES:
+        current = frame[f'{rate}_rate']
+        limited = np.clip(final[rate], current - (current * rule.get('down', 100) / 100),
+                          current + (current * rule.get('up', np.inf) / 100))
+        final[rate] = np.where(mask, limited, final[rate])
+
+
+RULE_TYPES = {
+    'cap_above_average': cap_above_average,
+    'keep_current_if_revenue_drops': keep_current_if_revenue_drops,
+    'limit_change': limit_change,
+}
+
+
+_location_rules = (None, None)
+
+
+def load_location_rules(path=None):
+    '''rules of each location from the JSON file at path, kept in memory until the file changes'''
+    global _location_rules
+    path = path or RULES_PATH
+    if path is None:
+        return dict()
+    mtime = os.path.getmtime(path)
+    if _location_rules[0] != (path, mtime):
+        with open(path) as file:
+            location_rules = json.load(file)
+        for rules in location_rules.values():
+            for rule in rules:
+                if rule['type'] not in RULE_TYPES:
+                    raise ValueError(f"Unknown pricing rule {rule['type']} in {path}")
+        _location_rules = ((path, mtime), location_rules)
+    return _location_rules[1]
+
+
+def rules_for(location, policy=None):
+    '''rules of a location, cap_threshold and cap_increase of a policy replace the parameters of its cap'''
+    rules = [dict(rule) for rule in load_location_rules().get(location, DEFAULT_RULES)]
+    for rule in rules:
+        if rule['type'] == 'cap_above_average' and policy:
+            if policy.get('cap_threshold') is not None:
+                rule['threshold'] = policy['cap_threshold']
+            if policy.get('cap_increase') is not None:
+                rule['increase'] = policy['cap_increase']
+    return rules
+
+
+@timed('apply_rules')
+def apply_rules(predictions_df, averages, policy=None):
+    '''Add final_hourly_rate and final_daily_rate to predictions_df with the rules of each location on whole columns
+
+    predictions_df has location, vehicle_type, the current hourly_rate and daily_rate, adjusted_hourly, adjusted_daily,
+    adjusted_revenue and actual_revenue, for any number of locations. averages has the location, Vehicle Type, hourly_rate
+    and daily_rate columns of get_average_rates.
+    '''
+    frame = {column: predictions_df[column].to_numpy(dtype=float) for column in
+             ['hourly_rate', 'daily_rate', 'adjusted_revenue', 'actual_revenue']}
+
+    # Average rates of the location and vehicle type of every row
+    table = averages.set_index([averages['location'].astype(object), averages['Vehicle Type'].astype(object)])
+    positions = table.index.get_indexer(pd.MultiIndex.from_arrays([predictions_df['location'].astype(object),
+                                                                    predictions_df['vehicle_type'].astype(object)]))
+    for rate in RATES:
+        frame[f'average_{rate}_rate'] = np.where(positions >= 0, table[f'{rate}_rate'].to_numpy()[positions], np.nan)
+
+    final = {rate: predictions_df[f'adjusted_{rate}'].to_numpy(dtype=float) for rate in RATES}
+
+    # Locations sharing the same rules are handled together
+    locations = predictions_df['location'].astype(object).to_numpy()
+    groups = dict()
+    for location in pd.unique(locations):
+        rules = rules_for(location, policy)
+        groups.setdefault(json.dumps(rules, sort_keys=True), (rules, []))[1].append(location)
+    for rules, group in groups.values():
+        mask = np.isin(locations, group)
+        for rule in rules:
+            RULE_TYPES[rule['type']](frame, final, mask, rule)
+
+    # rows whose revenues cannot be compared get no final rates
+    comparable = ~(np.isnan(frame['adjusted_revenue']) | np.isnan(frame['actual_revenue']))
+    predictions_df['final_hourly_rate'] = np.where(comparable, final['hourly'], np.nan)
+    predictions_df['final_daily_rate'] = np.where(comparable, final['daily'], np.nan)
+    return predictions_df
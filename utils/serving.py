@@ -0,0 +1,268 @@
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+# Backend of the rate models: native (tf.function, Booster.inplace_predict, tree arrays), onnx or treelite
+SERVING_BACKEND = os.environ.get('SERVING_BACKEND', 'native')
+# Milliseconds a prediction waits for predictions of other threads to share one model call, 0 disables batching
+SERVING_BATCH_WAIT = float(os.environ.get('SERVING_BATCH_WAIT', '0'))
+# Largest batch of rows merged across threads
+SERVING_MAX_BATCH = 256
+
+
+class KerasPredictor:
+    '''Keras model called through a traced tf.function instead of model.predict'''
+
+    def __init__(self, model):
+        import tensorflow as tf
+        self.model = model
+        signature = [tf.TensorSpec([None, model.input_shape[-1]], tf.float32)]
+        self._call = tf.function(lambda X: model(X, training=False), input_signature=signature)
+
+    def predict(self, X):
+        return self._call(np.asarray(X, dtype=np.float32)).numpy().ravel()
+
+
+class XGBPredictor:
+    '''XGBoost model predicted with inplace_predict on its cached Booster'''
+
+    def __init__(self, model):
+        self.booster = model.get_booster()
+        try:
+            # same trees as XGBRegressor.predict when trained with early stopping
+            self.iteration_range = (0, model.best_iteration + 1)
+        except AttributeError:
+            self.iteration_range = (0, 0)
+
+    def predict(self, X):
+        return self.booster.inplace_predict(np.asarray(X, dtype=np.float64), iteration_range=self.iteration_range).ravel()
+
+
+class TreePredictor:
+    '''scikit-learn decision tree read from its tree arrays, without input validation'''
+
+    def __init__(self, model):
+        self.tree = model.tree_
+
+    def predict(self, X):
+        return self.tree.predict(np.asarray(X, dtype=np.float32)).ravel()
+
+
+class ModelPredictor:
+    '''any other model with a predict method'''
+
+    def __init__(self, model):
+        self.model = model
+
+    def predict(self, X):
+        return np.ravel(self.model.predict(np.asarray(X)))
+
+
+class OnnxPredictor:
+    '''model exported with export_onnx, run by onnxruntime'''
+
+    def __init__(self, path):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict(self, X):
+        return self.session.run(None, {self.input_name: np.asarray(X, dtype=np.float32)})[0].ravel()
+
+
+class TreelitePredictor:
+    '''XGBoost model run by the Treelite CPU predictor'''
+
+    def __init__(self, model):
+        import treelite
+        self.model = treelite.frontend.from_xgboost(model.get_booster())
+        self.gtil = treelite.gtil
+
+    def predict(self, X):
+        return self.gtil.predict(self.model, np.asarray(X, dtype=np.float32)).ravel()
+
+
+def is_keras(model):
+    return hasattr(model, 'layers') and hasattr(model, 'input_shape')
+
+
+def onnx_path(path):
+    '''ONNX file exported next to a model file'''
+    return os.path.splitext(path)[0] + '.onnx'
+
+
+def make_predictor(model, path, backend=SERVING_BACKEND):
+    '''predictor of a loaded model for backend, falling back to native when the backend cannot run it'''
+    try:
+        if backend == 'onnx' and os.path.exists(onnx_path(path)):
+            return OnnxPredictor(onnx_path(path))
+        # Treelite does not import single scikit-learn trees
+        if backend == 'treelite' and hasattr(model, 'get_booster'):
+            return TreelitePredictor(model)
+    except ImportError as e:
+        print(f"Error loading {backend} backend for {path}, using native: {e}")
+
+    if is_keras(model):
+        return KerasPredictor(model)
+    if hasattr(model, 'get_booster'):
+        return XGBPredictor(model)
+    if hasattr(model, 'tree_'):
+        return TreePredictor(model)
+    return ModelPredictor(model)
+
+
+def scale_features(scaler, X):
+    '''MinMaxScaler.transform without the per call validation, columns are checked by name like scikit-learn'''
+    if not hasattr(scaler, 'min_'):
+        return scaler.transform(X)
+    if isinstance(X, pd.DataFrame):
+        if hasattr(scaler, 'feature_names_in_') and list(X.columns) != list(scaler.feature_names_in_):
+            raise ValueError('The feature names should match those that were passed during fit.')
+        X = X.to_numpy(dtype=np.float64)
+    X = np.array(X, dtype=np.float64)
+    X *= scaler.scale_
+    X += scaler.min_
+    if scaler.clip:
+        np.clip(X, scaler.feature_range[0], scaler.feature_range[1], out=X)
+    return X
+
+
+class BatchingPredictor:
+    '''Merge predict calls of concurrent threads into one model call
+
+    The first caller waits up to max_wait seconds (or until max_batch rows are queued) for other callers, then runs
+    the merged batch and hands every caller its own rows.
+    '''
+
+    def __init__(self, predict, max_wait, max_batch=SERVING_MAX_BATCH):
+        self._predict = predict
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self._condition = threading.Condition()
+        self._pending = []
+        self._rows = 0
+
+    def predict(self, X):
+        X = np.asarray(X)
+        request = {'X': X, 'done': threading.Event()}
+        with self._condition:
+            self._pending.append(request)
+            self._rows += len(X)
+            leader = len(self._pending) == 1
+            if self._rows >= self.max_batch:
+                self._condition.notify_all()
+
+        if leader:
+            with self._condition:
+                self._condition.wait_for(lambda: self._rows >= self.max_batch, timeout=self.max_wait)
+                batch, self._pending, self._rows = self._pending, [], 0
+            try:
+                results = self._predict(np.concatenate([item['X'] for item in batch]))
+                offsets = np.cumsum([0] + [len(item['X']) for item in batch])
+                for item, start, stop in zip(batch, offsets[:-1], offsets[1:]):
+                    item['result'] = tuple(result[start:stop] for result in results)
+            except Exception as e:
+                for item in batch:
+                    item['error'] = e
+            finally:
+                for item in batch:
+                    item['done'].set()
+
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['result']
+
+
+class ServingEngine:
+    '''One predict interface for the hourly and daily rate models of every vehicle type'''
+
+    def __init__(self, predictors, batch_wait=SERVING_BATCH_WAIT):
+        # predictors: vehicle -> (hourly predictor, daily predictor, scaler or None)
+        self.predictors = predictors
+        self.batchers = dict()
+        if batch_wait > 0:
+            for vehicle in predictors:
+                self.batchers[vehicle] = BatchingPredictor(
+                    lambda X, vehicle=vehicle: self._predict(vehicle, X), batch_wait / 1000)
+
+    def __contains__(self, vehicle):
+        return vehicle.replace('Vehicle Type_', '') in self.predictors
+
+    def _predict(self, vehicle, X):
+        predictor_hourly, predictor_daily, scaler = self.predictors[vehicle]
+        return predictor_hourly.predict(X), predictor_daily.predict(X)
+
+    def predict(self, vehicle, X):
+        '''hourly and daily rates of the rows of X for a vehicle type, X is scaled when the models need it'''
+        vehicle = vehicle.replace('Vehicle Type_', '')
+        scaler = self.predictors[vehicle][2]
+        X = scale_features(scaler, X) if scaler is not None else np.asarray(X, dtype=np.float64)
+        if vehicle in self.batchers:
+            return self.batchers[vehicle].predict(X)
+        return self._predict(vehicle, X)
+
+
+def keras_to_onnx(model):
+    '''ONNX graph of a Sequential model of Dense and Dropout layers'''
+    from onnx import helper, numpy_helper, TensorProto
+    nodes = []
+    initializers = []
+    name = 'X'
+    for i, layer in enumerate(model.layers):
+        kind = type(layer).__name__
+        if kind == 'Dropout':
+            continue
+        if kind != 'Dense':
+            raise ValueError(f'Cannot export {kind} layers to ONNX')
+        weights = layer.get_weights()
+        bias = weights[1] if len(weights) > 1 else np.zeros(weights[0].shape[1], dtype=np.float32)
+        initializers += [numpy_helper.from_array(weights[0].astype(np.float32), f'kernel_{i}'),
+                         numpy_helper.from_array(bias.astype(np.float32), f'bias_{i}')]
+        nodes.append(helper.make_node('Gemm', [name, f'kernel_{i}', f'bias_{i}'], [f'dense_{i}']))
+        name = f'dense_{i}'
+        activation = layer.get_config()['activation']
+        if activation == 'relu':
+            nodes.append(helper.make_node('Relu', [name], [f'relu_{i}']))
+            name = f'relu_{i}'
+        elif activation != 'linear':
+            raise ValueError(f'Cannot export {activation} activations to ONNX')
+    graph = helper.make_graph(nodes, 'rate_model', [helper.make_tensor_value_info('X', TensorProto.FLOAT, [None, model.input_shape[-1]])],
+                              [helper.make_tensor_value_info(name, TensorProto.FLOAT, [None, 1])], initializers)
+    return helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)])
+
+
+def export_onnx(model, path):
+    '''write the ONNX file of a loaded model next to its model file, for the onnx backend'''
+    if is_keras(model):
+        onnx_model = keras_to_onnx(model)
+    elif hasattr(model, 'get_booster'):
+        from onnxmltools import convert_xgboost
+        from onnxmltools.convert.common.data_types import FloatTensorType
+        # the converter only accepts the default f0, f1, ... feature names
+        booster = model.get_booster().copy()
+        booster.feature_names = None
+        onnx_model = convert_xgboost(booster, initial_types=[('X', FloatTensorType([None, booster.num_features()]))])
+    else:
+        from skl2onnx import convert_sklearn
+        from skl2onnx.common.data_types import FloatTensorType
+        onnx_model = convert_sklearn(model, initial_types=[('X', FloatTensorType([None, model.n_features_in_]))])
+    with open(onnx_path(path), 'wb') as file:
+        file.write(onnx_model.SerializeToString())
+
+
+if __name__ == '__main__':
+    # python -m utils.serving, then start the app with SERVING_BACKEND=onnx
+    from utils.registry import get_registry, manifest_models, MODEL_PATH
+    registry = get_registry().load(warm_up=False)
+    for vehicle, entry in manifest_models().items():
+        loaded = registry.get_models(vehicle)
+        if loaded is None:
+            continue
+        for model, target in zip(loaded[:2], ['hourly', 'daily']):
+            path = MODEL_PATH + entry[target]['file']
+            export_onnx(model, path)
+            print(f'Exported {onnx_path(path)}')
@@ -0,0 +1,198 @@
+import argparse
+import json
+import os
+import shutil
+import time
+import numpy as np
+from utils.model import DATA_PATH, CATEGORIES
+from utils.feature_store import FEATURE_STORE_PATH
+from utils.locations import read_manifest
+
+# Precomputed responses of every location and hour, one directory per build and a 'current' link to the latest
+SURFACE_PATH = DATA_PATH + "price_surface/"
+HOURS = 24
+VEHICLE_TYPES = CATEGORIES['Vehicle Type']
+RATE_FIELDS = ['current_hourly_rate', 'current_daily_rate', 'adjusted_hourly_rate', 'adjusted_daily_rate']
+REVENUE_FIELDS = ['adjusted_revenue', 'actual_revenue', 'profitability']
+# Vehicle types of the profitability block, 'Z' is the total
+REVENUE_KEYS = VEHICLE_TYPES + ['Z']
+# Pricing passes before a build is abandoned because the data or models kept changing under it
+BUILD_ATTEMPTS = 3
+# Seconds between checks of the versions by python -m utils.surface --interval, a change rebuilds straight away
+WATCH_INTERVAL = 5.0
+
+
+def pack(locations, results):
+    '''arrays of the responses of price_batch, pairs with errors are left out'''
+    rates = np.full((len(locations), HOURS, len(VEHICLE_TYPES), len(RATE_FIELDS)), np.nan)
+    revenue = np.full((len(locations), HOURS, len(REVENUE_KEYS), len(REVENUE_FIELDS)), np.nan)
+    has_rates = np.zeros(rates.shape[:3], dtype=bool)
+    has_revenue = np.zeros(revenue.shape[:3], dtype=bool)
+    has_response = np.zeros(rates.shape[:2], dtype=bool)
+    peak_hours = [[None] * HOURS for location in locations]
+    positions = {location: i for i, location in enumerate(locations)}
+    for location, hour_of_the_day, response in results:
+        if 'error' in response:
+            continue
+        i, hour = positions[location], int(hour_of_the_day)
+        for vehicle_type, values in response['predictions'].items():
+            j = VEHICLE_TYPES.index(vehicle_type)
+            rates[i, hour, j] = [values[field] for field in RATE_FIELDS]
+            has_rates[i, hour, j] = True
+        for vehicle_type, values in response['profitability'].items():
+            j = REVENUE_KEYS.index(vehicle_type)
+            revenue[i, hour, j] = [values[field] for field in REVENUE_FIELDS]
+            has_revenue[i, hour, j] = True
+        peak_hours[i][hour] = [int(peak_hour) for peak_hour in response['peakHours']]
+        has_response[i, hour] = True
+    return {'rates': rates, 'revenue': revenue, 'has_rates': has_rates, 'has_revenue': has_revenue,
+            'has_response': has_response}, peak_hours
+
+
+def build_surface(locations=None, path=SURFACE_PATH, keep=2):
+    '''Price every active location at every hour and swap the result in as the current surface
+
+    The previous build is kept for readers that still have it open, older ones are removed. A pricing pass during
+    which the data, models or live demand changed is priced again, after BUILD_ATTEMPTS passes nothing is published and
+    None is returned.
+    '''
+    # imported here so reading a surface does not load the models
+    from utils.pricing import price_batch
+    from utils.cache import ResponseCache
+    from utils.registry import get_registry
+
+    if locations is None:
+        locations = [entry['location'] for entry in read_manifest(FEATURE_STORE_PATH) if entry['active']]
+    # the surface is valid for the data and models it was computed from, read again after pricing
+    cache = ResponseCache(check_interval=0)
+    for attempt in range(BUILD_ATTEMPTS):
+        versions = cache.versions()
+        # a pass after a change prices with the models now on disk
+        get_registry().reload_if_changed()
+        results = price_batch([(location, hour) for location in locations for hour in range(HOURS)])
+        arrays, peak_hours = pack(locations, results)
+        if cache.versions() == versions:
+            break
+        print(f"Error building the price surface: the data or models changed while pricing (attempt {attempt + 1})")
+    else:
+        return None
+
+    os.makedirs(path, exist_ok=True)
+    name = f'surface-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}'
+    tmp_path = os.path.join(path, f'.{name}.tmp')
+    os.makedirs(tmp_path)
+    for key, values in arrays.items():
+        np.save(os.path.join(tmp_path, f'{key}.npy'), values)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as file:
+        json.dump({'locations': list(locations), 'vehicle_types': VEHICLE_TYPES, 'peak_hours': peak_hours,
+                   'versions': list(versions), 'built_at': time.time()}, file)
+    os.rename(tmp_path, os.path.join(path, name))
+
+    # a new link replaces 'current' in one step
+    link = os.path.join(path, f'.current.{os.getpid()}.tmp')
+    os.symlink(name, link)
+    os.replace(link, os.path.join(path, 'current'))
+
+    builds = sorted(build for build in os.listdir(path) if build.startswith('surface-'))
+    for build in builds[:-keep]:
+        shutil.rmtree(os.path.join(path, build), ignore_errors=True)
+    return os.path.join(path, name)
+
+
+class PriceSurface:
+    '''One build of the surface, memory mapped'''
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as file:
+            meta = json.load(file)
+        self.versions = tuple(meta['versions'])
+        self.peak_hours = meta['peak_hours']
+        self.positions = {location: i for i, location in enumerate(meta['locations'])}
+        for key in ['rates', 'revenue', 'has_rates', 'has_revenue', 'has_response']:
+            setattr(self, key, np.load(os.path.join(path, f'{key}.npy'), mmap_mode='r'))
+
+    def lookup(self, location, hour_of_the_day):
+        '''response of price_location, None for locations and hours that are not precomputed'''
+        i = self.positions.get(location)
+        hour = int(hour_of_the_day) if float(hour_of_the_day).is_integer() else -1
+        if i is None or not 0 <= hour < HOURS or not self.has_response[i, hour]:
+            return None
+        rates = self.rates[i, hour].tolist()
+        revenue = self.revenue[i, hour].tolist()
+        has_rates = self.has_rates[i, hour]
+        has_revenue = self.has_revenue[i, hour]
+        return {
+            'peakHours': self.peak_hours[i][hour],
+            'predictions': {vehicle_type: dict(zip(RATE_FIELDS, rates[j]))
+                            for j, vehicle_type in enumerate(VEHICLE_TYPES) if has_rates[j]},
+            'profitability': {key: dict(zip(REVENUE_FIELDS, revenue[j]))
+                              for j, key in enumerate(REVENUE_KEYS) if has_revenue[j]},
+        }
+
+
+class SurfaceReader:
+    '''Current surface of a surface directory, reopened when a new build is swapped in'''
+
+    def __init__(self, path=SURFACE_PATH, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._surface = None
+        self._target = None
+        self._checked = 0
+        self.hits = 0
+        self.misses = 0
+
+    def current(self):
+        '''the latest PriceSurface, None before the first build'''
+        now = time.monotonic()
+        if now - self._checked >= self.check_interval:
+            self._checked = now
+            try:
+                target = os.readlink(os.path.join(self.path, 'current'))
+            except OSError:
+                target = None
+            if target != self._target:
+                self._surface = PriceSurface(os.path.join(self.path, target)) if target else None
+                self._target = target
+        return self._surface
+
+    def lookup(self, location, hour_of_the_day, versions):
+        '''precomputed response, None when it is missing or was computed from other data or models
+
+        The live demand version is not compared: python -m utils.surface --interval rebuilds the surface when the live
+        DemandIndex is published, so it is served until the rebuild with the previous demand factors.
+        '''
+        surface = self.current()
+        response = None
+        if surface is not None and surface.versions[:2] == tuple(versions[:2]):
+            response = surface.lookup(location, hour_of_the_day)
+        if response is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return response
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+if __name__ == '__main__':
+    # python -m utils.surface [--interval 900]
+    parser = argparse.ArgumentParser(description='Precompute the prices of every active location and hour')
+    parser.add_argument('--locations', nargs='+', default=None)
+    parser.add_argument('--interval', type=float, default=None,
+                        help='rebuild every this many seconds, and when the data, models or live demand change')
+    args = parser.parse_args()
+    from utils.cache import ResponseCache
+    cache = ResponseCache(check_interval=0)
+    while True:
+        start = time.perf_counter()
+        path = build_surface(args.locations)
+        if path is not None:
+            print(f'Built {path} in {time.perf_counter() - start:.1f}s', flush=True)
+        # a build that was abandoned is tried again at the next change or interval
+        versions = PriceSurface(path).versions if path is not None else cache.versions()
+        if args.interval is None:
+            break
+        while time.perf_counter() - start < args.interval and cache.versions() == versions:
+            time.sleep(min(WATCH_INTERVAL, max(0, args.interval - (time.perf_counter() - start))))
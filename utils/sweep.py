@@ -0,0 +1,123 @@
+import argparse
+import itertools
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from utils.model import predict_rates_batch
+from utils.pricing import DEFAULT_POLICY, build_response
+from utils.feature_store import load_history, load_location_data, load_demand_index, load_rate_averages
+
+# History columns used by build_response, shared with the workers as memory mapped .npy files
+SHARED_COLUMNS = ['location', 'Vehicle Type', 'booking_billed_start', 'booking_created_at_hour', 'booking_rates_hours',
+                  'booking_rates_24hours', 'booking_actual_cost_distance', 'booking_actual_cost_total']
+
+
+def share_history(df, path):
+    '''Write the SHARED_COLUMNS of df sorted by location to path, return the row range of every location'''
+    df = df.sort_values('location', kind='stable')
+    categories = dict()
+    for column in SHARED_COLUMNS:
+        values = df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # categoricals are shared as their integer codes
+            categories[column] = values.cat.categories.tolist()
+            values = values.cat.codes
+        np.save(os.path.join(path, f'{column}.npy'), values.to_numpy())
+    with open(os.path.join(path, 'categories.json'), 'w') as file:
+        json.dump(categories, file)
+
+    locations = df['location'].astype(object).to_numpy()
+    boundaries = np.flatnonzero(locations[1:] != locations[:-1]) + 1
+    starts = np.concatenate([[0], boundaries])
+    stops = np.concatenate([boundaries, [len(df)]])
+    return {locations[start]: (int(start), int(stop)) for start, stop in zip(starts, stops) if len(df)}
+
+
+# Memory mapped history of a worker process, set by init_worker
+_shared = dict()
+
+
+def init_worker(path, predictions, demand_index, rate_averages):
+    '''open the shared history without copying it, the other inputs are small'''
+    with open(os.path.join(path, 'categories.json')) as file:
+        categories = json.load(file)
+    _shared['columns'] = {column: np.load(os.path.join(path, f'{column}.npy'), mmap_mode='r') for column in SHARED_COLUMNS}
+    _shared['categories'] = categories
+    _shared['predictions'] = predictions
+    _shared['demand_index'] = demand_index
+    _shared['rate_averages'] = rate_averages
+
+
+def shared_frame(start, stop):
+    '''DataFrame of rows start to stop of the shared history, numeric columns are views of the memory map'''
+    data = dict()
+    for column, values in _shared['columns'].items():
+        values = values[start:stop]
+        if column in _shared['categories']:
+            values = pd.Categorical.from_codes(values, categories=_shared['categories'][column])
+        data[column] = values
+    return pd.DataFrame(data, copy=False)
+
+
+def evaluate(task):
+    '''revenue of one location under one policy'''
+    location, (start, stop), hour_of_the_day, policy = task
+    response = build_response(location, hour_of_the_day, _shared['predictions'][location], shared_frame(start, stop),
+                              _shared['demand_index'], _shared['rate_averages'], policy)
+    rows = []
+    for vehicle_type, revenue in response['profitability'].items():
+        rows.append({'location': location, **policy, 'vehicle_type': 'Total' if vehicle_type == 'Z' else vehicle_type,
+                     **revenue})
+    return rows
+
+
+def policy_grid(demand_weights=(1,), cap_thresholds=(50,), cap_increases=(10,)):
+    '''every combination of the policy parameters'''
+    return [{'demand_weight': demand_weight, 'cap_threshold': cap_threshold, 'cap_increase': cap_increase}
+            for demand_weight, cap_threshold, cap_increase in itertools.product(demand_weights, cap_thresholds, cap_increases)]
+
+
+def sweep(policies, hour_of_the_day, locations=None, max_workers=None):
+    '''Compare pricing policies on every location in a process pool
+
+    Rates are predicted once for every location, the workers only replay the policies over the shared history.
+    Returns one row per location, policy and vehicle type (plus a Total row) with the revenue comparison.
+    '''
+    df = load_history(locations)
+    locations = df['location'].astype(object).dropna().unique().tolist()
+    data = [(load_location_data(location)[0], location) for location in locations]
+    predictions = {location: predictions_df for location, predictions_df in predict_rates_batch(data).items()
+                   if not predictions_df.empty}
+
+    path = tempfile.mkdtemp(prefix='pricing_sweep_')
+    try:
+        ranges = share_history(df, path)
+        del df
+        tasks = [(location, ranges[location], hour_of_the_day, {**DEFAULT_POLICY, **policy})
+                 for location in sorted(predictions) for policy in policies]
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                                 initargs=(path, predictions, load_demand_index(), load_rate_averages())) as executor:
+            results = list(executor.map(evaluate, tasks, chunksize=max(1, len(tasks) // (4 * (os.cpu_count() or 1)))))
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+    return pd.DataFrame([row for rows in results for row in rows])
+
+
+if __name__ == '__main__':
+    # python -m utils.sweep --hour 17 --demand-weights 0 0.5 1 --cap-thresholds 30 50 --cap-increases 5 10
+    parser = argparse.ArgumentParser(description='Compare pricing policies on every location of the feature store')
+    parser.add_argument('--hour', type=float, required=True, help='hour_of_the_day to price at')
+    parser.add_argument('--demand-weights', type=float, nargs='+', default=[1])
+    parser.add_argument('--cap-thresholds', type=float, nargs='+', default=[50])
+    parser.add_argument('--cap-increases', type=float, nargs='+', default=[10])
+    parser.add_argument('--locations', nargs='+', default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output', default='sweep.csv')
+    args = parser.parse_args()
+    policies = policy_grid(args.demand_weights, args.cap_thresholds, args.cap_increases)
+    sweep(policies, args.hour, args.locations, args.workers).to_csv(args.output, index=False)
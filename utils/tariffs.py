@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+
+# Rates of every tariff version: hourly_rate, daily_rate and per_mile
+# The key is the Size Category for 'pre_2022' (with a flat 'EV' rate) and the Vehicle Type for every later tariff
+TARIFF_RATES = pd.DataFrame([
+    ('pre_2022', 'Small', 4.75, 33.25, 0.18), ('pre_2022', 'Medium', 5.50, 38.50, 0.18),
+    ('pre_2022', 'Large', 6.25, 43.75, 0.18), ('pre_2022', 'Family', 7.25, 50.75, 0.20),
+    ('pre_2022', 'Van', 7.50, 60.00, 0.22), ('pre_2022', '7 Seater', 7.50, 60.00, 0.22),
+    ('pre_2022', 'EV', 5.50, 38.50, 0.18),
+
+    ('feb_2022', 'City', 5.00, 40.00, 0.20), ('feb_2022', 'Everyday', 5.75, 46.00, 0.20),
+    ('feb_2022', 'Family', 6.50, 52.00, 0.22), ('feb_2022', '7 Seater', 7.50, 60.00, 0.22),
+    ('feb_2022', 'Van', 7.50, 60.00, 0.22), ('feb_2022', 'Hydrogen', 7.50, 60.00, 0.31),
+
+    ('nov_2022', 'City', 5.00, 40.00, 0.22), ('nov_2022', 'Everyday', 5.95, 47.60, 0.22),
+    ('nov_2022', 'Family', 6.70, 53.60, 0.22), ('nov_2022', '7 Seater', 7.70, 61.60, 0.24),
+    ('nov_2022', 'Van', 7.70, 61.60, 0.24), ('nov_2022', 'Hydrogen', 7.70, 61.60, 0.31),
+
+    ('glasgow_sep_2023', 'City', 4.95, 39.60, 0.22), ('glasgow_sep_2023', 'Everyday', 5.75, 46.00, 0.22),
+    ('glasgow_sep_2023', 'Family', 6.50, 52.00, 0.22), ('glasgow_sep_2023', '7 Seater', 7.50, 60.00, 0.24),
+    ('glasgow_sep_2023', 'Van', 7.50, 60.00, 0.24), ('glasgow_sep_2023', 'Hydrogen', 7.50, 60.00, 0.31),
+
+    ('sep_2023', 'City', 5.50, 44.00, 0.23), ('sep_2023', 'Everyday', 6.50, 52.00, 0.23),
+    ('sep_2023', 'Family', 7.40, 59.20, 0.23), ('sep_2023', '7 Seater', 8.50, 68.00, 0.25),
+    ('sep_2023', 'Van', 8.50, 68.00, 0.25), ('sep_2023', 'Hydrogen', 8.50, 68.00, 0.31),
+
+    ('shropshire_apr_2024', 'City', 5.00, 40.00, 0.22), ('shropshire_apr_2024', 'Everyday', 6.50, 52.00, 0.23),
+    ('shropshire_apr_2024', 'Family', 7.40, 59.20, 0.23), ('shropshire_apr_2024', '7 Seater', 7.70, 61.60, 0.24),
+    ('shropshire_apr_2024', 'Van', 7.70, 61.60, 0.24), ('shropshire_apr_2024', 'Hydrogen', 7.70, 61.60, 0.31),
+
+    # No Hydrogen rate for Newcastle and Canterbury
+    ('newcastle_apr_2024', 'City', 5.50, 44.00, 0.24), ('newcastle_apr_2024', 'Everyday', 6.80, 52.00, 0.24),
+    ('newcastle_apr_2024', 'Family', 7.50, 59.20, 0.24), ('newcastle_apr_2024', '7 Seater', 9.00, 68.00, 0.27),
+    ('newcastle_apr_2024', 'Van', 9.00, 68.00, 0.27),
+
+    ('plymouth_apr_2024', 'City', 5.50, 44.00, 0.23), ('plymouth_apr_2024', 'Everyday', 7.25, 58.00, 0.23),
+    ('plymouth_apr_2024', 'Family', 8.20, 65.60, 0.23), ('plymouth_apr_2024', '7 Seater', 8.50, 68.00, 0.25),
+    ('plymouth_apr_2024', 'Van', 8.50, 68.00, 0.25), ('plymouth_apr_2024', 'Hydrogen', 8.50, 68.00, 0.31),
+
+    ('default', 'City', 5.75, 44.00, 0.24), ('default', 'Everyday', 7.25, 52.00, 0.24),
+    ('default', 'Family', 8.15, 59.20, 0.24), ('default', '7 Seater', 9.90, 68.00, 0.27),
+    ('default', 'Van', 9.90, 68.00, 0.27), ('default', 'Hydrogen', 9.90, 68.00, 0.31),
+], columns=['tariff', 'key', 'hourly_rate', 'daily_rate', 'per_mile'])
+
+# Per mile rate of EVs by tariff and Vehicle Type, replaces per_mile of TARIFF_RATES
+EV_PER_MILE = pd.DataFrame([
+    ('feb_2022', 'City', 0.05), ('feb_2022', 'Everyday', 0.05), ('feb_2022', 'Family', 0.05),
+    ('feb_2022', '7 Seater', 0.07), ('feb_2022', 'Van', 0.07),
+    *[(tariff, vehicle, per_mile)
+      for tariff, per_mile in [('nov_2022', 0.12), ('glasgow_sep_2023', 0.12), ('sep_2023', 0.13), ('shropshire_apr_2024', 0.12),
+                               ('newcastle_apr_2024', 0.14), ('plymouth_apr_2024', 0.15), ('default', 0.14)]
+      for vehicle in ['City', 'Everyday', 'Family', '7 Seater', 'Van']],
+], columns=['tariff', 'key', 'per_mile'])
+
+# Which tariff applies to a booking, the first matching rule wins
+# Year and month ranges are inclusive and checked separately (e.g. 'year >= 2024 and month >= 4'), NaN is unbounded
+TARIFF_RULES = pd.DataFrame([
+    ('pre_2022', np.nan, 2021, np.nan, np.nan, None),
+    ('pre_2022', 2022, 2022, 1, 1, None),
+    ('feb_2022', 2022, 2022, 2, 10, None),
+    ('nov_2022', 2022, 2022, 11, np.nan, None),
+    ('nov_2022', 2023, 2023, np.nan, 8, None),
+    ('glasgow_sep_2023', 2023, np.nan, 9, np.nan, ['Glasgow']),
+    # Tunbridge Wells kept the November 2022 rates for the rest of 2023
+    ('nov_2022', 2023, 2023, 9, np.nan, ['Tunbridge Wells']),
+    ('sep_2023', 2023, 2023, 9, np.nan, None),
+    # 'Saffron Waldron' is spelled as in apply_rates and never matches the mapped 'Saffron Walden'
+    ('sep_2023', 2024, np.nan, 4, np.nan, ['Tunbridge Wells', 'Saffron Waldron', 'Eastbourne', 'Salisbury']),
+    ('shropshire_apr_2024', 2024, np.nan, 4, np.nan, ['Shropshire']),
+    ('newcastle_apr_2024', 2024, np.nan, 4, np.nan, ['Newcastle', 'Canterbury']),
+    ('plymouth_apr_2024', 2024, np.nan, 4, np.nan, ['Plymouth']),
+    ('default', np.nan, np.nan, np.nan, np.nan, None),
+], columns=['tariff', 'year_from', 'year_to', 'month_from', 'month_to', 'locations'])
+
+
+def resolve_tariffs(year, month, location):
+    '''Name of the tariff of every booking from TARIFF_RULES'''
+    conditions = []
+    for rule in TARIFF_RULES.itertuples(index=False):
+        mask = np.ones(len(year), dtype=bool)
+        if not np.isnan(rule.year_from):
+            mask &= year >= rule.year_from
+        if not np.isnan(rule.year_to):
+            mask &= year <= rule.year_to
+        if not np.isnan(rule.month_from):
+            mask &= month >= rule.month_from
+        if not np.isnan(rule.month_to):
+            mask &= month <= rule.month_to
+        if rule.locations is not None:
+            mask &= location.isin(rule.locations).to_numpy()
+        conditions.append(mask)
+    return np.select(conditions, TARIFF_RULES['tariff'].to_numpy(dtype=object), default='default')
+
+
+def resolve_rates(dataframe):
+    '''Vectorised apply_rates, add hourly_rate, daily_rate and per_mile for all rows at once'''
+    year = dataframe['booking_billed_start'].dt.year.to_numpy(dtype=float)
+    month = dataframe['booking_billed_start'].dt.month.to_numpy(dtype=float)
+    fuel_type = dataframe['Fuel Type'].to_numpy(dtype=object)
+    is_ev = fuel_type == 'EV'
+
+    tariff = resolve_tariffs(year, month, dataframe['location'])
+
+    # Before 2022 rates depend on the Size Category and EVs share a single rate
+    key = np.where(tariff == 'pre_2022',
+                   np.where(is_ev, 'EV', dataframe['Size Category'].to_numpy(dtype=object)),
+                   dataframe['Vehicle Type'].to_numpy(dtype=object))
+
+    # Join the tariff rates and EV overrides on (tariff, key)
+    index = pd.MultiIndex.from_arrays([tariff, key])
+    rates = TARIFF_RATES.set_index(['tariff', 'key']).reindex(index)
+    ev_per_mile = EV_PER_MILE.set_index(['tariff', 'key'])['per_mile'].reindex(index).to_numpy()
+    per_mile = rates['per_mile'].to_numpy()
+    per_mile = np.where(is_ev & ~np.isnan(ev_per_mile), ev_per_mile, per_mile)
+
+    dataframe = dataframe.copy()
+    dataframe['hourly_rate'] = rates['hourly_rate'].to_numpy()
+    dataframe['daily_rate'] = rates['daily_rate'].to_numpy()
+    dataframe['per_mile'] = per_mile
+    return dataframe
@@ -0,0 +1,458 @@
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import joblib
+from utils.registry import MODEL_PATH, ENCODERS_PATH, MANIFEST_FILE, model_filename, scaler_filename, read_manifest, \
+    manifest_models, load_model
+
+# Candidate model families of every (vehicle type, target) job
+FAMILIES = ['nn', 'xgb', 'dt']
+TARGETS = ['hourly', 'daily']
+# Share of the oldest bookings of each vehicle type used for training, the rest validates
+SPLIT_RATIO = 0.8
+# Columns that are not model features, as in prepare_features
+NON_FEATURES = ['booking_billed_start', 'hourly_rate', 'daily_rate']
+# Warm starts of --incremental: learning rate of the fine tuned networks and boosting rounds added to XGBoost models
+FINE_TUNE_LEARNING_RATE = 1e-4
+BOOSTING_ROUNDS = 50
+# Drift that makes a vehicle type fall back to a full refit: error of the published model on the new bookings this
+# many times its validation error, or this share of the new bookings outside the range the scaler was fitted on
+DRIFT_ERROR_RATIO = 1.5
+DRIFT_RANGE_SHARE = 0.1
+# Share of the latest new bookings held out of an incremental update to score it against the published model
+HOLDOUT_SHARE = 0.2
+# Release part of the model and scaler files written by publish
+RELEASE_PATTERN = re.compile(r'\.\d{8}-\d{6}-\d+\.(keras|pkl)$')
+
+
+def create_nn_model(input_dim):
+    '''Dense network of the Model Building notebook'''
+    from keras.models import Sequential
+    from keras.layers import Dense, Dropout, Input
+    model = Sequential()
+    model.add(Input(shape=(input_dim,)))
+    model.add(Dense(128, activation='relu'))
+    model.add(Dropout(0.2))
+    model.add(Dense(64, activation='relu'))
+    model.add(Dropout(0.2))
+    model.add(Dense(32, activation='relu'))
+    model.add(Dense(1, activation='linear'))
+    model.compile(optimizer='adam', loss='mean_squared_error')
+    return model
+
+
+def split_vehicle_data(scaled_df, vehicle):
+    '''time ordered train and validation features and targets of one vehicle type'''
+    vehicle_data = scaled_df[scaled_df[f'Vehicle Type_{vehicle}'].to_numpy() == 1]
+    vehicle_data = vehicle_data.sort_values(by='booking_billed_start', kind='stable')
+    features = vehicle_data.drop(columns=NON_FEATURES)
+    split_index = int(len(vehicle_data) * SPLIT_RATIO)
+    return {'feature_names': features.columns.tolist(),
+            'trained_until': str(vehicle_data['booking_billed_start'].iloc[split_index - 1]) if split_index else None,
+            'X_train': features.iloc[:split_index], 'X_test': features.iloc[split_index:],
+            'y_train': {target: vehicle_data[f'{target}_rate'].to_numpy()[:split_index] for target in TARGETS},
+            'y_test': {target: vehicle_data[f'{target}_rate'].to_numpy()[split_index:] for target in TARGETS}}
+
+
+def init_worker(threads):
+    '''limit the threads of every library before it is imported, so parallel jobs do not oversubscribe the cores'''
+    for variable in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS']:
+        os.environ[variable] = str(threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+
+def save_network(model, path):
+    '''save a Keras model, in a directory of its own first as Keras writes its weights next to the file'''
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(path))
+    try:
+        model.save(os.path.join(tmp_path, os.path.basename(path)))
+        os.replace(os.path.join(tmp_path, os.path.basename(path)), path)
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def train_job(job):
+    '''Fit one model family for one vehicle type and target, save it to the staging directory
+
+    Returns the job with the validation MAE and RMSE and the file of the model.
+    '''
+    vehicle, target, family, data_path, staging_path, threads, epochs = job
+    X_train = np.load(os.path.join(data_path, f'{vehicle}_X_train.npy'), mmap_mode='r')
+    X_test = np.load(os.path.join(data_path, f'{vehicle}_X_test.npy'), mmap_mode='r')
+    y_train = np.load(os.path.join(data_path, f'{vehicle}_{target}_train.npy'))
+    y_test = np.load(os.path.join(data_path, f'{vehicle}_{target}_test.npy'))
+    path = os.path.join(staging_path, model_filename(vehicle, family, target))
+
+    start = time.perf_counter()
+    if family == 'nn':
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+        tf.keras.utils.set_random_seed(0)
+        model = create_nn_model(X_train.shape[1])
+        model.fit(np.asarray(X_train), y_train, epochs=epochs, batch_size=32, validation_split=0.2, verbose=0)
+        save_network(model, path)
+        y_pred = model.predict(np.asarray(X_test), verbose=0).ravel()
+    else:
+        if family == 'xgb':
+            from xgboost import XGBRegressor
+            model = XGBRegressor(tree_method='hist', n_jobs=threads, random_state=0)
+        else:
+            from sklearn.tree import DecisionTreeRegressor
+            model = DecisionTreeRegressor(random_state=0)
+        model.fit(np.asarray(X_train), y_train)
+        joblib.dump(model, path)
+        y_pred = model.predict(np.asarray(X_test))
+
+    mae, rmse = prediction_errors(y_test, y_pred)
+    return {'vehicle': vehicle, 'target': target, 'family': family, 'file': os.path.basename(path),
+            'mae': mae, 'rmse': rmse, 'rows': len(y_train), 'seconds': time.perf_counter() - start}
+
+
+def prediction_errors(y_true, y_pred):
+    '''(MAE, RMSE), None without rows'''
+    if len(y_true) == 0:
+        return None, None
+    errors = y_true - np.ravel(y_pred)
+    return float(np.round(np.mean(np.abs(errors)), 5)), float(np.round(np.sqrt(np.mean(errors ** 2)), 5))
+
+
+def update_job(job):
+    '''Continue training one published model on the new bookings, save it to the staging directory when it improved
+
+    XGBoost models get more boosting rounds fitted on the older new bookings and networks are fine tuned from their
+    weights, so the time depends on the new bookings. Both the published and the updated model are then scored on the
+    latest new bookings, which the update did not see, and the updated model is only kept when it predicts them better.
+    Decision trees cannot be updated and are kept until the next full training. The job reports drift instead when
+    the model predicts the new bookings much worse than at validation.
+    '''
+    vehicle, target, family, data_path, staging_path, threads, epochs, rounds, model_file, reference_rmse = job
+    if family == 'nn':
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+        tf.keras.utils.set_random_seed(0)
+    with open(os.path.join(data_path, 'features.json')) as file:
+        feature_names = json.load(file)
+
+    def load_features(name):
+        X = np.load(os.path.join(data_path, f'{vehicle}_{name}.npy'))
+        # models fitted on frames check the feature names
+        if hasattr(model, 'feature_names_in_'):
+            X = pd.DataFrame(X, columns=feature_names)[list(model.feature_names_in_)]
+        return X
+
+    start = time.perf_counter()
+    model = load_model(model_file)
+    # new bookings in time order, the last ones are held out of the update
+    X_new = load_features('X_new')
+    y_new = np.load(os.path.join(data_path, f'{vehicle}_{target}_new.npy'))
+    fit_rows = int(np.load(os.path.join(data_path, f'{vehicle}_fit_rows.npy')))
+    X_fit, X_holdout, y_fit, y_holdout = X_new[:fit_rows], X_new[fit_rows:], y_new[:fit_rows], y_new[fit_rows:]
+    predict = (lambda X: model.predict(X, verbose=0)) if family == 'nn' else model.predict
+    y_pred = np.ravel(predict(X_new))
+    mae, rmse = prediction_errors(y_new, y_pred)
+    holdout_mae, holdout_rmse = prediction_errors(y_holdout, y_pred[fit_rows:])
+    result = {'vehicle': vehicle, 'target': target, 'family': family, 'file': os.path.basename(model_file),
+              'new_rows': len(y_new), 'fit_rows': fit_rows, 'new_mae': mae, 'new_rmse': rmse,
+              'holdout_mae': holdout_mae, 'holdout_rmse': holdout_rmse, 'drift': False, 'updated': False}
+    if reference_rmse and rmse > DRIFT_ERROR_RATIO * reference_rmse:
+        result['drift'] = True
+        return result
+    if family == 'dt' or len(y_fit) == 0:
+        result['seconds'] = time.perf_counter() - start
+        return result
+
+    if family == 'nn':
+        from keras.optimizers import Adam
+        model.compile(optimizer=Adam(learning_rate=FINE_TUNE_LEARNING_RATE), loss='mean_squared_error')
+        model.fit(np.asarray(X_fit), y_fit, epochs=epochs, batch_size=32, verbose=0)
+    else:
+        model.set_params(n_estimators=rounds, n_jobs=threads)
+        model.fit(X_fit, y_fit, xgb_model=model.get_booster())
+    result['updated_mae'], result['updated_rmse'] = prediction_errors(y_holdout, predict(X_holdout))
+    if result['updated_rmse'] < holdout_rmse:
+        result['updated'] = True
+        path = os.path.join(staging_path, os.path.basename(model_file))
+        if family == 'nn':
+            save_network(model, path)
+        else:
+            joblib.dump(model, path)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def pick_winners(results, metric='rmse'):
+    '''family with the lowest validation error of every vehicle type and target'''
+    winners = dict()
+    for result in results:
+        if result[metric] is None:
+            continue
+        key = (result['vehicle'], result['target'])
+        if key not in winners or result[metric] < winners[key][metric]:
+            winners[key] = result
+    return winners
+
+
+def run_jobs(function, jobs, max_workers, threads):
+    '''results of function over jobs in parallel processes with threads threads each'''
+    # spawned workers start without TensorFlow state of the parent
+    with ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker, initargs=(threads,)) as executor:
+        return list(executor.map(function, jobs))
+
+
+def current_manifest(model_path=MODEL_PATH):
+    '''manifest of model_path, the models of VEHICLE_MODELS when they were placed by hand'''
+    manifest = read_manifest(model_path)
+    if manifest is None:
+        manifest = {'models': manifest_models(model_path)}
+    return manifest
+
+
+def staging_directory(model_path=MODEL_PATH):
+    '''new directory for the files of a release, next to model_path so they are moved with a rename'''
+    parent = os.path.dirname(os.path.normpath(os.path.abspath(model_path)))
+    return tempfile.mkdtemp(prefix='.train-', dir=parent)
+
+
+def manifest_files(manifest):
+    '''model and scaler files named in a manifest'''
+    return {entry[target]['file'] for entry in manifest['models'].values() for target in TARGETS} | \
+        {entry['scaler'] for entry in manifest['models'].values() if entry.get('scaler')}
+
+
+def publish(staging_path, entries, results, model_path=MODEL_PATH, encoders_path=ENCODERS_PATH):
+    '''Move the new models and scalers of the staging directory into place, then the manifest that makes them current
+
+    entries {vehicle: manifest entry} replace the entries of those vehicle types, the others are kept. New files get
+    the name of their release, so the files of the current manifest are never replaced and the registry, which only
+    reloads when the manifest changes, switches to the whole release at once. Releases older than the previous one
+    are removed afterwards.
+    '''
+    previous = current_manifest(model_path)
+    manifest = json.loads(json.dumps(previous))
+    manifest['trained_at'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    manifest['candidates'] = results
+    release = f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}'
+    for vehicle, entry in sorted(entries.items()):
+        entry = dict(entry)
+        for target in TARGETS:
+            file = entry[target]['file']
+            if os.path.exists(os.path.join(staging_path, file)):
+                entry[target] = dict(entry[target], file=model_filename(vehicle, entry[target]['family'], target, release))
+                os.replace(os.path.join(staging_path, file), os.path.join(model_path, entry[target]['file']))
+        if entry.get('scaler') and os.path.exists(os.path.join(staging_path, entry['scaler'])):
+            scaler_file = scaler_filename(vehicle, release)
+            os.replace(os.path.join(staging_path, entry['scaler']), os.path.join(encoders_path, scaler_file))
+            entry['scaler'] = scaler_file
+        manifest['models'][vehicle] = entry
+
+    tmp_path = os.path.join(model_path, f'.{MANIFEST_FILE}.tmp')
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(tmp_path, os.path.join(model_path, MANIFEST_FILE))
+
+    # readers that loaded the previous manifest can still open its files
+    keep = manifest_files(manifest) | manifest_files(previous)
+    for path in [model_path, encoders_path]:
+        for filename in os.listdir(path):
+            if RELEASE_PATTERN.search(filename) and filename not in keep:
+                os.remove(os.path.join(path, filename))
+    return manifest
+
+
+def train_models(scaled_df, vehicles=None, families=FAMILIES, max_workers=None, epochs=50, metric='rmse',
+                 model_path=MODEL_PATH, encoders_path=ENCODERS_PATH):
+    '''Train every (vehicle type, target, model family) job in parallel and publish the best model of each target
+
+    Features of every vehicle type are scaled with a MinMaxScaler fitted on its training split. The neural networks
+    need it and tree models are not affected by it, so every winner of a vehicle type takes the same input.
+    '''
+    from sklearn.preprocessing import MinMaxScaler
+
+    if vehicles is None:
+        vehicles = [col.replace('Vehicle Type_', '') for col in scaled_df.columns if col.startswith('Vehicle Type_')]
+    max_workers = max_workers or os.cpu_count() or 1
+    threads = max(1, (os.cpu_count() or 1) // max_workers)
+
+    data_path = tempfile.mkdtemp(prefix='pricing_train_')
+    staging_path = staging_directory(model_path)
+    try:
+        jobs = []
+        scalers = dict()
+        trained_until = dict()
+        for vehicle in vehicles:
+            split = split_vehicle_data(scaled_df, vehicle)
+            if len(split['X_train']) == 0 or len(split['X_test']) == 0:
+                print(f'Error training {vehicle}: not enough bookings')
+                continue
+            scaler = MinMaxScaler().fit(split['X_train'])
+            scalers[vehicle] = scaler_filename(vehicle)
+            trained_until[vehicle] = split['trained_until']
+            joblib.dump(scaler, os.path.join(staging_path, scalers[vehicle]))
+            np.save(os.path.join(data_path, f'{vehicle}_X_train.npy'), scaler.transform(split['X_train']))
+            np.save(os.path.join(data_path, f'{vehicle}_X_test.npy'), scaler.transform(split['X_test']))
+            for target in TARGETS:
+                np.save(os.path.join(data_path, f'{vehicle}_{target}_train.npy'), split['y_train'][target])
+                np.save(os.path.join(data_path, f'{vehicle}_{target}_test.npy'), split['y_test'][target])
+                jobs += [(vehicle, target, family, data_path, staging_path, threads, epochs) for family in families]
+
+        results = run_jobs(train_job, jobs, max_workers, threads)
+
+        for result in results:
+            print(f"{result['vehicle']:9s} {result['target']:7s} {result['family']:4s} MAE {result['mae']} "
+                  f"RMSE {result['rmse']} ({result['seconds']:.1f}s)")
+        winners = pick_winners(results, metric)
+        entries = dict()
+        for vehicle in scalers:
+            # vehicle types need both rate models
+            if all((vehicle, target) in winners for target in TARGETS):
+                entries[vehicle] = {'scaler': scalers[vehicle], 'trained_until': trained_until[vehicle]}
+                for target in TARGETS:
+                    entries[vehicle][target] = {key: winners[vehicle, target][key] for key in ['family', 'file', 'mae', 'rmse', 'rows']}
+        return publish(staging_path, entries, results, model_path, encoders_path)
+    finally:
+        shutil.rmtree(data_path, ignore_errors=True)
+        shutil.rmtree(staging_path, ignore_errors=True)
+
+
+def update_models(scaled_df, vehicles=None, since=None, max_workers=None, epochs=5, rounds=BOOSTING_ROUNDS,
+                  model_path=MODEL_PATH, encoders_path=ENCODERS_PATH):
+    '''Warm start the published models of every vehicle type on the bookings after they were trained
+
+    The new bookings are scaled with the published scalers, so the models keep their input. Vehicle types whose new
+    bookings drifted out of the scaled range or whose models predict them much worse are refitted with train_models.
+    '''
+    manifest = current_manifest(model_path)
+    if vehicles is None:
+        vehicles = list(manifest['models'])
+    max_workers = max_workers or os.cpu_count() or 1
+    threads = max(1, (os.cpu_count() or 1) // max_workers)
+
+    data_path = tempfile.mkdtemp(prefix='pricing_train_')
+    staging_path = staging_directory(model_path)
+    refit = []
+    try:
+        features = scaled_df.drop(columns=NON_FEATURES)
+        with open(os.path.join(data_path, 'features.json'), 'w') as file:
+            json.dump(features.columns.tolist(), file)
+        jobs = []
+        # time of the last new booking each vehicle type is fitted on
+        fitted_until = dict()
+        for vehicle in vehicles:
+            entry = manifest['models'].get(vehicle)
+            start_date = since or (entry or {}).get('trained_until')
+            if entry is None or start_date is None:
+                print(f'Error updating {vehicle}: no training date, train it fully or pass --since')
+                continue
+            in_vehicle = scaled_df[f'Vehicle Type_{vehicle}'].to_numpy() == 1
+            new = in_vehicle & (scaled_df['booking_billed_start'] > pd.Timestamp(start_date)).to_numpy()
+            if not new.any():
+                print(f'{vehicle}: no new bookings since {start_date}')
+                continue
+            scaler = joblib.load(os.path.join(encoders_path, entry['scaler'])) if entry.get('scaler') else None
+
+            def scale(X):
+                return scaler.transform(X) if scaler is not None else X.to_numpy()
+
+            X_new = scale(features[new])
+            families = [entry[target]['family'] for target in TARGETS]
+            if 'nn' in families and scaler is not None:
+                # networks extrapolate badly outside the range the scaler was fitted on
+                out_of_range = ((X_new < -0.05) | (X_new > 1.05)).any(axis=1).mean()
+                if out_of_range > DRIFT_RANGE_SHARE:
+                    print(f'{vehicle}: {out_of_range:.0%} of the new bookings are out of the scaled range')
+                    refit.append(vehicle)
+                    continue
+            # in time order, the latest new bookings score the update as the validation split of train_models does
+            order = np.argsort(scaled_df['booking_billed_start'].to_numpy()[new], kind='stable')
+            times = scaled_df['booking_billed_start'].to_numpy()[new][order]
+            fit_rows = len(order) - max(1, int(len(order) * HOLDOUT_SHARE))
+            # bookings at the same time stay on one side, the next update starts after the last fitted one
+            fit_rows = int(np.searchsorted(times, times[fit_rows], side='left'))
+            np.save(os.path.join(data_path, f'{vehicle}_X_new.npy'), X_new[order])
+            np.save(os.path.join(data_path, f'{vehicle}_fit_rows.npy'), fit_rows)
+            fitted_until[vehicle] = str(pd.Timestamp(times[fit_rows - 1])) if fit_rows else None
+            for target in TARGETS:
+                np.save(os.path.join(data_path, f'{vehicle}_{target}_new.npy'), scaled_df[f'{target}_rate'].to_numpy()[new][order])
+                jobs.append((vehicle, target, entry[target]['family'], data_path, staging_path, threads, epochs, rounds,
+                             os.path.join(model_path, entry[target]['file']), entry[target].get('rmse')))
+
+        results = run_jobs(update_job, jobs, max_workers, threads)
+        updates = dict()
+        for result in results:
+            line = f"{result['vehicle']:9s} {result['target']:7s} {result['family']:4s}"
+            if result['drift']:
+                print(f"{line} drifted: RMSE {result['new_rmse']} on {result['new_rows']} new bookings")
+                refit.append(result['vehicle'])
+                continue
+            if result['updated']:
+                note = f"updated on {result['fit_rows']} new bookings"
+            elif result['family'] == 'dt':
+                note = 'not updated, decision trees are only refitted by a full training'
+            elif result['fit_rows'] == 0:
+                note = 'not updated, too few new bookings'
+            else:
+                note = 'not updated, no better on the held out new bookings'
+            updates[result['vehicle'], result['target']] = (result, note)
+            updated_rmse = f" -> {result['updated_rmse']}" if 'updated_rmse' in result else ''
+            print(f"{line} held out RMSE {result['holdout_rmse']}{updated_rmse}: {note} ({result['seconds']:.1f}s)")
+
+        entries = dict()
+        for vehicle in fitted_until:
+            if vehicle in refit:
+                continue
+            entries[vehicle] = dict(manifest['models'][vehicle])
+            # held out and rejected bookings come back in the next update, unless a model was fitted past them
+            if any(updates[vehicle, target][0]['updated'] for target in TARGETS):
+                entries[vehicle]['trained_until'] = fitted_until[vehicle]
+            for target in TARGETS:
+                # the validation errors stay the reference of later drift checks
+                result, note = updates[vehicle, target]
+                entries[vehicle][target] = dict(entries[vehicle][target], incremental=note)
+                if result['updated']:
+                    entries[vehicle][target]['rows'] = entries[vehicle][target].get('rows', 0) + result['fit_rows']
+        manifest = publish(staging_path, entries, results, model_path, encoders_path)
+    finally:
+        shutil.rmtree(data_path, ignore_errors=True)
+        shutil.rmtree(staging_path, ignore_errors=True)
+
+    if refit:
+        refit = sorted(set(refit))
+        print(f"Refitting {', '.join(refit)} on the whole history")
+        manifest = train_models(scaled_df, refit, max_workers=max_workers, model_path=model_path, encoders_path=encoders_path)
+    return manifest
+
+
+if __name__ == '__main__':
+    # python -m utils.train [--vehicles City Van] [--families nn xgb dt] [--workers 4] [--epochs 50]
+    # python -m utils.train --incremental [--since 2024-06-01] [--epochs 5] [--rounds 50]
+    from utils.feature_store import load_scaled
+    parser = argparse.ArgumentParser(description='Train the rate models on the feature store and publish the best ones')
+    parser.add_argument('--vehicles', nargs='+', default=None)
+    parser.add_argument('--families', nargs='+', default=FAMILIES, choices=FAMILIES)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--epochs', type=int, default=None, help='50 for a full training, 5 to fine tune')
+    parser.add_argument('--metric', default='rmse', choices=['rmse', 'mae'])
+    parser.add_argument('--incremental', action='store_true', help='warm start the published models on new bookings')
+    parser.add_argument('--since', default=None, help='bookings after this date are new, instead of the manifest dates')
+    parser.add_argument('--rounds', type=int, default=BOOSTING_ROUNDS, help='boosting rounds added to XGBoost models')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    if args.incremental:
+        manifest = update_models(load_scaled(), args.vehicles, args.since, args.workers, args.epochs or 5, args.rounds)
+    else:
+        manifest = train_models(load_scaled(), args.vehicles, args.families, args.workers, args.epochs or 50, args.metric)
+    for vehicle, entry in manifest['models'].items():
+        print(f"{vehicle}: hourly {entry['hourly']['family']}, daily {entry['daily']['family']}")
+    print(f'Trained in {time.perf_counter() - start:.1f}s')
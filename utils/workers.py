@@ -0,0 +1,68 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Threads running preprocessing and inference in each server process
+PRICING_WORKERS = int(os.environ.get('PRICING_WORKERS', os.cpu_count() or 1))
+# Requests waiting for a worker before new ones are turned away, keeps the wait within a few computations
+PRICING_QUEUE_SIZE = int(os.environ.get('PRICING_QUEUE_SIZE', 8 * PRICING_WORKERS))
+# Seconds a request waits for its result
+PRICING_TIMEOUT = float(os.environ.get('PRICING_TIMEOUT', '30'))
+
+
+class Overloaded(Exception):
+    pass
+
+
+class InferencePool:
+    '''Bounded pool of worker threads for pricing computations
+
+    At most max_workers computations run at once and max_queue more wait for a worker, further submissions raise
+    Overloaded (back-pressure). Submissions with the key of a running or queued computation share its result.
+    '''
+
+    def __init__(self, max_workers=PRICING_WORKERS, max_queue=PRICING_QUEUE_SIZE, timeout=PRICING_TIMEOUT):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='pricing-worker')
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._in_flight = dict()
+        self._lock = threading.Lock()
+        self.active = 0
+        self.submitted = 0
+        self.coalesced = 0
+        self.rejected = 0
+
+    def submit(self, key, fn, *args):
+        '''future of fn(*args), shared with the computation of the same key if one is in flight, key None never shares'''
+        with self._lock:
+            future = self._in_flight.get(key) if key is not None else None
+            if future is not None:
+                self.coalesced += 1
+                return future
+            if not self._slots.acquire(blocking=False):
+                self.rejected += 1
+                raise Overloaded(f'{self.max_workers + self.max_queue} pricing requests already in progress')
+            self.active += 1
+            self.submitted += 1
+            future = self._executor.submit(fn, *args)
+            if key is not None:
+                self._in_flight[key] = future
+        future.add_done_callback(lambda future: self._done(key))
+        return future
+
+    def _done(self, key):
+        with self._lock:
+            self._in_flight.pop(key, None)
+            self.active -= 1
+        self._slots.release()
+
+    def run(self, key, fn, *args):
+        '''result of fn(*args) computed by the pool, TimeoutError after timeout seconds'''
+        return self.submit(key, fn, *args).result(timeout=self.timeout)
+
+    def stats(self):
+        with self._lock:
+            return {'workers': self.max_workers, 'queue_size': self.max_queue, 'active': self.active,
+                    'submitted': self.submitted, 'coalesced': self.coalesced, 'rejected': self.rejected}